@@ -0,0 +1,95 @@
+import glob
+import os
+import time
+
+import pandas as pd
+import torch
+from pytorch_lightning.utilities import move_data_to_device
+
+import create_instance
+import model.model as module_arch
+from model import lora as lora_module
+from soup import pearson_of, predict_dev
+
+
+def predict(model, loader, device):
+    predictions = []
+    model.eval()
+    with torch.no_grad():
+        for x in loader:
+            predictions.append(model(move_data_to_device(x, device)).reshape(-1))
+    return torch.cat(predictions)
+
+
+def adapter_ensemble(args, conf):
+    """
+    pretrained backbone 하나에 fold별 lora adapter를 번갈아 올려서 앙상블 추론
+
+    backbone은 첫 adapter 체크포인트로 한 번만 만들고, 나머지는 adapter / head / 추가 토큰 embedding만 교체
+    lora.merge면 adapter마다 weight에 합쳐서(merge) 추가 연산 없이 예측한 뒤 되돌림(unmerge)
+    fold별 / 앙상블 dev pearson, 로드 시간, 파일 크기를 adapter_report.csv로, 앙상블 예측을 output.csv로 저장
+    """
+    paths = sorted({path for pattern in conf.lora.adapters for path in glob.glob(pattern)})
+    if not paths:
+        exit("lora.adapters에 adapter 체크포인트 경로를 지정해주세요")
+
+    dataloader = create_instance.new_dataloader(conf)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model_class = getattr(module_arch, conf.model.model_class)
+
+    start = time.perf_counter()
+    model = model_class.load_from_checkpoint(paths[0]).to(device)
+    backbone_load_s = time.perf_counter() - start
+    if model.hparams.get("lora") is None:
+        exit(f"{paths[0]}은 lora로 학습한 체크포인트가 아닙니다")
+
+    dataloader.setup("test")
+    dev_loader = dataloader.test_dataloader()
+    targets = torch.cat([y.reshape(-1) for _, y in dev_loader]).to(device)
+    dataloader.setup("predict")
+    predict_loader = dataloader.predict_dataloader()
+
+    rows, dev_predictions, test_predictions = [], [], []
+    for i, path in enumerate(paths):
+        start = time.perf_counter()
+        if i > 0:
+            checkpoint = torch.load(path, map_location="cpu")
+            if checkpoint["hyper_parameters"].get("lora") != model.hparams["lora"] or checkpoint["hyper_parameters"]["model_name"] != model.model_name:
+                exit(f"{path}의 backbone 또는 lora 설정이 {paths[0]}과 다릅니다")
+            lora_module.load_adapter(model, checkpoint["state_dict"], checkpoint.get("added_embeddings"))
+        load_s = backbone_load_s if i == 0 else time.perf_counter() - start
+
+        if conf.lora.merge:
+            lora_module.merge_lora(model)
+        predictions, pearson, elapsed = predict_dev(model, dev_loader, device)
+        dev_predictions.append(predictions)
+        test_predictions.append(predict(model, predict_loader, device))
+        lora_module.unmerge_lora(model)
+
+        rows.append(
+            {
+                "adapter": os.path.basename(path),
+                "file_mb": os.path.getsize(path) / 1024**2,
+                "load_s": load_s,
+                "dev_pearson": pearson,
+                "latency_ms_per_pair": elapsed / len(targets) * 1000,
+            }
+        )
+        print(rows[-1])
+
+    rows.append(
+        {
+            "adapter": "ensemble",
+            "file_mb": sum(row["file_mb"] for row in rows),
+            "load_s": sum(row["load_s"] for row in rows),
+            "dev_pearson": pearson_of(torch.stack(dev_predictions).mean(dim=0), targets),
+            "latency_ms_per_pair": sum(row["latency_ms_per_pair"] for row in rows),
+        }
+    )
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    report.to_csv("adapter_report.csv", index=False)
+
+    output = pd.read_csv("../data/sample_submission.csv")
+    output["target"] = list(float(i) for i in torch.stack(test_predictions).mean(dim=0))
+    output.to_csv("output.csv", index=False)
@@ -0,0 +1,140 @@
+import copy
+import os
+import time
+
+import pandas as pd
+import torch
+from omegaconf import OmegaConf
+
+import create_instance
+
+
+def doubling(start, stop):
+    values = []
+    while start <= stop:
+        values.append(start)
+        start *= 2
+    return values
+
+
+def probe_batch(dataset, rows, length, pad_token_id):
+    # 데이터셋 앞쪽부터 rows개의 쌍을 length 길이로 맞춘 batch (가장 긴 쌍부터 써서 최악의 경우로 측정)
+    order = sorted(range(len(dataset)), key=lambda i: -len(dataset.inputs[i]))
+    x = torch.full((rows, length), pad_token_id, dtype=torch.long)
+    for row in range(rows):
+        ids = torch.tensor(dataset.inputs[order[row % len(order)]][:length])
+        x[row, : len(ids)] = ids
+    y = torch.tensor([dataset.targets[order[row % len(order)]] for row in range(rows)])
+    return x, y
+
+
+def measure(model, optimizer, batch, train, steps, device, snapshot):
+    """
+    warmup 1번 후 steps번 실행한 초당 쌍 수와 최대 메모리(MB, cuda만), 메모리가 부족하면 None
+
+    학습 측정은 optimizer.step()까지 실행하므로(메모리에 optimizer 상태 포함) 끝나면 snapshot(가중치, optimizer 상태)으로 되돌림
+    다음 후보와 추론 측정이 모두 같은 처음 가중치에서 실행됨
+    """
+    x, y = batch[0].to(device), batch[1].to(device)
+    if device == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+    try:
+        for step in range(steps + 1):
+            if step == 1:
+                if device == "cuda":
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+            if train:
+                loss = model.loss_func(model(x), y.float())
+                loss.backward()
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+            else:
+                with torch.no_grad():
+                    model(x)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+    except RuntimeError as e:
+        if "out of memory" not in str(e):
+            raise
+        return None
+    finally:
+        optimizer.zero_grad(set_to_none=True)
+        if train:
+            model.load_state_dict(snapshot[0])
+            optimizer.load_state_dict(snapshot[1])
+    peak_mb = torch.cuda.max_memory_allocated() / 1024**2 if device == "cuda" else float("nan")
+    return {"pairs_per_sec": len(x) * steps / elapsed, "peak_memory_mb": peak_mb}
+
+
+def autotune(args, conf):
+    """
+    설정한 모델 클래스와 현재 장비에서 학습 / 추론 batch 크기를 각각 늘려가며 처리량을 재고,
+    메모리 안에 들어가는 것 중 처리량이 가장 높은 값을 config overlay로 저장
+
+    bucket_boundaries를 쓰면 batch 크기 대신 batch당 토큰 수(max_tokens)를 늘려가며 측정하고,
+    메모리는 가장 긴 bucket 경계 길이의 batch(최악의 경우)로 확인함
+    """
+    tune_conf = conf.autotune
+    if tune_conf.steps < 1:
+        exit("autotune.steps는 1 이상이어야 합니다 (warmup 1번 뒤 steps번 측정)")
+    dataloader, model = create_instance.new_instance(conf)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model.to(device)
+    optimizer = model.configure_optimizers()
+    while isinstance(optimizer, (list, tuple)):  # ([optimizer], [scheduler]) 형태
+        optimizer = optimizer[0]
+    # 측정 전 가중치(cpu 복사본)와 optimizer 상태, 학습 측정마다 이 상태로 되돌림
+    snapshot = ({key: value.detach().cpu().clone() for key, value in model.state_dict().items()}, copy.deepcopy(optimizer.state_dict()))
+
+    if dataloader.lazy_tokenization:
+        exit("autotune은 토크나이징된 길이가 필요합니다 (data.lazy_tokenization: False로 실행)")
+    dataloader.setup("fit")
+    dataset = dataloader.train_dataset
+    pad_token_id = dataloader.tokenizer.pad_token_id
+    budget_mb = torch.cuda.get_device_properties(0).total_memory / 1024**2 * tune_conf.memory_fraction if device == "cuda" else None
+
+    bucket = dataloader.bucket_boundaries is not None
+    length = max(dataloader.bucket_boundaries) if bucket else dataloader.tokenizer.model_max_length
+    if bucket:
+        candidates = doubling(tune_conf.min_tokens, tune_conf.max_tokens)
+    else:
+        candidates = doubling(tune_conf.min_batch_size, tune_conf.max_batch_size)
+
+    rows = []
+    for train in [True, False]:
+        model.train(train)
+        for candidate in candidates:
+            batch_rows = max(1, candidate // length) if bucket else candidate
+            result = measure(model, optimizer, probe_batch(dataset, batch_rows, length, pad_token_id), train, tune_conf.steps, device, snapshot)
+            fits = result is not None and (budget_mb is None or result["peak_memory_mb"] <= budget_mb)
+            rows.append({"phase": "train" if train else "inference", "max_tokens" if bucket else "batch_size": candidate, "fits": fits, **(result or {})})
+            print(rows[-1])
+            if not fits:
+                break
+
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    report.to_csv("autotune_report.csv", index=False)
+    key = "max_tokens" if bucket else "batch_size"
+    best = {}
+    for phase in ["train", "inference"]:
+        fitting = report[(report["phase"] == phase) & report["fits"]]
+        if len(fitting) == 0:
+            exit(f"{phase}: 가장 작은 후보도 메모리에 들어가지 않습니다")
+        best[phase] = int(fitting.loc[fitting["pairs_per_sec"].idxmax(), key])
+
+    if bucket:
+        overlay = {"data": {"max_tokens": best["train"], "eval_max_tokens": best["inference"], "eval_batch_size": max(1, best["inference"] // length)}}
+    else:
+        overlay = {"train": {"batch_size": best["train"]}, "data": {"eval_batch_size": best["inference"]}}
+
+    # python main.py ... -o <overlay 경로>로 적용
+    os.makedirs("./config/overlay", exist_ok=True)
+    name = f"{conf.model.model_name.replace('/', '_')}_{type(model).__name__}_{device}"
+    overlay_path = f"./config/overlay/autotune_{name}.yaml"
+    OmegaConf.save(OmegaConf.create(overlay), overlay_path)
+    print(f"추천: {overlay}")
+    print(f"overlay 저장: {overlay_path}")
@@ -0,0 +1,92 @@
+import resource
+import time
+
+import pandas as pd
+import torch
+from omegaconf import OmegaConf
+from pytorch_lightning.utilities import move_data_to_device
+
+import create_instance
+
+
+def transformer_shape(config):
+    # 모델 계열마다 다른 config 이름을 맞춤 (funnel: d_model / n_head / block_sizes)
+    hidden = getattr(config, "hidden_size", None) or config.d_model
+    heads = getattr(config, "num_attention_heads", None) or config.n_head
+    layers = getattr(config, "num_hidden_layers", None) or sum(config.block_sizes)
+    return hidden, heads, layers
+
+
+def analytic_estimate(model, batch_size, seq_len):
+    """
+    파라미터 / gradient / AdamW 상태 / activation 메모리(MB)와 step당 FLOPs 추정
+
+    activation: 레이어당 s*b*h*(34 + 5*a*s/h) 바이트 (16bit 기준, Korthikanti et al. 2022)를 fp32로 환산해서 2배
+    FLOPs: forward = 2 * (embedding 제외 파라미터) * 토큰 수 + 레이어당 attention 4*b*s^2*h, 학습 step = forward의 3배
+    funnel은 블록마다 길이를 줄이므로 activation과 FLOPs가 실제보다 크게 나옴
+    """
+    hidden, heads, layers = transformer_shape(model.plm.config)
+    n_params = sum(p.numel() for p in model.parameters())
+    n_trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    n_embedding = model.plm.get_input_embeddings().weight.numel()
+    mb = 1024**2
+
+    activation = layers * seq_len * batch_size * hidden * (34 + 5 * heads * seq_len / hidden) * 2
+    tokens = batch_size * seq_len
+    forward_flops = 2 * (n_params - n_embedding) * tokens + layers * 4 * batch_size * seq_len**2 * hidden
+    estimate = {
+        "params": n_params,
+        "trainable_params": n_trainable,
+        "embedding_params": n_embedding,
+        "vocab_size": model.plm.get_input_embeddings().num_embeddings,
+        "param_mb": n_params * 4 / mb,
+        "grad_mb": n_trainable * 4 / mb,
+        "optimizer_mb": 2 * n_trainable * 4 / mb,  # AdamW exp_avg, exp_avg_sq (fp32)
+        "activation_mb": activation / mb,
+        "forward_gflops": forward_flops / 1e9,
+        "train_step_gflops": 3 * forward_flops / 1e9,
+    }
+    estimate["train_total_mb"] = estimate["param_mb"] + estimate["grad_mb"] + estimate["optimizer_mb"] + estimate["activation_mb"]
+    return estimate
+
+
+def dry_run(model, dataloader, device):
+    # 실제 batch 하나로 학습 step을 한 번 돌려서 최대 메모리와 시간을 잼 (cpu는 프로세스 최대 RSS)
+    dataloader.setup("fit")
+    x, y = next(iter(dataloader.train_dataloader()))
+    model.to(device).train()
+    optimizer = model.configure_optimizers()
+    while isinstance(optimizer, (list, tuple)):
+        optimizer = optimizer[0]
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    x, y = move_data_to_device((x, y), device)
+
+    start = time.perf_counter()
+    loss = model.loss_func(model(x), y.float())
+    loss.backward()
+    optimizer.step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+        peak_mb = torch.cuda.max_memory_allocated() / 1024**2
+    else:
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # linux는 KB 단위
+    return {"measured_peak_mb": peak_mb, "measured_step_s": time.perf_counter() - start}
+
+
+def capacity(args, conf):
+    dataloader, model = create_instance.new_instance(conf)
+    batch_size = conf.train.batch_size
+    seq_len = dataloader.tokenizer.model_max_length  # dynamic padding이면 최악의 경우
+    estimate = analytic_estimate(model, batch_size, seq_len)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cuda":
+        estimate["device_mb"] = torch.cuda.get_device_properties(0).total_memory / 1024**2
+        estimate["fits"] = estimate["train_total_mb"] <= estimate["device_mb"]
+    if OmegaConf.select(conf, "capacity.dry_run", default=False):
+        estimate.update(dry_run(model, dataloader, device))
+
+    report = pd.Series(estimate, name=f"{conf.model.model_name} ({type(model).__name__}, batch {batch_size}, length {seq_len})")
+    print(report.to_string())
+    report.to_frame().T.to_csv("capacity_report.csv", index=False)
@@ -0,0 +1,172 @@
+import glob
+import itertools
+import time
+
+import pandas as pd
+import torch
+from omegaconf import OmegaConf
+from pytorch_lightning.utilities import move_data_to_device
+
+import create_instance
+import model.model as module_arch
+from soup import pearson_of
+
+
+def load_stage(conf, stage):
+    # stage의 config(예: funnel_ensemble)를 base config 위에 덮어써서 그 모델의 tokenizer로 dev / test를 준비
+    stage_conf = OmegaConf.merge(conf, OmegaConf.load(f"./config/{stage.config}.yaml"))
+    dataloader = create_instance.new_dataloader(stage_conf)
+    dataloader.setup("test")
+    model_class = getattr(module_arch, OmegaConf.select(stage_conf, "model.model_class", default="Model"))
+    paths = sorted({path for pattern in stage.checkpoints for path in glob.glob(pattern)})
+    if not paths:
+        exit(f"{stage.config} stage의 checkpoints에 해당하는 파일이 없습니다")
+    return {"name": stage.config, "dataloader": dataloader, "model_class": model_class, "paths": paths}
+
+
+def run_member(stage, path, dataset, rows, device):
+    # rows 위치의 쌍만 입력 순서대로 예측, (예측값, 예측에 걸린 시간)
+    model = stage["model_class"].load_from_checkpoint(path).to(device).eval()
+    loader = stage["dataloader"].make_dataloader(type(dataset)([dataset.inputs[i] for i in rows]), False, bucket=False)  # lazy면 문자열 dataset
+    predictions = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for x in loader:
+            predictions.append(model(move_data_to_device(x, device)).reshape(-1).float().cpu())
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    del model
+    return torch.cat(predictions) if predictions else torch.zeros(0), elapsed
+
+
+def uncertainty(members, kind, grid_step):
+    """
+    지금까지 실행한 멤버 예측 [멤버 수, 쌍 수]로 쌍마다 불확실도를 계산
+    disagreement: 멤버 예측의 표준편차
+    grid: 평균 예측이 grid_step 배수(정수 점수) 사이 중간에 가까울수록 큼
+    """
+    if kind == "disagreement":
+        return members.std(dim=0, unbiased=False)
+    if kind == "grid":
+        scaled = members.mean(dim=0) / grid_step
+        return (scaled - scaled.round()).abs() * grid_step
+    raise ValueError(f"지원하지 않는 signal입니다: {kind} (disagreement, grid)")
+
+
+def simulate(stage_predictions, thresholds, kind, grid_step):
+    # dev에서 모든 멤버를 미리 실행해둔 예측으로 cascade 결과를 계산, (최종 예측, stage별 실행된 쌍 비율)
+    n_pairs = stage_predictions[0].size(1)
+    active = torch.ones(n_pairs, dtype=torch.bool)
+    final = torch.zeros(n_pairs)
+    ran = []
+    for k, threshold in enumerate(list(thresholds) + [None]):
+        ran.append(float(active.float().mean()))
+        members = torch.cat(stage_predictions[: k + 1])
+        mean = members.mean(dim=0)
+        if threshold is None:
+            final[active] = mean[active]
+            break
+        escalate = active & (uncertainty(members, kind, grid_step) > threshold)
+        final[active & ~escalate] = mean[active & ~escalate]
+        active = escalate
+    return final, ran
+
+
+def tune(stage_predictions, stage_costs, targets, cascade_conf, target_pearson):
+    # stage마다 signal의 분위수를 threshold 후보로 두고 전체 조합 중 target_pearson 이상에서 평균 연산량이 가장 작은 것 선택
+    candidates = []
+    for k in range(len(stage_predictions) - 1):
+        signal = uncertainty(torch.cat(stage_predictions[: k + 1]), cascade_conf.signal, cascade_conf.grid_step)
+        quantiles = torch.quantile(signal, torch.linspace(0, 1, cascade_conf.threshold_steps + 1)).tolist()
+        candidates.append([float("-inf")] + quantiles)  # -inf: 모든 쌍을 다음 stage로
+
+    rows = []
+    for thresholds in itertools.product(*candidates):
+        predictions, ran = simulate(stage_predictions, thresholds, cascade_conf.signal, cascade_conf.grid_step)
+        cost = sum(r * c for r, c in zip(ran, stage_costs))
+        rows.append({"thresholds": list(thresholds), "escalated": ran[1:], "ms_per_pair": cost, "dev_pearson": pearson_of(predictions, targets)})
+    tuning = pd.DataFrame(rows)
+    feasible = tuning[tuning["dev_pearson"] >= target_pearson]
+    best = feasible.loc[feasible["ms_per_pair"].idxmin()] if len(feasible) else tuning.loc[tuning["dev_pearson"].idxmax()]
+    return best, tuning
+
+
+def cascade(args, conf):
+    """
+    싼 모델부터 실행하고 불확실한 쌍만 다음(비싼) stage로 넘기는 앙상블 추론
+
+    쌍의 예측은 그 쌍이 멈춘 stage까지 실행한 모든 멤버의 평균 (마지막 stage까지 가면 전체 soft voting과 같음)
+    threshold는 dev에서 모든 멤버를 한 번씩 실행한 예측으로, target_pearson을 만족하면서 pair당 평균 연산 시간이 가장 작게 정함
+    결과: cascade_report.csv (stage별 / 전체 앙상블 / cascade 비교), cascade_tuning.csv (threshold 조합별), output.csv
+    """
+    cascade_conf = conf.cascade
+    if len(cascade_conf.stages) < 2:
+        exit("cascade.stages에 2개 이상의 stage를 지정해주세요")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    stages = [load_stage(conf, stage) for stage in cascade_conf.stages]
+    if cascade_conf.signal == "disagreement" and len(stages[0]["paths"]) < 2:
+        exit("disagreement signal은 첫 stage에 멤버가 2개 이상 필요합니다 (cascade.signal: grid 사용)")
+
+    dev_dataset = stages[0]["dataloader"].test_dataset
+    targets = torch.tensor(dev_dataset.targets, dtype=torch.float)
+    all_rows = list(range(len(targets)))
+
+    stage_predictions, stage_costs, rows = [], [], []
+    for stage in stages:
+        dataset = stage["dataloader"].test_dataset
+        members, cost = [], 0.0
+        for path in stage["paths"]:
+            predictions, elapsed = run_member(stage, path, dataset, all_rows, device)
+            members.append(predictions)
+            cost += elapsed / len(all_rows) * 1000
+        stage_predictions.append(torch.stack(members))
+        stage_costs.append(cost)
+        rows.append({"model": stage["name"], "members": len(members), "ms_per_pair": cost, "dev_pearson": pearson_of(torch.stack(members).mean(dim=0), targets)})
+        print(rows[-1])
+
+    everything = torch.cat(stage_predictions)
+    ensemble_pearson = pearson_of(everything.mean(dim=0), targets)
+    rows.append({"model": "ensemble", "members": len(everything), "ms_per_pair": sum(stage_costs), "dev_pearson": ensemble_pearson})
+    target_pearson = cascade_conf.target_pearson if cascade_conf.target_pearson is not None else ensemble_pearson - cascade_conf.tolerance
+
+    best, tuning = tune(stage_predictions, stage_costs, targets, cascade_conf, target_pearson)
+    thresholds = best["thresholds"]
+    rows.append({"model": "cascade (dev)", "members": len(everything), "ms_per_pair": best["ms_per_pair"], "dev_pearson": best["dev_pearson"], "escalated": best["escalated"]})
+    print(f"threshold {thresholds}, 다음 stage로 넘긴 비율 {best['escalated']}, target pearson {target_pearson:.4f}")
+
+    # test: stage마다 아직 남은 쌍만 실행
+    n_pairs = len(stages[0]["dataloader"].predict_dataset)
+    active = torch.arange(n_pairs)
+    final = torch.zeros(n_pairs)
+    seen = []  # 남은 쌍에 대해 지금까지 실행한 멤버 예측
+    elapsed = 0.0
+    escalated = []
+    for k, stage in enumerate(stages):
+        escalated.append(len(active) / n_pairs)
+        if len(active) == 0:
+            break
+        rows_k = active.tolist()
+        for path in stage["paths"]:
+            predictions, seconds = run_member(stage, path, stage["dataloader"].predict_dataset, rows_k, device)
+            seen.append(predictions)
+            elapsed += seconds
+        members = torch.stack(seen)
+        mean = members.mean(dim=0)
+        if k == len(stages) - 1:
+            final[active] = mean
+            break
+        escalate = uncertainty(members, cascade_conf.signal, cascade_conf.grid_step) > thresholds[k]
+        final[active[~escalate]] = mean[~escalate]
+        active = active[escalate]
+        seen = [member[escalate] for member in seen]
+    rows.append({"model": "cascade (test)", "members": len(everything), "ms_per_pair": elapsed / n_pairs * 1000, "escalated": escalated[1:]})
+
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    report.to_csv("cascade_report.csv", index=False)
+    tuning.to_csv("cascade_tuning.csv", index=False)
+
+    output = pd.read_csv("../data/sample_submission.csv")
+    output["target"] = list(float(i) for i in final)
+    output.to_csv("output.csv", index=False)
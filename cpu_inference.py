@@ -0,0 +1,145 @@
+import os
+import queue
+import time
+import traceback
+
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+import create_instance
+
+
+def worker(model, threads, cores, inputs, outputs):
+    # 각 worker는 자기 thread 수와 코어만 사용, 입력 큐에서 batch를 꺼내 예측
+    # 예외는 traceback 문자열로 부모에게 보냄 (부모가 기다리다 멈추지 않도록)
+    try:
+        torch.set_num_threads(threads)
+        if cores is not None:
+            os.sched_setaffinity(0, cores)
+        outputs.put(None)  # 준비 완료 (프로세스 시작 시간은 처리량 측정에서 제외)
+        with torch.no_grad():
+            while True:
+                item = inputs.get()
+                if item is None:
+                    break
+                batch_id, x = item
+                # 텐서를 그대로 보내면 부모가 (이미 종료했을 수 있는) worker 프로세스에 접속해서 받아오므로 list로 보냄
+                outputs.put((batch_id, model(x).reshape(-1).tolist()))
+    except Exception:
+        outputs.put(traceback.format_exc())
+
+
+def receive(outputs, processes, timeout=1.0):
+    # timeout마다 worker 상태를 확인해서, worker가 실패했거나 비정상 종료했으면 기다리지 않고 예외를 냄
+    all_exited = False
+    while True:
+        try:
+            item = outputs.get(timeout=timeout)
+        except queue.Empty:
+            dead = [process.exitcode for process in processes if not process.is_alive()]
+            # 모두 정상 종료했어도 마지막 결과가 아직 큐에 도착 중일 수 있으므로 한 번 더 기다린 뒤 판단
+            if any(code != 0 for code in dead) or all_exited:
+                stop_workers(processes)
+                raise RuntimeError(f"cpu_inference worker가 결과 없이 종료됨 (exitcode {dead})")
+            all_exited = len(dead) == len(processes)
+            continue
+        if isinstance(item, str):
+            stop_workers(processes)
+            raise RuntimeError(f"cpu_inference worker 실패:\n{item}")
+        return item
+
+
+def stop_workers(processes):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+def run_workers(model, batches, num_workers, threads, pin=True):
+    """
+    num_workers개의 프로세스로 batches를 예측하고 (입력 순서대로 이어붙인 예측값, 걸린 시간)을 돌려줌
+
+    model.share_memory()로 파라미터를 공유 메모리에 올려서 worker마다 복사본을 만들지 않음 (읽기 전용)
+    batch는 공유 큐로 나눠주므로 먼저 끝난 worker가 다음 batch를 가져감
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    if pin and num_workers * threads > len(cores):
+        raise ValueError(f"pin을 쓰려면 num_workers * threads_per_worker({num_workers * threads})가 사용 가능한 코어 수({len(cores)}) 이하여야 합니다")
+    context = mp.get_context("spawn")
+    inputs, outputs = context.Queue(), context.Queue()
+    processes = []
+    for i in range(num_workers):
+        worker_cores = set(cores[i * threads : (i + 1) * threads]) if pin else None
+        process = context.Process(target=worker, args=(model, threads, worker_cores, inputs, outputs), daemon=True)
+        process.start()
+        processes.append(process)
+
+    for _ in processes:
+        receive(outputs, processes)
+
+    start = time.perf_counter()
+    for batch_id, x in enumerate(batches):
+        inputs.put((batch_id, x))
+    for _ in processes:
+        inputs.put(None)
+    results = dict(receive(outputs, processes) for _ in batches)
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    return torch.cat([torch.tensor(results[i]) for i in range(len(batches))]), elapsed
+
+
+def candidate_configs(num_cores):
+    # worker 수는 2의 거듭제곱, worker마다 코어를 균등하게 나눔
+    configs = []
+    workers = 1
+    while workers <= num_cores:
+        configs.append((workers, num_cores // workers))
+        workers *= 2
+    return configs
+
+
+def cpu_inference(args, conf):
+    """
+    멀티 프로세스 CPU 추론
+
+    cpu_inference.num_workers / threads_per_worker가 null이면 predict 데이터 앞쪽 tune_batches개로
+    (worker 수, worker당 thread 수) 조합별 처리량을 재서 가장 빠른 조합을 고름
+    """
+    cpu_conf = conf.cpu_inference
+    dataloader, model = create_instance.new_instance(conf)
+    model, _, __ = create_instance.load_model(args, conf, dataloader, model)
+    model.cpu().eval()
+    if hasattr(model, "exit_threshold"):
+        model.exit_threshold = conf.early_exit.inference_threshold
+    model.share_memory()
+
+    dataloader.setup("predict")
+    batches = list(dataloader.predict_dataloader())
+    num_cores = len(os.sched_getaffinity(0))
+
+    if cpu_conf.num_workers is None or cpu_conf.threads_per_worker is None:
+        probe = batches[: cpu_conf.tune_batches]
+        rows = []
+        for num_workers, threads in candidate_configs(num_cores):
+            predictions, elapsed = run_workers(model, probe, num_workers, threads, cpu_conf.pin)
+            rows.append({"num_workers": num_workers, "threads_per_worker": threads, "pairs_per_sec": len(predictions) / elapsed})
+            print(rows[-1])
+        report = pd.DataFrame(rows)
+        print(report.to_string(index=False))
+        report.to_csv("cpu_inference_report.csv", index=False)
+        best = report.loc[report["pairs_per_sec"].idxmax()]
+        num_workers, threads = int(best["num_workers"]), int(best["threads_per_worker"])
+    else:
+        num_workers, threads = cpu_conf.num_workers, cpu_conf.threads_per_worker
+        if cpu_conf.pin and num_workers * threads > num_cores:
+            exit(f"cpu_inference.pin: num_workers * threads_per_worker({num_workers * threads})가 사용 가능한 코어 수({num_cores})보다 큽니다")
+
+    predictions, elapsed = run_workers(model, batches, num_workers, threads, cpu_conf.pin)
+    print(f"workers {num_workers} x threads {threads}: {len(predictions) / elapsed:.1f} pairs/s")
+
+    output = pd.read_csv("../data/sample_submission.csv")
+    output["target"] = list(float(i) for i in predictions)
+    output.to_csv("output.csv", index=False)
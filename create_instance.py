@@ -1,17 +1,12 @@
 import torch
+from omegaconf import OmegaConf
 
 import model.model as module_arch
 from data_loader.data_loaders import Dataloader, KfoldDataloader
 
 
-def new_instance(conf, config=None):  # sweep 부분 때문에 두번째 인자 추가
-
-    if config is None:
-        learning_rate = conf.train.learning_rate
-    else:
-        learning_rate = config.learning_rate
-
-    dataloader = Dataloader(
+def new_dataloader(conf):
+    return Dataloader(
         conf.model.model_name,
         conf.train.batch_size,
         conf.data.train_ratio,
@@ -20,16 +15,91 @@ def new_instance(conf, config=None):  # sweep 부분 때문에 두번째 인자
         conf.path.test_path,
         conf.path.predict_path,
         conf.data.swap,
+        OmegaConf.select(conf, "data.text_preprocessing", default=False),
+        max_length=OmegaConf.select(conf, "data.max_length", default=128),
+        bucket_boundaries=OmegaConf.select(conf, "data.bucket_boundaries", default=None),
+        packing=OmegaConf.select(conf, "data.packing", default=False),
+        eval_batch_size=OmegaConf.select(conf, "data.eval_batch_size", default=None),
+        max_tokens=OmegaConf.select(conf, "data.max_tokens", default=None),
+        eval_max_tokens=OmegaConf.select(conf, "data.eval_max_tokens", default=None),
+        shard_dir=OmegaConf.select(conf, "data.shard_dir", default=None),
+        shard_buffer_size=OmegaConf.select(conf, "data.shard_buffer_size", default=10000),
+        num_workers=OmegaConf.select(conf, "data.num_workers", default=0),
+        lazy_tokenization=OmegaConf.select(conf, "data.lazy_tokenization", default=False),
+        sub_val_size=sub_val_size(conf),
+        pruning=pruning_config(conf),
     )
 
+
+def sub_val_size(conf):
+    # sub_validation.every_n_steps가 설정되어 있을 때만 data 모듈이 검증 부분집합을 만듦
+    if not OmegaConf.select(conf, "sub_validation.every_n_steps", default=None):
+        return None
+    return conf.sub_validation.size
+
+
+def pruning_config(conf):
+    # pruning.use_pruning이면 학습 batch sampler(LossPruningBatchSampler)에 넘길 설정
+    if not OmegaConf.select(conf, "pruning.use_pruning", default=False):
+        return None
+    return {
+        "prune_ratio": conf.pruning.prune_ratio,
+        "keep_prob": conf.pruning.keep_prob,
+        "warmup_epochs": conf.pruning.warmup_epochs,
+        "readmit_every": conf.pruning.readmit_every,
+        "momentum": conf.pruning.momentum,
+    }
+
+
+def lora_config(conf):
+    # lora.use_lora면 모델 생성자에 넘길 adapter 설정 (hparams로 저장되어 load_from_checkpoint 때 같은 구조로 복원)
+    if not OmegaConf.select(conf, "lora.use_lora", default=False):
+        return None
+    return {
+        "r": conf.lora.r,
+        "alpha": conf.lora.alpha,
+        "dropout": conf.lora.dropout,
+        "target_modules": list(conf.lora.target_modules),
+    }
+
+
+def new_instance(conf, config=None):  # sweep 부분 때문에 두번째 인자 추가
+
+    if config is None:
+        learning_rate = conf.train.learning_rate
+    else:
+        learning_rate = config.learning_rate
+
+    dataloader = new_dataloader(conf)
+
+    # dynamic padding / packing을 쓰면 모델이 pad 토큰을 attention에서 제외하도록 pad id를 넘김
+    pad_token_id = None if dataloader.padding() == "max_length" else dataloader.tokenizer.pad_token_id
+
     # custom 모델 인지 확인
-    model = module_arch.Model(
-        conf.model.model_name,
-        learning_rate,
-        conf.train.loss,
-        dataloader.new_vocab_size(),
-        conf.train.use_frozen,
-    )  # 새롭게 추가한 토큰 사이즈 반영
+    if OmegaConf.select(conf, "early_exit.use_early_exit", default=False):
+        model_class = OmegaConf.select(conf, "model.model_class", default="Model")
+        if model_class not in module_arch.early_exit_config:
+            exit(f"early exit을 지원하지 않는 model_class입니다: {model_class} ({', '.join(module_arch.early_exit_config)})")
+        model = module_arch.early_exit_config[model_class](
+            conf.model.model_name,
+            learning_rate,
+            conf.train.loss,
+            dataloader.new_vocab_size(),
+            conf.train.use_frozen,
+            conf.early_exit.training,
+            pad_token_id=pad_token_id,
+        )
+    else:
+        # model.model_class로 model/model.py의 클래스 선택 (없으면 Model)
+        model = getattr(module_arch, OmegaConf.select(conf, "model.model_class", default="Model"))(
+            conf.model.model_name,
+            learning_rate,
+            conf.train.loss,
+            dataloader.new_vocab_size(),
+            conf.train.use_frozen,
+            pad_token_id=pad_token_id,
+            lora=lora_config(conf),
+        )  # 새롭게 추가한 토큰 사이즈 반영
 
     return dataloader, model
 
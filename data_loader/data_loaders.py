@@ -1,3 +1,4 @@
+import functools
 import os
 import re
 
@@ -5,8 +6,10 @@ import pandas as pd
 import pytorch_lightning as pl
 import torch
 import transformers
+from omegaconf import OmegaConf
 from sklearn.model_selection import KFold, StratifiedShuffleSplit
-from tqdm.auto import tqdm
+
+PREPROCESSING_RULES = "./config/text_preprocessing.yaml"  # text_preprocessing 규칙 파일
 
 
 class Dataset(torch.utils.data.Dataset):
@@ -24,8 +27,41 @@ class Dataset(torch.utils.data.Dataset):
         return len(self.inputs)
 
 
+class PairTextDataset(Dataset):
+    # 토크나이징하지 않은 문장 쌍 문자열을 그대로 돌려줌, 토크나이징은 DataLoader worker의 TokenizeCollate에서 batch 단위로
+    def __getitem__(self, idx):
+        if len(self.targets) == 0:
+            return self.inputs[idx]
+        else:
+            return self.inputs[idx], torch.tensor(self.targets[idx])
+
+
 class Dataloader(pl.LightningDataModule):
-    def __init__(self, model_name, batch_size, train_ratio, shuffle, train_path, test_path, predict_path, swap, text_preprocessing=False):
+    def __init__(
+        self,
+        model_name,
+        batch_size,
+        train_ratio,
+        shuffle,
+        train_path,
+        test_path,
+        predict_path,
+        swap,
+        text_preprocessing=False,
+        preprocessing_rules=PREPROCESSING_RULES,
+        max_length=128,
+        bucket_boundaries=None,
+        packing=False,
+        eval_batch_size=None,
+        max_tokens=None,
+        eval_max_tokens=None,
+        shard_dir=None,
+        shard_buffer_size=10000,
+        num_workers=0,
+        lazy_tokenization=False,
+        sub_val_size=None,
+        pruning=None,
+    ):
         super().__init__()
         self.model_name = model_name
         self.batch_size = batch_size
@@ -38,6 +74,7 @@ class Dataloader(pl.LightningDataModule):
 
         self.train_dataset = None
         self.val_dataset = None
+        self.sub_val_dataset = None
         self.test_dataset = None
         self.predict_dataset = None
 
@@ -71,13 +108,31 @@ class Dataloader(pl.LightningDataModule):
             self.tokenizer = transformers.FunnelTokenizer.from_pretrained(self.model_name)
         else:
             self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.model_name)
-
-        self.tokenizer.model_max_length = 128
+        if lazy_tokenization and not self.tokenizer.is_fast:  # worker에서 batch 단위로 부를 때는 Rust 기반 fast tokenizer 사용 (같은 vocab)
+            self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.model_name, use_fast=True)
+
+        self.tokenizer.model_max_length = max_length
+        self.bucket_boundaries = bucket_boundaries  # 설정하면 max_length까지 padding하지 않고 길이 bucket별로 batch 구성
+        self.packing = packing  # True면 여러 문장 쌍을 max_length 길이의 행 하나에 이어붙여서 학습/추론
+        self.eval_batch_size = eval_batch_size or batch_size  # 검증/테스트/추론 batch 크기 (gradient가 없어서 더 크게 잡을 수 있음)
+        self.max_tokens = max_tokens  # bucket 사용 시 batch당 토큰 수 상한 (설정하면 bucket마다 batch 크기가 달라짐)
+        self.eval_max_tokens = eval_max_tokens or max_tokens
+        self.shard_dir = shard_dir  # 설정하면 train csv 대신 data_loader/shards.py로 만든 shard를 스트리밍 (검증은 test_path 사용)
+        self.shard_buffer_size = shard_buffer_size
+        self.num_workers = num_workers
+        # True면 setup에서는 문장 쌍 문자열만 만들고 토크나이징은 DataLoader worker에서 batch마다 (첫 step까지 기다리지 않음)
+        self.lazy_tokenization = lazy_tokenization
+        self.dataset_class = PairTextDataset if lazy_tokenization else Dataset
+        # 설정하면 검증 split에서 binary-label 비율대로 고정 부분집합을 뽑아 학습 중 sub validation에 사용 (1 이하면 비율, 크면 쌍 개수)
+        self.sub_val_size = sub_val_size
+        # 설정하면({prune_ratio, keep_prob, warmup_epochs, readmit_every, momentum}) 학습 batch를 LossPruningBatchSampler로 뽑음
+        self.pruning = pruning
         # ###
         # self.add_token = ["<PERSON>"]  # , "rtt", "sampled"
         # ###
         # 넣을 토큰 지정 , "rtt", "sampled"
         self.use_preprocessing = text_preprocessing
+        self.preprocessor = TextPreprocessor.from_yaml(preprocessing_rules) if text_preprocessing else None
         if self.use_preprocessing:
             self.add_token = [
                 "<PERSON>",
@@ -101,33 +156,13 @@ class Dataloader(pl.LightningDataModule):
         self.text_columns = ["sentence_1", "sentence_2"]
 
     def tokenizing(self, dataframe, swap):
-        data = []
-        for idx, item in tqdm(dataframe.iterrows(), desc="tokenizing", total=len(dataframe)):
-            text = "[SEP]".join([item[text_column] for text_column in self.text_columns])
-            if self.use_preprocessing:
-                text = text_preprocessing(text)  # 전처리 추가
-
-            ### rtt, sampled 토큰을 추가한 경우 텍스트 맨 앞에 해당 토큰 붙여줌
-            # source = item["source"].split("-")[-1]
-            # text = source + "[SEP]" + text
-            ###
-            outputs = self.tokenizer(text, add_special_tokens=True, padding="max_length", truncation=True)
-            data.append(outputs["input_ids"])
-
-        if swap:  # swap 적용시 양방향 될 수 있도록
-            for idx, item in tqdm(dataframe.iterrows(), desc="tokenizing", total=len(dataframe)):
-                text = "[SEP]".join([item[text_column] for text_column in self.text_columns[::-1]])
-
-                if self.use_preprocessing:
-                    text = text_preprocessing(text)  # 전처리 추가
-                ###
-                # source = item["source"].split("-")[-1]
-                # text = source + "[SEP]" + text
-                ###
-                outputs = self.tokenizer(text, add_special_tokens=True, padding="max_length", truncation=True)
-                data.append(outputs["input_ids"])
-
-        return data
+        ### rtt, sampled 토큰을 추가한 경우 텍스트 맨 앞에 해당 토큰 붙여줌
+        # source = item["source"].split("-")[-1]
+        # text = source + "[SEP]" + text
+        ###
+        if self.lazy_tokenization:
+            return pair_texts(dataframe, self.text_columns, swap, self.preprocessor)
+        return tokenize_pairs(self.tokenizer, dataframe, self.text_columns, swap, self.preprocessor, self.padding())
 
     def preprocessing(self, data, swap):
         data = data.drop(columns=self.delete_columns)  # id column 삭제
@@ -144,7 +179,25 @@ class Dataloader(pl.LightningDataModule):
         return inputs, targets
 
     def setup(self, stage="fit"):
-        if stage == "fit":
+        if stage == "fit" and self.shard_dir is not None:
+            from data_loader.shards import ShardedIterableDataset  # shards.py가 이 모듈을 import하므로 여기서 import
+
+            # csv 전체를 읽지 않고 shard를 mmap으로 스트리밍, 분할은 shard를 만들 때 이미 끝났으므로 dev를 검증에 사용
+            self.train_dataset = ShardedIterableDataset(
+                self.shard_dir,
+                self.shuffle,
+                self.shard_buffer_size,
+                seed=torch.initial_seed() % 2**31,
+                expected={"model_name": self.model_name, "max_length": self.tokenizer.model_max_length, "padding": self.padding()},
+            )
+            val_data = pd.read_csv(self.test_path)
+            val_inputs, val_targets = self.preprocessing(val_data, False)
+            self.val_dataset = self.dataset_class(val_inputs, val_targets)
+            self.setup_sub_val(val_data)
+            print("train data len : ", self.train_dataset.num_rows)
+            print("valid data len : ", len(val_inputs))
+
+        elif stage == "fit":
             total_data = pd.read_csv(self.train_path)
 
             split = StratifiedShuffleSplit(n_splits=1, test_size=1 - self.train_ratio, random_state=1004)  # 층화 추출 fix
@@ -160,8 +213,9 @@ class Dataloader(pl.LightningDataModule):
             print("train data len : ", len(train_inputs))
             print("valid data len : ", len(val_inputs))
 
-            self.train_dataset = Dataset(train_inputs, train_targets)
-            self.val_dataset = Dataset(val_inputs, val_targets)
+            self.train_dataset = self.dataset_class(train_inputs, train_targets)
+            self.val_dataset = self.dataset_class(val_inputs, val_targets)
+            self.setup_sub_val(val_data)
 
         else:
             test_data = pd.read_csv(self.test_path)
@@ -170,24 +224,53 @@ class Dataloader(pl.LightningDataModule):
             test_inputs, test_targets = self.preprocessing(test_data, False)
             predict_inputs, predict_targets = self.preprocessing(predict_data, False)
 
-            self.test_dataset = Dataset(test_inputs, test_targets)
-            self.predict_dataset = Dataset(predict_inputs, predict_targets)
+            self.test_dataset = self.dataset_class(test_inputs, test_targets)
+            self.predict_dataset = self.dataset_class(predict_inputs, predict_targets)
+
+    def setup_sub_val(self, val_data):
+        # sub validation은 swap 없이 한 방향만 (전체 검증보다 자주 돌기 때문에 최대한 가볍게)
+        if self.sub_val_size is None:
+            return
+        sub_inputs, sub_targets = self.preprocessing(stratified_subsample(val_data, self.sub_val_size), False)
+        self.sub_val_dataset = self.dataset_class(sub_inputs, sub_targets)
+        print("sub valid data len : ", len(sub_inputs))
 
     def train_dataloader(self):
-        return torch.utils.data.DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=self.shuffle)
+        return self.make_dataloader(self.train_dataset, self.shuffle, train=True)
 
     def val_dataloader(self):
-        return torch.utils.data.DataLoader(self.val_dataset, batch_size=self.batch_size)
+        return self.make_dataloader(self.val_dataset, False)
 
     def test_dataloader(self):
-        return torch.utils.data.DataLoader(self.test_dataset, batch_size=self.batch_size)
+        return self.make_dataloader(self.test_dataset, False)
 
     def predict_dataloader(self):
-        return torch.utils.data.DataLoader(self.predict_dataset, batch_size=self.batch_size)
+        # 예측 결과가 입력 순서와 같아야 하므로 bucket으로 묶지 않음
+        return self.make_dataloader(self.predict_dataset, False, bucket=False)
+
+    def make_dataloader(self, dataset, shuffle, bucket=True, train=False):
+        return build_dataloader(
+            dataset,
+            self.batch_size if train else self.eval_batch_size,
+            shuffle,
+            self.tokenizer.pad_token_id,
+            self.bucket_boundaries,
+            bucket=bucket,
+            packing=self.packing,
+            max_length=self.tokenizer.model_max_length,
+            max_tokens=self.max_tokens if train else self.eval_max_tokens,
+            num_workers=self.num_workers,
+            tokenizer=self.tokenizer,
+            pruning=self.pruning if train else None,
+        )
 
     def new_vocab_size(self):
         return self.new_token_count + self.tokenizer.vocab_size
 
+    def padding(self):
+        # bucket / packing은 batch를 만들 때 padding하므로 토크나이징 단계에서는 padding하지 않음
+        return "max_length" if self.bucket_boundaries is None and not self.packing else False
+
 
 class KfoldDataloader(pl.LightningDataModule):
     def __init__(
@@ -201,6 +284,16 @@ class KfoldDataloader(pl.LightningDataModule):
         test_path,
         predict_path,
         use_swap,
+        max_length=128,
+        bucket_boundaries=None,
+        packing=False,
+        eval_batch_size=None,
+        max_tokens=None,
+        eval_max_tokens=None,
+        num_workers=0,
+        lazy_tokenization=False,
+        sub_val_size=None,
+        pruning=None,
     ):
 
         super().__init__()
@@ -217,6 +310,7 @@ class KfoldDataloader(pl.LightningDataModule):
 
         self.train_dataset = None
         self.val_dataset = None
+        self.sub_val_dataset = None
         self.test_dataset = None
         self.predict_dataset = None
 
@@ -248,8 +342,20 @@ class KfoldDataloader(pl.LightningDataModule):
             self.tokenizer = transformers.FunnelTokenizer.from_pretrained(self.model_name)
         else:
             self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.model_name)
-
-        self.tokenizer.model_max_length = 128
+        if lazy_tokenization and not self.tokenizer.is_fast:  # worker에서 batch 단위로 부를 때는 Rust 기반 fast tokenizer 사용 (같은 vocab)
+            self.tokenizer = transformers.AutoTokenizer.from_pretrained(self.model_name, use_fast=True)
+
+        self.tokenizer.model_max_length = max_length
+        self.bucket_boundaries = bucket_boundaries  # 설정하면 max_length까지 padding하지 않고 길이 bucket별로 batch 구성
+        self.packing = packing  # True면 여러 문장 쌍을 max_length 길이의 행 하나에 이어붙여서 학습/추론
+        self.eval_batch_size = eval_batch_size or batch_size  # 검증/테스트/추론 batch 크기 (gradient가 없어서 더 크게 잡을 수 있음)
+        self.max_tokens = max_tokens  # bucket 사용 시 batch당 토큰 수 상한 (설정하면 bucket마다 batch 크기가 달라짐)
+        self.eval_max_tokens = eval_max_tokens or max_tokens
+        self.num_workers = num_workers
+        self.lazy_tokenization = lazy_tokenization
+        self.dataset_class = PairTextDataset if lazy_tokenization else Dataset
+        self.sub_val_size = sub_val_size
+        self.pruning = pruning
         ###
         self.add_token = ["<PERSON>"]
         ###
@@ -262,22 +368,10 @@ class KfoldDataloader(pl.LightningDataModule):
         self.text_columns = ["sentence_1", "sentence_2"]
 
     def tokenizing(self, dataframe, swap):
-        data = []
         print("ToKenizer info: \n", self.tokenizer)
-        for idx, item in tqdm(dataframe.iterrows(), desc="tokenizing", total=len(dataframe)):
-            text = "[SEP]".join([item[text_column] for text_column in self.text_columns])
-            # text = text_preprocessing(text)
-            outputs = self.tokenizer(text, add_special_tokens=True, padding="max_length", truncation=True)
-            data.append(outputs["input_ids"])
-
-        if swap:  # swap 적용시 양방향 될 수 있도록
-            for idx, item in tqdm(dataframe.iterrows(), desc="tokenizing", total=len(dataframe)):
-                text = "[SEP]".join([item[text_column] for text_column in self.text_columns[::-1]])
-                # text = text_preprocessing(text)
-                outputs = self.tokenizer(text, add_special_tokens=True, padding="max_length", truncation=True)
-                data.append(outputs["input_ids"])
-
-        return data
+        if self.lazy_tokenization:
+            return pair_texts(dataframe, self.text_columns, swap)
+        return tokenize_pairs(self.tokenizer, dataframe, self.text_columns, swap, padding=self.padding())
 
     def preprocessing(self, data, swap):
         data = data.drop(columns=self.delete_columns)
@@ -313,14 +407,15 @@ class KfoldDataloader(pl.LightningDataModule):
             train_inputs, train_targets = self.preprocessing(total_data.loc[train_indexes], self.swap)
             valid_inputs, valid_targets = self.preprocessing(total_data.loc[val_indexes], False)
 
-            train_dataset = Dataset(train_inputs, train_targets)
-            valid_dataset = Dataset(valid_inputs, valid_targets)
+            train_dataset = self.dataset_class(train_inputs, train_targets)
+            valid_dataset = self.dataset_class(valid_inputs, valid_targets)
 
             print("After Swap Train data len: \n", len(train_inputs))
             print("After Swap Valid data len: \n", len(valid_inputs))
 
             self.train_dataset = train_dataset
             self.val_dataset = valid_dataset
+            self.setup_sub_val(total_data.loc[val_indexes])
 
         else:
             test_data = pd.read_csv(self.test_path)
@@ -329,32 +424,449 @@ class KfoldDataloader(pl.LightningDataModule):
             test_inputs, test_targets = self.preprocessing(test_data, False)
             predict_inputs, predict_targets = self.preprocessing(predict_data, False)
 
-            self.test_dataset = Dataset(test_inputs, test_targets)
-            self.predict_dataset = Dataset(predict_inputs, predict_targets)
+            self.test_dataset = self.dataset_class(test_inputs, test_targets)
+            self.predict_dataset = self.dataset_class(predict_inputs, predict_targets)
+
+    def setup_sub_val(self, val_data):
+        # sub validation은 swap 없이 한 방향만 (전체 검증보다 자주 돌기 때문에 최대한 가볍게)
+        if self.sub_val_size is None:
+            return
+        sub_inputs, sub_targets = self.preprocessing(stratified_subsample(val_data, self.sub_val_size), False)
+        self.sub_val_dataset = self.dataset_class(sub_inputs, sub_targets)
+        print("sub valid data len : ", len(sub_inputs))
 
     def train_dataloader(self):
-        return torch.utils.data.DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=self.shuffle)
+        return self.make_dataloader(self.train_dataset, self.shuffle, train=True)
 
     def val_dataloader(self):
-        return torch.utils.data.DataLoader(self.val_dataset, batch_size=self.batch_size)
+        return self.make_dataloader(self.val_dataset, False)
 
     def test_dataloader(self):
-        return torch.utils.data.DataLoader(self.test_dataset, batch_size=self.batch_size)
+        return self.make_dataloader(self.test_dataset, False)
 
     def predict_dataloader(self):
-        return torch.utils.data.DataLoader(self.predict_dataset, batch_size=self.batch_size)
+        # 예측 결과가 입력 순서와 같아야 하므로 bucket으로 묶지 않음
+        return self.make_dataloader(self.predict_dataset, False, bucket=False)
+
+    def make_dataloader(self, dataset, shuffle, bucket=True, train=False):
+        return build_dataloader(
+            dataset,
+            self.batch_size if train else self.eval_batch_size,
+            shuffle,
+            self.tokenizer.pad_token_id,
+            self.bucket_boundaries,
+            bucket=bucket,
+            packing=self.packing,
+            max_length=self.tokenizer.model_max_length,
+            max_tokens=self.max_tokens if train else self.eval_max_tokens,
+            num_workers=self.num_workers,
+            tokenizer=self.tokenizer,
+            pruning=self.pruning if train else None,
+        )
 
     def new_vocab_size(self):
         return self.new_token_count + self.tokenizer.vocab_size
 
+    def padding(self):
+        # bucket / packing은 batch를 만들 때 padding하므로 토크나이징 단계에서는 padding하지 않음
+        return "max_length" if self.bucket_boundaries is None and not self.packing else False
+
+
+class TextPreprocessor:
+    """
+    yaml에 정의된 정규화 규칙들을 하나의 정규식으로 컴파일해서 한 번에 적용함
+
+    규칙 i는 (?P<r{i}>pattern) 그룹이 되고, 매치된 그룹 이름으로 치환 문자열을 찾음
+    """
+
+    def __init__(self, rules):
+        self.repls = {f"r{i}": rule["repl"] for i, rule in enumerate(rules)}
+        self.pattern = re.compile("|".join(f"(?P<r{i}>{rule['pattern']})" for i, rule in enumerate(rules)))
+
+    @classmethod
+    def from_yaml(cls, path=PREPROCESSING_RULES):
+        return cls(OmegaConf.to_container(OmegaConf.load(path).rules))
+
+    def _replace(self, match):
+        return self.repls[match.lastgroup]
+
+    def __call__(self, sentence):
+        return self.pattern.sub(self._replace, sentence)
+
+    def apply(self, column):
+        # 같은 문장은 한 번만 처리한 뒤 컬럼 전체에 매핑
+        uniques = column.unique()
+        return column.map(dict(zip(uniques, map(self, uniques))))
+
+
+def stratified_subsample(data, size, seed=1004):
+    # binary-label 비율을 유지하는 고정 부분집합 (seed 고정이라 매 epoch / 재개 후에도 같은 쌍), size가 1 이하면 비율, 크면 행 수
+    if size >= len(data) or size == 1:
+        return data
+    split = StratifiedShuffleSplit(n_splits=1, train_size=int(size) if size > 1 else size, random_state=seed)
+    sub_idx, _ = next(split.split(data, data["binary-label"]))
+    return data.iloc[sub_idx]
+
+
+def pair_texts(dataframe, text_columns, swap, preprocessor=None):
+    # 문장 컬럼별로 전처리를 한 번만 적용하고, swap 시에도 같은 결과를 재사용
+    first, second = (dataframe[text_column] for text_column in text_columns)
+    if preprocessor is not None:
+        first, second = preprocessor.apply(first), preprocessor.apply(second)
+
+    texts = (first + "[SEP]" + second).tolist()
+    if swap:  # swap 적용시 양방향 될 수 있도록
+        texts += (second + "[SEP]" + first).tolist()
+    return texts
+
+
+def tokenize_pairs(tokenizer, dataframe, text_columns, swap, preprocessor=None, padding="max_length"):
+    texts = pair_texts(dataframe, text_columns, swap, preprocessor)
+
+    # 중복된 문장 쌍은 한 번만 토크나이징
+    uniques = list(dict.fromkeys(texts))
+    outputs = tokenizer(uniques, add_special_tokens=True, padding=padding, truncation=True)
+    input_ids = dict(zip(uniques, outputs["input_ids"]))
+    return [input_ids[text] for text in texts]
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    길이가 비슷한 샘플끼리 batch를 구성함
+
+    각 샘플은 길이가 들어가는 가장 작은 boundary의 bucket에 배정되고, batch는 한 bucket 안에서만 만들어짐
+    shuffle이면 bucket 안의 순서와 batch 순서를 매 epoch 섞음
+    분산 학습이면 모든 rank가 같은 seed로 batch 목록을 만든 뒤 batch 단위로 나눠 가짐 (rank마다 batch 수 동일)
+    """
+
+    def __init__(self, lengths, boundaries, batch_size, shuffle=True, seed=0, num_replicas=1, rank=0, max_tokens=None):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.start = 0
+
+        boundaries = sorted(boundaries)
+        self.buckets = [[] for _ in boundaries]
+        for idx, length in enumerate(lengths):
+            bucket = next((i for i, b in enumerate(boundaries) if length <= b), len(boundaries) - 1)
+            self.buckets[bucket].append(idx)
+        # max_tokens가 있으면 bucket마다 (경계 길이 x batch 크기)가 max_tokens를 넘지 않도록 batch 크기를 정함
+        self.bucket_batch_sizes = [batch_size if max_tokens is None else max(1, max_tokens // b) for b in boundaries]
+
+    def set_epoch(self, epoch):  # Lightning이 매 epoch 호출
+        self.epoch = epoch
+
+    def skip(self, num_batches):  # 재개 시 이번 epoch에서 이미 학습한 batch 수만큼 건너뜀
+        self.start = num_batches
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        start, self.start = self.start, 0
+
+        batches = []
+        for bucket, size in zip(self.buckets, self.bucket_batch_sizes):
+            if self.shuffle:
+                bucket = [bucket[i] for i in torch.randperm(len(bucket), generator=generator).tolist()]
+            batches += [bucket[i : i + size] for i in range(0, len(bucket), size)]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return iter(batches[self.rank : len(self) * self.num_replicas : self.num_replicas][start:])
+
+    def __len__(self):
+        num_batches = sum((len(bucket) + size - 1) // size for bucket, size in zip(self.buckets, self.bucket_batch_sizes))
+        return num_batches // self.num_replicas
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    epoch와 seed로 순서가 정해지는 sampler (DistributedSampler와 같은 방식으로 rank별 분할)
+
+    skip(n)을 호출하면 다음 epoch 한 번은 앞의 n개 샘플을 건너뛰고 나머지만 돌려줌
+    __len__은 항상 epoch 전체 길이라서 Lightning이 세는 epoch당 batch 수는 바뀌지 않음
+    """
+
+    def __init__(self, num_samples, shuffle, seed=0, num_replicas=1, rank=0):
+        self.num_samples = num_samples
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):  # Lightning이 매 epoch 호출
+        self.epoch = epoch
+
+    def skip(self, num_samples):
+        self.start = num_samples
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.num_samples, generator=generator).tolist()
+        else:
+            indices = list(range(self.num_samples))
+        indices += indices[: len(self) * self.num_replicas - len(indices)]  # rank마다 같은 개수가 되도록 앞쪽을 반복
+        start, self.start = self.start, 0
+        return iter(indices[self.rank :: self.num_replicas][start:])
+
+    def __len__(self):
+        return (self.num_samples + self.num_replicas - 1) // self.num_replicas
+
+
+class LossPruningBatchSampler(torch.utils.data.Sampler):
+    """
+    최근 epoch의 예시별 loss로 쉬운 예시를 덜 뽑는 batch sampler (pruning 설정, loss 기록은 utils/loss_pruning.py의 LossPruning callback)
+
+    예시별 loss는 epoch마다 평균을 내서 momentum으로 지수이동평균(EMA)함
+    EMA가 낮은 쪽 prune_ratio 비율의 예시는 keep_prob 확률로만 뽑고, 뽑히면 loss에 importance weight 1 / keep_prob를 곱함
+    (epoch 전체 loss 합의 기대값이 전체 데이터와 같음), 아직 loss가 없는 예시와 나머지는 항상 뽑음 (weight 1)
+    warmup_epochs 동안과 그 뒤 readmit_every epoch마다 한 번은 전체 데이터를 학습해서 모든 예시의 loss를 새로 잼
+    분산 학습이면 모든 rank가 같은 loss 표와 seed로 batch 목록을 만든 뒤 batch 단위로 나눠 가짐 (rank마다 batch 수 동일)
+    """
+
+    def __init__(
+        self, num_samples, batch_size, shuffle=True, seed=0, num_replicas=1, rank=0, prune_ratio=0.5, keep_prob=0.3, warmup_epochs=1, readmit_every=3, momentum=0.5
+    ):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.prune_ratio = prune_ratio
+        self.keep_prob = keep_prob
+        self.warmup_epochs = warmup_epochs
+        self.readmit_every = readmit_every
+        self.momentum = momentum
+        self.epoch = 0
+        self.start = 0
+
+        self.ema = torch.full((num_samples,), float("nan"))  # 예시별 loss EMA (nan: 아직 학습하지 않음)
+        self.weights = torch.ones(num_samples)  # 이번 epoch의 importance weight
+        self.loss_sum = torch.zeros(num_samples)  # 이번 epoch에 이 rank가 기록한 loss 합과 횟수
+        self.loss_count = torch.zeros(num_samples)
+        self.batches = []  # 이번 epoch에 이 rank가 학습할 batch 목록, batch_idx로 예시 index를 찾는 데 사용
+        self.prepare()
+
+    def set_epoch(self, epoch):  # Lightning이 매 epoch 호출, epoch 시작 전에 batch 수를 알 수 있도록 여기서 batch 목록을 만듦
+        self.epoch = epoch
+        self.prepare()
+
+    def skip(self, num_batches):  # 재개 시 이번 epoch에서 이미 학습한 batch 수만큼 건너뜀
+        self.start = num_batches
+
+    def full_epoch(self):
+        after_warmup = self.epoch - self.warmup_epochs
+        return after_warmup < 0 or (self.readmit_every > 0 and after_warmup % self.readmit_every == self.readmit_every - 1)
+
+    def plan(self, generator):
+        # 이번 epoch에 뽑을 예시 index와 예시별 importance weight
+        keep = torch.ones(self.num_samples, dtype=torch.bool)
+        weights = torch.ones(self.num_samples)
+        seen = ~torch.isnan(self.ema)
+        if not self.full_epoch() and seen.any():
+            easy = seen & (self.ema <= torch.quantile(self.ema[seen], self.prune_ratio))
+            keep[easy] = torch.rand(int(easy.sum()), generator=generator) < self.keep_prob
+            weights[easy] = 1 / self.keep_prob
+        return keep.nonzero().reshape(-1), weights
+
+    def record(self, indices, losses):
+        self.loss_sum.index_add_(0, indices, losses)
+        self.loss_count.index_add_(0, indices, torch.ones_like(losses))
+
+    def update(self, loss_sum, loss_count):
+        # epoch 끝에 (rank 합산된) 예시별 loss 평균으로 EMA 갱신, 처음 본 예시는 그 값으로 시작
+        seen = loss_count > 0
+        mean = loss_sum[seen] / loss_count[seen]
+        previous = self.ema[seen]
+        self.ema[seen] = torch.where(torch.isnan(previous), mean, self.momentum * previous + (1 - self.momentum) * mean)
+        self.loss_sum.zero_()
+        self.loss_count.zero_()
+
+    def kept_ratio(self):
+        return sum(len(batch) for batch in self.batches) * self.num_replicas / self.num_samples
+
+    def prepare(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices, self.weights = self.plan(generator)
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices), generator=generator)]
+        indices = indices.tolist()
+        batches = [indices[i : i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        num_batches = len(batches) // self.num_replicas
+        self.batches = batches[self.rank : num_batches * self.num_replicas : self.num_replicas]
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        return iter(self.batches[start:])
+
+    def __len__(self):  # 이번 epoch 기준 (뽑는 예시 수가 epoch마다 달라짐)
+        return len(self.batches)
+
+
+def pad_collate(batch, pad_token_id):
+    # batch 안에서 가장 긴 샘플 길이에 맞춰 padding
+    if isinstance(batch[0], tuple):
+        inputs, targets = zip(*batch)
+        return torch.nn.utils.rnn.pad_sequence(inputs, batch_first=True, padding_value=pad_token_id), torch.stack(targets)
+    return torch.nn.utils.rnn.pad_sequence(batch, batch_first=True, padding_value=pad_token_id)
+
+
+def pack_collate(batch, pad_token_id, max_length):
+    """
+    batch의 문장 쌍들을 max_length 길이의 행에 이어붙임 (긴 쌍부터 first-fit)
+
+    돌려주는 입력은 dict
+        input_ids: [행 수, max_length]
+        segment_ids: 같은 쌍의 토큰끼리만 같은 값 (1부터, pad는 0), 모델이 block-diagonal attention mask를 만드는 데 사용
+        position_ids: 쌍마다 0부터 다시 시작하는 위치
+        cls_index: [2, batch 크기], batch 순서대로 각 쌍의 CLS 토큰 (행, 열) 위치
+    """
+    if isinstance(batch[0], tuple):
+        inputs, targets = zip(*batch)
+    else:
+        inputs, targets = batch, None
+
+    free = []  # 행마다 남은 길이
+    placement = [None] * len(inputs)
+    for i in sorted(range(len(inputs)), key=lambda i: -len(inputs[i])):
+        length = len(inputs[i])
+        row = next((r for r, space in enumerate(free) if space >= length), None)
+        if row is None:
+            row = len(free)
+            free.append(max_length)
+        placement[i] = (row, max_length - free[row])
+        free[row] -= length
+
+    input_ids = torch.full((len(free), max_length), pad_token_id, dtype=torch.long)
+    segment_ids = torch.zeros((len(free), max_length), dtype=torch.long)
+    position_ids = torch.zeros((len(free), max_length), dtype=torch.long)
+    for i, (ids, (row, start)) in enumerate(zip(inputs, placement)):
+        end = start + len(ids)
+        input_ids[row, start:end] = ids
+        segment_ids[row, start:end] = i + 1
+        position_ids[row, start:end] = torch.arange(len(ids))
+    packed = {
+        "input_ids": input_ids,
+        "segment_ids": segment_ids,
+        "position_ids": position_ids,
+        "cls_index": torch.tensor(placement, dtype=torch.long).t(),
+    }
+    return packed if targets is None else (packed, torch.stack(targets))
+
+
+class TokenizeCollate:
+    """
+    문장 쌍 문자열 batch를 fast tokenizer 한 번 호출로 토크나이징하는 collate (data.lazy_tokenization, DataLoader worker에서 실행)
+
+    padding="max_length"면 setup에서 미리 토크나이징한 것과 같은 입력, "longest"면 pad_collate처럼 batch 안 최대 길이에 맞춤
+    packing이면 padding 없이 토크나이징한 뒤 pack_collate로 이어붙임
+    """
+
+    def __init__(self, tokenizer, padding, packing=False):
+        self.tokenizer = tokenizer
+        self.padding = padding
+        self.packing = packing
+
+    def __call__(self, batch):
+        if isinstance(batch[0], tuple):
+            texts, targets = zip(*batch)
+            targets = torch.stack(targets)
+        else:
+            texts, targets = batch, None
+
+        if self.packing:
+            inputs = [torch.tensor(ids) for ids in self.tokenizer(list(texts), add_special_tokens=True, truncation=True)["input_ids"]]
+            return pack_collate(inputs if targets is None else list(zip(inputs, targets)), self.tokenizer.pad_token_id, self.tokenizer.model_max_length)
+        inputs = self.tokenizer(list(texts), add_special_tokens=True, padding=self.padding, truncation=True, return_tensors="pt")["input_ids"]
+        return inputs if targets is None else (inputs, targets)
+
+
+def distributed():
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def build_dataloader(
+    dataset,
+    batch_size,
+    shuffle,
+    pad_token_id=None,
+    bucket_boundaries=None,
+    bucket=True,
+    packing=False,
+    max_length=128,
+    max_tokens=None,
+    num_workers=0,
+    tokenizer=None,
+    pruning=None,
+):
+    # 분산 학습이면 rank별로 데이터를 나누는 sampler 사용 (bucket=False인 predict는 rank마다 전체를 순서대로 예측)
+    shard = distributed() and bucket
+    num_replicas = torch.distributed.get_world_size() if shard else 1
+    rank = torch.distributed.get_rank() if shard else 0
+
+    seed = torch.initial_seed() % 2**31  # main.py에서 고정한 seed
+
+    if isinstance(dataset, torch.utils.data.IterableDataset):  # shard 스트리밍: 순서와 rank 분할은 dataset이 직접 처리
+        if packing:
+            collate_fn = functools.partial(pack_collate, pad_token_id=pad_token_id, max_length=max_length)
+        elif bucket_boundaries is not None:
+            collate_fn = functools.partial(pad_collate, pad_token_id=pad_token_id)
+        else:
+            collate_fn = None
+        if hasattr(dataset, "set_batching"):
+            dataset.set_batching(batch_size, num_workers)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn)
+
+    if pruning is not None:  # 학습 dataloader만, 쉬운 예시를 덜 뽑는 batch sampler (bucket 대신 batch 안 최대 길이로 padding)
+        if isinstance(dataset, PairTextDataset):
+            collate_fn = TokenizeCollate(tokenizer, "longest" if bucket_boundaries is not None else "max_length", packing)
+        elif packing:
+            collate_fn = functools.partial(pack_collate, pad_token_id=pad_token_id, max_length=max_length)
+        elif bucket_boundaries is not None:
+            collate_fn = functools.partial(pad_collate, pad_token_id=pad_token_id)
+        else:
+            collate_fn = None
+        sampler = LossPruningBatchSampler(len(dataset), batch_size, shuffle, seed, num_replicas, rank, **pruning)
+        return torch.utils.data.DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_fn, num_workers=num_workers, persistent_workers=num_workers > 0)
+
+    if isinstance(dataset, PairTextDataset):
+        # worker에서 batch마다 토크나이징, 길이를 미리 모르므로 bucket 대신 batch 안 최대 길이로 padding (max_tokens 미사용)
+        padding = "longest" if bucket_boundaries is not None else "max_length"
+        collate_fn = TokenizeCollate(tokenizer, padding, packing)
+        sampler = ResumableSampler(len(dataset), shuffle, seed, num_replicas, rank)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn, num_workers=num_workers, persistent_workers=num_workers > 0)
+
+    if packing:  # batch_size개의 쌍을 max_length 행들에 나눠 담음 (bucket_boundaries는 사용하지 않음)
+        collate_fn = functools.partial(pack_collate, pad_token_id=pad_token_id, max_length=max_length)
+        sampler = ResumableSampler(len(dataset), shuffle, seed, num_replicas, rank)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn)
+
+    if bucket_boundaries is None:  # 기존 방식: max_length까지 padding된 입력
+        sampler = ResumableSampler(len(dataset), shuffle, seed, num_replicas, rank)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler)
+
+    collate_fn = functools.partial(pad_collate, pad_token_id=pad_token_id)
+    if not bucket:
+        sampler = ResumableSampler(len(dataset), shuffle, seed)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn)
+    sampler = BucketBatchSampler([len(x) for x in dataset.inputs], bucket_boundaries, batch_size, shuffle, seed, num_replicas, rank, max_tokens)
+    return torch.utils.data.DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_fn)
+
 
 def text_preprocessing(sentence):
-    s = re.sub(r"!!+", "!!!", sentence)  # !한개 이상 -> !!! 고정
-    s = re.sub(r"\?\?+", "???", s)  # ?한개 이상 -> ??? 고정
-    s = re.sub(r"\.\.+", "...", s)  # .두개 이상 -> ... 고정
-    s = re.sub(r"\~+", "~", s)  # ~한개 이상 -> ~ 고정
-    s = re.sub(r"\;+", ";", s)  # ;한개 이상 -> ; 고정
-    s = re.sub(r"ㅎㅎ+", "ㅎㅎㅎ", s)  # ㅎ두개 이상 -> ㅎㅎㅎ 고정
-    s = re.sub(r"ㅋㅋ+", "ㅋㅋㅋ", s)  # ㅋ두개 이상 -> ㅋㅋㅋ 고정
-    s = re.sub(r"ㄷㄷ+", "ㄷㄷㄷ", s)  # ㄷ두개 이상 -> ㄷㄷㄷ 고정
-    return s
+    global _default_preprocessor
+    if _default_preprocessor is None:
+        _default_preprocessor = TextPreprocessor.from_yaml()
+    return _default_preprocessor(sentence)
+
+
+_default_preprocessor = None
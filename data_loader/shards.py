@@ -0,0 +1,145 @@
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+import pytorch_lightning as pl
+import torch
+
+from data_loader.data_loaders import distributed, tokenize_pairs
+
+INDEX_FILE = "index.json"
+
+
+def write_shards(dataloader, csv_path, shard_dir, rows_per_shard=100000):
+    """
+    csv를 rows_per_shard행씩 읽어 토크나이징한 뒤 shard마다 NumPy 파일 3개로 저장 (전체 csv를 메모리에 올리지 않음)
+
+    <번호>.tokens.npy: 모든 쌍의 input_ids를 이어붙인 int32 배열
+    <번호>.offsets.npy: 쌍 i의 토큰은 tokens[offsets[i]:offsets[i + 1]]
+    <번호>.labels.npy: float32 label
+    swap이면 각 shard 안에 역방향 쌍도 함께 저장
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    for i, chunk in enumerate(pd.read_csv(csv_path, chunksize=rows_per_shard)):
+        input_ids = tokenize_pairs(dataloader.tokenizer, chunk, dataloader.text_columns, dataloader.swap, dataloader.preprocessor, dataloader.padding())
+        labels = chunk[dataloader.target_columns[0]].to_numpy(dtype=np.float32)
+        if dataloader.swap:
+            labels = np.concatenate([labels, labels])
+
+        name = f"{i:05d}"
+        offsets = np.zeros(len(input_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(ids) for ids in input_ids])
+        np.save(os.path.join(shard_dir, f"{name}.tokens.npy"), np.fromiter((t for ids in input_ids for t in ids), dtype=np.int32, count=offsets[-1]))
+        np.save(os.path.join(shard_dir, f"{name}.offsets.npy"), offsets)
+        np.save(os.path.join(shard_dir, f"{name}.labels.npy"), labels)
+        shards.append({"name": name, "rows": len(input_ids)})
+        print(f"shard {name}: {len(input_ids)}쌍")
+
+    index = {"shards": shards, "model_name": dataloader.model_name, "max_length": dataloader.tokenizer.model_max_length, "padding": dataloader.padding()}
+    with open(os.path.join(shard_dir, INDEX_FILE), "w") as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+class ShardedIterableDataset(torch.utils.data.IterableDataset):
+    """
+    write_shards로 만든 shard를 mmap으로 읽으며 (input_ids, [label])를 하나씩 내보냄
+
+    shard는 rank마다 고정으로 나눠 갖고 (shards[rank::world_size]), rank 안에서는 DataLoader worker들이
+    같은 순서의 행 스트림을 worker 수 간격으로 나눠 가짐 (같은 노드라 페이지 캐시를 공유)
+    순서: epoch와 seed로 정한 shard 순서 -> shard 안 행 순서 -> 크기 buffer_size인 shuffle buffer
+    모든 rank가 같은 수의 batch를 돌도록 rank마다 행 수를 가장 적은 rank에 맞춤 (나머지는 그 epoch에서 제외)
+    메모리는 shard 하나의 행 순서 배열과 shuffle buffer 크기만큼만 사용
+    expected({model_name, max_length, padding})가 주어지면 shard를 만들 때의 설정과 다를 때 불러오지 않음
+    len은 DataLoader가 batch 수를 맞게 세도록 set_batching 이후 worker별 batch 수 합 x batch_size (행 수는 num_rows)
+    """
+
+    def __init__(self, shard_dir, shuffle=True, buffer_size=10000, seed=0, expected=None):
+        self.shard_dir = shard_dir
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+        with open(os.path.join(shard_dir, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.shards = index["shards"]
+        # 다른 tokenizer의 id나 다른 padding 방식(가변 길이 shard를 고정 길이 collate로)으로 학습하지 않도록 확인
+        mismatched = {key: (index.get(key), value) for key, value in (expected or {}).items() if index.get(key) != value}
+        if mismatched:
+            details = ", ".join(f"{key}: shard {saved!r} / 현재 {current!r}" for key, (saved, current) in mismatched.items())
+            raise ValueError(f"{shard_dir}의 shard 설정이 현재 data 설정과 다릅니다 ({details}), python main.py -m sh 로 다시 만들어주세요")
+
+        self.num_replicas = torch.distributed.get_world_size() if distributed() else 1
+        self.rank = torch.distributed.get_rank() if distributed() else 0
+        self.rank_shards = self.shards[self.rank :: self.num_replicas]
+        self.num_rows = min(sum(s["rows"] for s in self.shards[r :: self.num_replicas]) for r in range(self.num_replicas))
+        self.batch_size = None
+        self.num_workers = 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_batching(self, batch_size, num_workers):
+        # DataLoader는 len(dataset) / batch_size로 epoch당 batch 수를 정함 (Lightning은 그 수에서 epoch를 끝냄)
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+
+    def __len__(self):
+        if self.batch_size is None:
+            return self.num_rows
+        # worker마다 자기 몫(num_workers 간격)의 행을 따로 batch로 묶어서 마지막 batch가 worker마다 하나씩 덜 참
+        worker_rows = [(self.num_rows - w + self.num_workers - 1) // self.num_workers for w in range(self.num_workers)]
+        return sum(math.ceil(rows / self.batch_size) for rows in worker_rows) * self.batch_size
+
+    def _load(self, shard):
+        path = os.path.join(self.shard_dir, shard["name"])
+        return (np.load(f"{path}.{kind}.npy", mmap_mode="r") for kind in ("tokens", "offsets", "labels"))
+
+    def _rank_stream(self, generator, worker_id, num_workers):
+        # rank에 배정된 shard들의 행을 정해진 순서로 num_rows개까지 늘어놓고, 그중 이 worker 몫(worker 수 간격)만 읽음
+        shard_order = torch.randperm(len(self.rank_shards), generator=generator).tolist() if self.shuffle else range(len(self.rank_shards))
+        position = 0
+        for s in shard_order:
+            tokens, offsets, labels = self._load(self.rank_shards[s])
+            rows = torch.randperm(len(labels), generator=generator).tolist() if self.shuffle else range(len(labels))
+            for row in rows:
+                if position == self.num_rows:
+                    return
+                if position % num_workers == worker_id:
+                    yield torch.from_numpy(np.array(tokens[offsets[row] : offsets[row + 1]], dtype=np.int64)), torch.tensor([float(labels[row])])
+                position += 1
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)  # 모든 worker가 같은 순서를 만들고 자기 몫만 가져감
+        stream = self._rank_stream(generator, worker_id, num_workers)
+        if not self.shuffle:
+            yield from stream
+            return
+
+        buffer_generator = torch.Generator()
+        buffer_generator.manual_seed(self.seed + self.epoch + 1 + worker_id)
+        buffer = []
+        for item in stream:
+            if len(buffer) < self.buffer_size:
+                buffer.append(item)
+                continue
+            i = int(torch.randint(len(buffer), (1,), generator=buffer_generator))
+            yield buffer[i]
+            buffer[i] = item
+        order = torch.randperm(len(buffer), generator=buffer_generator).tolist()
+        yield from (buffer[i] for i in order)
+
+
+class ShardEpoch(pl.Callback):
+    # IterableDataset은 Lightning이 sampler.set_epoch을 불러줄 수 없어서 epoch 시작마다 직접 전달 (worker iterator 생성 전)
+    def on_train_epoch_start(self, trainer, pl_module):
+        dataset = getattr(trainer.datamodule, "train_dataset", None)
+        if isinstance(dataset, ShardedIterableDataset):
+            dataset.set_epoch(trainer.current_epoch)
@@ -0,0 +1,77 @@
+import copy
+import time
+
+import pandas as pd
+import pytorch_lightning as pl
+
+import create_instance
+import utils.utils as utils
+
+
+class EpochReport(pl.Callback):
+    """epoch마다 학습 시간(검증 제외), 학습한 예시 수, 그 epoch 끝 검증의 val_pearson을 기록"""
+
+    def __init__(self):
+        self.rows = []
+        self.start = None
+        self.train_s = None
+        self.examples = 0
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.start = time.perf_counter()
+        self.train_s = None
+        self.examples = 0
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.examples += len(batch[1]) * trainer.world_size
+
+    def on_validation_start(self, trainer, pl_module):
+        if not trainer.sanity_checking and self.start is not None:
+            self.train_s = time.perf_counter() - self.start
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        train_s = self.train_s if self.train_s is not None else time.perf_counter() - self.start
+        val_pearson = trainer.callback_metrics.get("val_pearson")
+        self.rows.append(
+            {"epoch": trainer.current_epoch, "train_s": train_s, "examples": self.examples, "val_pearson": None if val_pearson is None else float(val_pearson)}
+        )
+
+
+def data_pruning(args, conf):
+    """
+    같은 config와 seed로 전체 데이터 학습과 data pruning 학습(pruning 섹션)을 차례로 해서 비교
+
+    epoch별 학습 시간, 학습한 예시 수, val_pearson은 data_pruning_epochs.csv로,
+    run별 전체 학습 시간, 마지막 val_pearson, dev(test_path) pearson, 전체 데이터 대비 시간 비율은 data_pruning_report.csv로 저장
+    """
+    rows, epochs = [], []
+    for name, use_pruning in [("full", False), ("pruned", True)]:
+        run_conf = copy.deepcopy(conf)
+        run_conf.pruning.use_pruning = use_pruning
+        pl.seed_everything(conf.utils.seed)
+        dataloader, model = create_instance.new_instance(run_conf)
+        report = EpochReport()
+        trainer = utils.build_trainer(run_conf, logger=False, callbacks=[report], enable_checkpointing=False)
+        trainer.fit(model=model, datamodule=dataloader)
+        test_pearson = trainer.test(model=model, datamodule=dataloader)[0]["test_pearson"]
+
+        epochs += [{"run": name, **row} for row in report.rows]
+        rows.append(
+            {
+                "run": name,
+                "epochs": len(report.rows),
+                "train_s": sum(row["train_s"] for row in report.rows),
+                "examples": sum(row["examples"] for row in report.rows),
+                "val_pearson": report.rows[-1]["val_pearson"] if report.rows else None,
+                "test_pearson": test_pearson,
+            }
+        )
+        print(rows[-1])
+
+    summary = pd.DataFrame(rows)
+    summary["time_ratio"] = summary["train_s"] / summary["train_s"].iloc[0]
+    summary["example_ratio"] = summary["examples"] / summary["examples"].iloc[0]
+    print(pd.DataFrame(epochs).to_string(index=False))
+    print(summary.to_string(index=False))
+    pd.DataFrame(epochs).to_csv("data_pruning_epochs.csv", index=False)
+    summary.to_csv("data_pruning_report.csv", index=False)
@@ -0,0 +1,49 @@
+import time
+
+import pandas as pd
+import torch
+
+import create_instance
+from model.metric import StreamingPearson
+
+
+def early_exit_report(args, conf):
+    # threshold별 평균 실행 레이어 수, latency, dev pearson 비교 (None = 모든 레이어 실행)
+    dataloader, model = create_instance.new_instance(conf)
+    model, _, __ = create_instance.load_model(args, conf, dataloader, model)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model.to(device)
+    model.eval()
+    dataloader.setup("test")
+
+    rows = []
+    for threshold in [None] + list(conf.early_exit.thresholds):
+        model.exit_threshold = threshold
+        pearson = StreamingPearson().to(device)
+        layers = []
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            for x, y in dataloader.test_dataloader():
+                x, y = x.to(device), y.to(device)
+                pearson.update(model(x), y)
+                layers.append(model.last_exit_layers.float())
+        if device == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+
+        layers = torch.cat(layers)
+        rows.append(
+            {
+                "threshold": "full" if threshold is None else threshold,
+                "avg_layers": float(layers.mean()),
+                "latency_ms_per_pair": elapsed / len(layers) * 1000,
+                "dev_pearson": float(pearson.compute()),
+            }
+        )
+    model.exit_threshold = None
+
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    report.to_csv(conf.path.save_path + "early_exit_report.csv", index=False)
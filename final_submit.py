@@ -1,19 +1,21 @@
+import argparse
+import json
 import os
 import random
-import re
+import shutil
 
 import numpy as np
 import pandas as pd
 import pytorch_lightning as pl
 import torch
 from omegaconf import OmegaConf
-from pytorch_lightning.loggers import WandbLogger
 
 import create_instance
 import model.model as module_arch
+import utils.checkpoint as checkpoint
 import utils.utils as utils
-import wandb
 from data_loader.data_loaders import Dataloader, KfoldDataloader
+from utils.pipeline import Pipeline, Stage
 
 # fix random seeds for reproducibility
 
@@ -85,7 +87,7 @@ def new_instance_FUNNEL(conf):  # sweep 부분 때문에 두번째 인자 추가
     return dataloader, model
 
 
-def full_model_step(conf, model_name, idx):
+def seed_everything(conf):
     SEED = conf.utils.seed
     random.seed(SEED)
     np.random.seed(SEED)
@@ -94,207 +96,194 @@ def full_model_step(conf, model_name, idx):
     torch.backends.cudnn.benchmark = False
     torch.use_deterministic_algorithms(True)
 
-    if idx == 0:
-        dataloader, model = new_instance_FUNNEL(conf)
-    elif idx == 1:
-        dataloader, model = new_instance_KLUE(conf)
-    elif idx == 2:
-        dataloader, model = new_instance_XLM(conf)
+
+def new_member_instance(conf, model_name):
+    if model_name == "funnel":
+        return new_instance_FUNNEL(conf)
+    elif model_name == "klue":
+        return new_instance_KLUE(conf)
     else:
-        dataloader, model = new_instance_XLM(conf)
-    project_name = conf.wandb.project
-
-    wandb_logger = WandbLogger(project=project_name)
-    trainer = pl.Trainer(
-        accelerator="gpu",
-        devices=1,
-        max_epochs=conf.train.max_epoch,
-        log_every_n_steps=1,
-        logger=wandb_logger,
-    )
-    trainer.fit(model=model, datamodule=dataloader)
-    trainer.test(model=model, datamodule=dataloader)
+        return new_instance_XLM(conf)
 
-    filename = re.sub("/", "_", conf.model.model_name)
-    # trainer.save_checkpoint("./result/" + f"{model_name}.ckpt")
-    predictions = trainer.predict(
-        model=model,
-        datamodule=dataloader,
-    )
+
+def save_predictions(predictions, path):
     predictions = list(float(i) for i in torch.cat(predictions))  # 리스트화
 
     output = pd.read_csv("../data/sample_submission.csv")
     output["target"] = predictions
-    output.to_csv(f"./result/output_{model_name}.csv", index=False)
-    wandb.finish()
-
-
-def K_model_step_train(conf):
-    project_name = conf.wandb.project
-
-    results = []
-    num_folds = conf.k_fold.num_folds
-
-    for k in range(num_folds):
-        k_datamodule = KfoldDataloader(
-            conf.model.model_name,
-            conf.train.batch_size,
-            conf.data.shuffle,
-            k,
-            conf.k_fold.num_split,
-            conf.path.train_path,
-            conf.path.test_path,
-            conf.path.predict_path,
-            conf.data.swap,
-        )
-
-        Kmodel = module_arch.Model(
-            conf.model.model_name,
-            conf.train.learning_rate,
-            conf.train.loss,
-            k_datamodule.new_vocab_size(),
-            conf.train.use_frozen,
-        )
-
-        name_ = f"{k+1}th_fold"
-        wandb_logger = WandbLogger(project=project_name, name=name_)
-        save_path = f"{conf.path.save_path}{conf.model.model_name}_{conf.train.max_epoch}_{conf.train.batch_size}/"  # 모델 저장 디렉터리명에 wandb run name 추가
-        trainer = pl.Trainer(
-            accelerator="gpu",
-            devices=1,
-            max_epochs=conf.train.max_epoch,
-            log_every_n_steps=1,
-            logger=wandb_logger,
-            callbacks=[
-                utils.early_stop(
-                    monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
-                    patience=conf.utils.patience,
-                    mode=utils.monitor_config[conf.utils.monitor]["mode"],
-                ),
-                utils.best_save(
-                    save_path=save_path,
-                    top_k=conf.utils.top_k,
-                    monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
-                    mode=utils.monitor_config[conf.utils.monitor]["mode"],
-                    filename=f"{k+1}_best_pearson_model",
-                ),
-            ],
-        )
-
-        trainer.fit(model=Kmodel, datamodule=k_datamodule)
-        score = trainer.test(model=Kmodel, datamodule=k_datamodule)
-        wandb.finish()
-
-        results.extend(score)
-        save_model = f"./result/kfold/{k}-fold"
-        trainer.save_checkpoint(save_model + ".ckpt")
-
-    result = [x["test_pearson"] for x in results]
-    score = sum(result) / num_folds
-    print(score)
-
-
-def K_model_step_inference(conf):
-    num_folds = conf.k_fold.num_folds
-    for k in range(num_folds):
-
-        trainer = pl.Trainer(gpus=1, max_epochs=conf.train.max_epoch, log_every_n_steps=1)
-
-        dataloader = Dataloader(
-            conf.model.model_name,
-            conf.train.batch_size,
-            conf.data.train_ratio,
-            conf.data.shuffle,
-            conf.path.train_path,
-            conf.path.test_path,
-            conf.path.predict_path,
-            conf.data.swap,
-        )
-        model = module_arch.Model(
-            conf.model.model_name,
-            conf.train.learning_rate,
-            conf.train.loss,
-            dataloader.new_vocab_size(),
-            conf.train.use_frozen,
-        )  # 새롭게 추가한 토큰 사이즈 반영
-        model = model.load_from_checkpoint(f"./result/kfold/{k}-fold.ckpt")
-        model.eval()
-
-        predictions = trainer.predict(
-            model=model,
-            datamodule=dataloader,
-        )
-
-        predictions = list(float(i) for i in torch.cat(predictions))  # 리스트화
-
-        output = pd.read_csv("../data/sample_submission.csv")
-        output["target"] = predictions
-        output.to_csv(f"./result/kfold/{k}-fold.csv", index=False)
+    output.to_csv(path, index=False)
 
 
-if __name__ == "__main__":
-    if not os.path.exists("./result"):
-        os.mkdir("./result")
-    if not os.path.exists("./result/kfold"):
-        os.mkdir("./result/kfold")
-
-    # print("꼭 K-Fold 확인할 것(yaml)")
-    config_name_list = ["funnel", "klue", "xlm", "xlm_5fold"]
-    for idx, model_name in enumerate(config_name_list[0:3]):
-        conf = OmegaConf.load(f"./config/{model_name}_ensemble.yaml")
-        full_model_step(conf, model_name, idx)
+def train_member(conf, out_dir, inputs, model_name):
+    seed_everything(conf)
+    dataloader, model = new_member_instance(conf, model_name)
 
-    # k-fold 결과 내기
-    conf = OmegaConf.load(f"./config/{config_name_list[3]}_ensemble.yaml")
-    K_model_step_train(conf)  # 각 폴드 모델 만들기
-    K_model_step_inference(conf)  # 각 csv 만들기
-    # csv 합치기
-    k_fold_value_list = []
-    for k in range(conf.k_fold.num_folds):
-        if k == 3:
-            continue
-        path = f"result/kfold/{k}-fold.csv"
-        output = pd.read_csv(path)
-        k_fold_value_list.append(output["target"])
-
-    ## 최종 k_fold 결과 내기
-
-    k_fold_mean_values = []
-    for i in range(len(k_fold_value_list[0])):
-        mean = 0
-        for j in range(len(k_fold_value_list)):
-            # print(value_list[j][i], end="    ")
-            mean += k_fold_value_list[j][i]
-        mean /= len(k_fold_value_list)
-        # print(mean)
-        k_fold_mean_values.append(mean)
+    logger = utils.build_logger(conf)
+    trainer = utils.build_trainer(conf, logger=logger)
+    trainer.fit(model=model, datamodule=dataloader)
+    trainer.test(model=model, datamodule=dataloader)
+    trainer.save_checkpoint(os.path.join(out_dir, "model.ckpt"))
+    utils.finish_logger(logger, os.path.join(out_dir, "model.ckpt"))
 
-    output = pd.read_csv("../data/sample_submission.csv")
-    output["target"] = k_fold_mean_values
-    output.to_csv("./result/output_xlm_5fold.csv", index=False)
 
-    value_list = []
-    for model_name in config_name_list:
-        path = f"result/output_{model_name}.csv"
+def predict_member(conf, out_dir, inputs, model_name):
+    dataloader, model = new_member_instance(conf, model_name)
+    model = model.load_from_checkpoint(os.path.join(inputs[f"train_{model_name}"], "model.ckpt"))
+    model.eval()
 
-        output = pd.read_csv(path)
-        print(output.head()["target"])
-        value_list.append(output["target"])
+    trainer = utils.build_trainer(conf, devices=1, strategy=None)  # 예측 순서를 유지하도록 단일 device
+    predictions = trainer.predict(model=model, datamodule=dataloader)
+    save_predictions(predictions, os.path.join(out_dir, "output.csv"))
+
+
+def train_fold(conf, out_dir, inputs, k):
+    seed_everything(conf)
+    k_datamodule = KfoldDataloader(
+        conf.model.model_name,
+        conf.train.batch_size,
+        conf.data.shuffle,
+        k,
+        conf.k_fold.num_split,
+        conf.path.train_path,
+        conf.path.test_path,
+        conf.path.predict_path,
+        conf.data.swap,
+        sub_val_size=create_instance.sub_val_size(conf),
+        pruning=create_instance.pruning_config(conf),
+    )
+
+    Kmodel = module_arch.Model(
+        conf.model.model_name,
+        conf.train.learning_rate,
+        conf.train.loss,
+        k_datamodule.new_vocab_size(),
+        conf.train.use_frozen,
+    )
 
-    # print(len(value_list))
-    # print(len(value_list[0]))
+    logger = utils.build_logger(conf, name=f"{k+1}th_fold")
+    trainer = utils.build_trainer(
+        conf,
+        logger=logger,
+        callbacks=[
+            utils.early_stop(
+                monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
+                patience=conf.utils.patience,
+                mode=utils.monitor_config[conf.utils.monitor]["mode"],
+            ),
+            utils.best_save(
+                save_path=out_dir,
+                top_k=conf.utils.top_k,
+                monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
+                mode=utils.monitor_config[conf.utils.monitor]["mode"],
+                filename=f"{k+1}_best_pearson_model",
+                async_save=OmegaConf.select(conf, "utils.async_save", default=False),
+                every_n_train_steps=OmegaConf.select(conf, "sub_validation.every_n_steps", default=None),
+            ),
+        ],
+    )
 
-    mean_values = []
-    for i in range(len(value_list[0])):
-        mean = 0
-        for j in range(len(value_list)):
-            # print(value_list[j][i], end="    ")
-            mean += value_list[j][i]
-        mean /= len(value_list)
-        # print(mean)
-        mean_values.append(mean)
-    # print(mean_values[0:10])
+    trainer.fit(model=Kmodel, datamodule=k_datamodule)
+    score = trainer.test(model=Kmodel, datamodule=k_datamodule)
+    checkpoint.save_final(trainer, os.path.join(out_dir, f"{k}-fold.ckpt"))
+    utils.finish_logger(logger, os.path.join(out_dir, f"{k}-fold.ckpt"))
+    checkpoint.wait_all(trainer)
+    with open(os.path.join(out_dir, "score.json"), "w") as f:
+        json.dump(score, f)
+
+
+def predict_fold(conf, out_dir, inputs, k):
+    dataloader = Dataloader(
+        conf.model.model_name,
+        conf.train.batch_size,
+        conf.data.train_ratio,
+        conf.data.shuffle,
+        conf.path.train_path,
+        conf.path.test_path,
+        conf.path.predict_path,
+        conf.data.swap,
+    )
+    model = module_arch.Model(
+        conf.model.model_name,
+        conf.train.learning_rate,
+        conf.train.loss,
+        dataloader.new_vocab_size(),
+        conf.train.use_frozen,
+    )  # 새롭게 추가한 토큰 사이즈 반영
+    model = model.load_from_checkpoint(os.path.join(inputs[f"train_fold_{k}"], f"{k}-fold.ckpt"))
+    model.eval()
+
+    trainer = utils.build_trainer(conf, devices=1, strategy=None)  # 예측 순서를 유지하도록 단일 device
+    predictions = trainer.predict(model=model, datamodule=dataloader)
+    save_predictions(predictions, os.path.join(out_dir, "output.csv"))
+
+
+def blend(conf, out_dir, inputs):
+    # 각 입력 stage의 output.csv를 soft voting (평균)
+    value_list = []
+    for name in sorted(inputs):
+        output = pd.read_csv(os.path.join(inputs[name], "output.csv"))
+        print(name, output.head()["target"].tolist())
+        value_list.append(output["target"])
 
     output = pd.read_csv("../data/sample_submission.csv")
-    output["target"] = mean_values
-    output.to_csv("final_submit.csv", index=False)
+    output["target"] = sum(value_list) / len(value_list)
+    output.to_csv(os.path.join(out_dir, "output.csv"), index=False)
+
+
+# 소스가 바뀌면 해당 stage를 다시 돌리도록 캐시 키에 포함되는 코드 파일들
+CODE_FILES = [
+    "final_submit.py",
+    "model/model.py",
+    "model/loss.py",
+    "data_loader/data_loaders.py",
+    "utils/utils.py",
+]
+EXCLUDE_FOLDS = [3]  # 4번째 fold는 성능이 낮아 최종 앙상블에서 제외
+
+
+def data_files(conf):
+    return [conf.path.train_path, conf.path.test_path, conf.path.predict_path, "../data/sample_submission.csv"]
+
+
+def build_pipeline(cache_dir):
+    pipeline = Pipeline(cache_dir)
+
+    member_outputs = []
+    for model_name in ["funnel", "klue", "xlm"]:
+        conf = OmegaConf.load(f"./config/{model_name}_ensemble.yaml")
+        pipeline.add(Stage(f"train_{model_name}", train_member, conf, data=data_files(conf), code=CODE_FILES, kwargs={"model_name": model_name}))
+        pipeline.add(Stage(f"predict_{model_name}", predict_member, conf, deps=[f"train_{model_name}"], data=data_files(conf), code=CODE_FILES, kwargs={"model_name": model_name}))
+        member_outputs.append(f"predict_{model_name}")
+
+    # k-fold 결과 내기
+    conf = OmegaConf.load("./config/xlm_5fold_ensemble.yaml")
+    fold_outputs = []
+    for k in range(conf.k_fold.num_folds):
+        pipeline.add(Stage(f"train_fold_{k}", train_fold, conf, data=data_files(conf), code=CODE_FILES, kwargs={"k": k}))
+        pipeline.add(Stage(f"predict_fold_{k}", predict_fold, conf, deps=[f"train_fold_{k}"], data=data_files(conf), code=CODE_FILES, kwargs={"k": k}))
+        if k not in EXCLUDE_FOLDS:
+            fold_outputs.append(f"predict_fold_{k}")
+    pipeline.add(Stage("blend_xlm_5fold", blend, deps=fold_outputs, code=CODE_FILES))
+    member_outputs.append("blend_xlm_5fold")
+
+    # 최종 soft voting
+    pipeline.add(Stage("blend", blend, deps=member_outputs, code=CODE_FILES))
+    return pipeline
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="동시에 실행할 stage 수 (GPU 1장이면 1)")
+    parser.add_argument("--cache_dir", default="./result/cache")
+    parser.add_argument("--targets", nargs="*", default=None, help="일부 stage만 실행, 예시: predict_klue")
+    parser.add_argument("--dry_run", action="store_true", help="실행하지 않고 stage별 캐시 상태만 출력")
+    args = parser.parse_args()
+
+    pipeline = build_pipeline(args.cache_dir)
+    if args.dry_run:
+        for name, out_dir in pipeline.plan().items():
+            print(f"{'cached ' if pipeline.is_done(out_dir) else 'pending'}  {name}  {out_dir}")
+    else:
+        out_dirs = pipeline.run(jobs=args.jobs, targets=args.targets)
+        if args.targets is None or "blend" in args.targets:
+            shutil.copy(os.path.join(out_dirs["blend"], "output.csv"), "final_submit.csv")
@@ -0,0 +1,191 @@
+import datetime
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+import torch
+from omegaconf import OmegaConf
+
+import create_instance
+import utils.checkpoint as checkpoint
+import utils.utils as utils
+from data_loader.data_loaders import Dataset, tokenize_pairs
+
+
+def row_hashes(dataframe, columns):
+    # 행 내용으로 만든 해시 (id나 행 순서가 바뀌어도 같은 행이면 같은 값)
+    rows = dataframe[columns].astype(str).agg("\x1f".join, axis=1)
+    return [hashlib.sha1(row.encode("utf-8")).hexdigest() for row in rows]
+
+
+def tokenizer_digest(dataloader):
+    # 토큰 캐시가 유효한 조건: 토크나이저, 추가 토큰, max_length, padding 방식, 전처리 규칙이 모두 같아야 함
+    settings = {
+        "model_name": dataloader.model_name,
+        "add_token": dataloader.add_token,
+        "max_length": dataloader.tokenizer.model_max_length,
+        "padding": dataloader.padding(),
+        "preprocessing": None if dataloader.preprocessor is None else dataloader.preprocessor.pattern.pattern,
+    }
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class TokenCache:
+    """
+    문장 쌍 해시 -> input_ids 캐시, 파일 하나(torch.save)로 저장
+    swap 방향은 "<해시>:swap" 키로 따로 저장
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = torch.load(path) if os.path.exists(path) else {}
+        self.hits = 0
+        self.misses = 0
+
+    def tokenize(self, dataloader, dataframe, swap):
+        # 캐시에 없는 쌍만 토크나이징한 뒤, 데이터셋 순서대로 input_ids를 돌려줌 (Dataloader.tokenizing과 같은 결과)
+        keys = row_hashes(dataframe, dataloader.text_columns)
+        if swap:
+            keys += [key + ":swap" for key in keys]
+
+        missing = ~pd.Series(keys[: len(dataframe)]).isin(self.ids).to_numpy()
+        if swap:
+            missing |= ~pd.Series(keys[len(dataframe) :]).isin(self.ids).to_numpy()
+        new_rows = dataframe[missing]
+        if len(new_rows):
+            new_keys = row_hashes(new_rows, dataloader.text_columns)
+            if swap:
+                new_keys += [key + ":swap" for key in new_keys]
+            new_ids = tokenize_pairs(dataloader.tokenizer, new_rows, dataloader.text_columns, swap, dataloader.preprocessor, dataloader.padding())
+            self.ids.update(zip(new_keys, new_ids))
+
+        self.misses += int(missing.sum())
+        self.hits += len(dataframe) - int(missing.sum())
+        return [self.ids[key] for key in keys]
+
+    def save(self):
+        atomic_path = self.path + ".tmp"
+        torch.save(self.ids, atomic_path)
+        os.replace(atomic_path, self.path)
+
+
+def build_dataset(cache, dataloader, dataframe, swap):
+    targets = dataframe[dataloader.target_columns].values.tolist()
+    return Dataset(cache.tokenize(dataloader, dataframe, swap), targets + targets if swap else targets)
+
+
+def dev_pearson(conf, model, loader):
+    trainer = utils.build_trainer(conf, logger=False, devices=1, strategy=None)
+    return trainer.test(model=model, dataloaders=loader, verbose=False)[0]["test_pearson"]
+
+
+def incremental_train(args, conf):
+    """
+    이전 실행 이후 train csv에 추가된 행만 골라서 -s 체크포인트에서 이어 학습
+
+    manifest에 이전 실행에서 본 행 해시를 저장해두고, 이번 train csv와 비교해 새 행을 찾음
+    manifest가 없으면(첫 실행) -s 체크포인트를 학습한 csv(incremental.seed_path)의 행으로 시작, 둘 다 없으면 실행하지 않음
+    새 행 전체 + 기존 행 중 replay_ratio 비율만큼 랜덤 추출한 행으로 학습 (기존 분포를 잊지 않도록)
+    토큰화 결과는 캐시에 저장해 두고 캐시에 없는 쌍만 토크나이징
+    학습 전후 dev pearson과 그 차이(drift)를 report로 남김
+    """
+    inc_conf = conf.incremental
+    save_root, model_name = conf.path.save_path, conf.model.model_name  # load_model이 conf를 바꾸기 전에 보관
+    dataloader, model = create_instance.new_instance(conf)
+    model, _, __ = create_instance.load_model(args, conf, dataloader, model)
+
+    os.makedirs(inc_conf.cache_dir, exist_ok=True)
+    manifest_path = os.path.join(inc_conf.cache_dir, f"manifest_{model_name.replace('/', '_')}.json")
+    manifest = {"rows": [], "runs": []}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    elif OmegaConf.select(conf, "incremental.seed_path", default=None):
+        # -m t 등으로 만든 체크포인트는 manifest가 없으므로 그 체크포인트가 학습한 csv의 행을 이미 본 것으로 둠
+        seed_data = pd.read_csv(inc_conf.seed_path)
+        manifest["rows"] = row_hashes(seed_data, dataloader.text_columns + dataloader.target_columns)
+        print(f"manifest가 없어서 {inc_conf.seed_path}의 {len(seed_data)}행으로 시작합니다")
+    else:
+        exit(f"{manifest_path}가 없습니다. -s 체크포인트를 학습한 csv를 incremental.seed_path에 지정해주세요 (지정하지 않으면 train csv 전체가 새 행이 됨)")
+
+    total_data = pd.read_csv(conf.path.train_path)
+    dev_data = pd.read_csv(conf.path.test_path)
+    hashes = row_hashes(total_data, dataloader.text_columns + dataloader.target_columns)
+    is_new = ~pd.Series(hashes).isin(set(manifest["rows"])).to_numpy()
+    new_data = total_data[is_new]
+    old_data = total_data[~is_new]
+    if len(new_data) == 0:
+        print("이전 실행 이후 추가된 행이 없습니다")
+        return
+
+    n_replay = min(len(old_data), int(round(len(new_data) * inc_conf.replay_ratio)))
+    replay_data = old_data.sample(n=n_replay, random_state=conf.utils.seed)
+    train_data = pd.concat([new_data, replay_data])
+    print(f"전체 {len(total_data)}행 중 새 행 {len(new_data)}개, replay {n_replay}개로 학습")
+
+    start = time.perf_counter()
+    cache = TokenCache(os.path.join(inc_conf.cache_dir, f"tokens_{tokenizer_digest(dataloader)}.pt"))
+    train_dataset = build_dataset(cache, dataloader, train_data, dataloader.swap)
+    dev_dataset = build_dataset(cache, dataloader, dev_data, False)
+    cache.save()
+    tokenize_time = time.perf_counter() - start
+    print(f"토큰화 {tokenize_time:.1f}s (캐시 hit {cache.hits}, 새로 토크나이징 {cache.misses})")
+
+    train_loader = dataloader.make_dataloader(train_dataset, dataloader.shuffle, train=True)
+    dev_loader = dataloader.make_dataloader(dev_dataset, False)
+
+    pearson_before = dev_pearson(conf, model, dev_loader)
+
+    logger = utils.build_logger(conf)
+    save_path = f"{save_root}{model_name}_incremental_{logger.experiment.name}/"
+    trainer = utils.build_trainer(
+        conf,
+        logger=logger,
+        max_epochs=inc_conf.max_epoch,
+        callbacks=[
+            utils.early_stop(
+                monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
+                patience=conf.utils.patience,
+                mode=utils.monitor_config[conf.utils.monitor]["mode"],
+            ),
+            utils.best_save(
+                save_path=save_path,
+                top_k=conf.utils.top_k,
+                monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
+                mode=utils.monitor_config[conf.utils.monitor]["mode"],
+                filename="{epoch}-{step}-{val_pearson}",
+                async_save=OmegaConf.select(conf, "utils.async_save", default=False),
+            ),
+        ],
+    )
+    start = time.perf_counter()
+    trainer.fit(model=model, train_dataloaders=train_loader, val_dataloaders=dev_loader)
+    train_time = time.perf_counter() - start
+    checkpoint.save_final(trainer, save_path + "model.ckpt")
+    utils.finish_logger(logger, save_path + "model.ckpt")
+    checkpoint.wait_all(trainer)
+
+    pearson_after = dev_pearson(conf, model, dev_loader)
+    run = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "warm_start": args.saved_model,
+        "checkpoint": save_path + "model.ckpt",
+        "total_rows": len(total_data),
+        "new_rows": len(new_data),
+        "replay_rows": n_replay,
+        "tokenize_s": tokenize_time,
+        "train_s": train_time,
+        "dev_pearson_before": pearson_before,
+        "dev_pearson_after": pearson_after,
+        "drift": pearson_after - pearson_before,
+    }
+    print(pd.DataFrame([run]).T.to_string(header=False))
+
+    # 학습이 끝난 뒤에만 manifest를 갱신해서, 중간에 실패하면 다음 실행에서 같은 행을 다시 새 행으로 봄
+    manifest = {"rows": sorted(set(hashes)), "runs": manifest["runs"] + [run]}
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    pd.DataFrame(manifest["runs"]).to_csv(os.path.join(inc_conf.cache_dir, "incremental_report.csv"), index=False)
@@ -1,25 +1,101 @@
+import hashlib
+import json
+import time
+
 import pandas as pd
 import pytorch_lightning as pl
 import torch
 import create_instance
+import utils.utils as utils
+from data_loader.data_loaders import Dataset, tokenize_pairs
+from omegaconf import OmegaConf
+from utils.pipeline import file_digest
+from utils.prediction_cache import PredictionCache
+
+
+def cached_predict(trainer, model, dataloader, cache, dataframe):
+    """
+    캐시에서 먼저 찾고, 없는 쌍만 중복 없이 토크나이징해서 예측한 뒤 캐시에 추가
+
+    캐시 키는 순서와 무관하므로 저장하는 값도 (a, b)와 (b, a) 예측의 평균으로 계산함 (요청 순서와 상관없이 같은 쌍은 같은 값)
+    모델이 완전히 대칭은 아니라서 캐시를 쓰면 한 방향만 예측하는 기본 inference와 값이 조금 다를 수 있음 (캐시가 비어 있어도)
+    """
+    first, second = (dataframe[column] for column in dataloader.text_columns)
+    if dataloader.preprocessor is not None:
+        first, second = dataloader.preprocessor.apply(first), dataloader.preprocessor.apply(second)
+    keys = [cache.pair_key(a, b) for a, b in zip(first, second)]
+
+    unique_pairs = dict(zip(keys, zip(first, second)))
+    scores = cache.get_many(list(unique_pairs))
+    missing = [key for key in unique_pairs if key not in scores]
+
+    elapsed = 0.0
+    if missing:
+        pairs = pd.DataFrame([unique_pairs[key] for key in missing], columns=dataloader.text_columns)
+        # swap: 앞쪽 len(missing)개는 (a, b), 뒤쪽은 (b, a), 이미 전처리한 문장
+        inputs = tokenize_pairs(dataloader.tokenizer, pairs, dataloader.text_columns, True, None, dataloader.padding())
+        loader = dataloader.make_dataloader(Dataset(inputs), False, bucket=False)
+        start = time.perf_counter()
+        predictions = torch.cat([p.reshape(-1) for p in trainer.predict(model=model, dataloaders=loader)])
+        predictions = (predictions[: len(missing)] + predictions[len(missing) :]) / 2
+        elapsed = time.perf_counter() - start
+        new_scores = dict(zip(missing, map(float, predictions)))
+        cache.put_many(new_scores)
+        scores.update(new_scores)
+
+    # 기본 inference는 요청마다 한 방향으로 한 번씩 예측하므로 그 대비로 계산 (없는 쌍은 양방향이라 두 번)
+    # 캐시가 비어 있으면 기본 inference보다 최대 2배 느리고 saved 값은 음수가 됨
+    computed_forward = 2 * len(missing)
+    plain_s_estimate = elapsed / computed_forward * len(keys) if missing else None
+    stats = cache.stats()
+    stats.update(
+        {
+            "requests": len(keys),
+            "computed": len(missing),
+            "computed_forward": computed_forward,
+            "plain_forward": len(keys),
+            "saved_forward": len(keys) - computed_forward,
+            "predict_s": elapsed,
+            "plain_s_estimate": plain_s_estimate,
+            "saved_s_estimate": None if plain_s_estimate is None else plain_s_estimate - elapsed,
+        }
+    )
+    return [scores[key] for key in keys], stats
 
 
 def inference(args, conf):
 
-    trainer = pl.Trainer(gpus=1, max_epochs=conf.train.max_epoch, log_every_n_steps=1)
+    trainer = utils.build_trainer(conf, devices=1, strategy=None)  # 예측 순서를 유지하도록 단일 device
 
     dataloader, model = create_instance.new_instance(conf)  # 모듈화하여 진행
     model, _, __ = create_instance.load_model(args, conf, dataloader, model)
 
     model.eval()
+    if hasattr(model, "exit_threshold"):  # EarlyExit 모델이면 설정한 threshold로 early exit 추론
+        model.exit_threshold = OmegaConf.select(conf, "early_exit.inference_threshold", default=None)
 
-    predictions = trainer.predict(
-        model=model,
-        datamodule=dataloader,
-    )
-    trainer.test(model=model, datamodule=dataloader)
+    if OmegaConf.select(conf, "prediction_cache.use_cache", default=False):
+        cache_conf = conf.prediction_cache
+        # 같은 체크포인트와 입력 설정일 때만 캐시를 공유 (symmetric: 양방향 평균으로 저장한 값, 이전 정렬 순서 값과 섞이지 않도록)
+        model_id = hashlib.sha1(f"{file_digest(args.saved_model)}:{dataloader.tokenizer.model_max_length}:symmetric".encode()).hexdigest()[:16]
+        cache = PredictionCache(model_id, cache_conf.capacity, cache_conf.disk_path)
+        predictions, stats = cached_predict(trainer, model, dataloader, cache, pd.read_csv(dataloader.predict_path))
+        cache.close()
+        print(json.dumps(stats, indent=2))
+        with open("prediction_cache_stats.json", "w") as f:
+            json.dump(stats, f, indent=2)
+        # datamodule로 test하면 setup("test")가 predict csv 전체를 토크나이징하므로 dev만 준비해서 평가
+        test_inputs, test_targets = dataloader.preprocessing(pd.read_csv(dataloader.test_path), False)
+        dataloader.test_dataset = dataloader.dataset_class(test_inputs, test_targets)
+        trainer.test(model=model, dataloaders=dataloader.test_dataloader())
+    else:
+        predictions = trainer.predict(
+            model=model,
+            datamodule=dataloader,
+        )
+        trainer.test(model=model, datamodule=dataloader)
 
-    predictions = list(float(i) for i in torch.cat(predictions))  # 리스트화
+        predictions = list(float(i) for i in torch.cat(predictions))  # 리스트화
 
     output = pd.read_csv("../data/sample_submission.csv")
     output["target"] = predictions
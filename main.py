@@ -6,9 +6,25 @@ import pandas as pd
 import pytorch_lightning as pl
 import torch
 
+import adapter_ensemble
+import autotune
+import capacity
+import cascade
+import create_instance
+import cpu_inference
+import data_pruning
+import early_exit
+import incremental
 import inference
+import prune
+import quantize
+import scaling
+import soup
+import token_profile
 import train
+import vocab_trim
 
+from data_loader import shards
 from omegaconf import OmegaConf
 
 # fix random seeds for reproducibility
@@ -27,8 +43,16 @@ if __name__ == "__main__":
         default=None,
         help="저장된 모델의 파일 경로를 입력해주세요. 예시: save_models/klue/roberta-small/epoch=?-step=?.ckpt 또는 save_models/model.pt",
     )
+    parser.add_argument(
+        "--overlay",
+        "-o",
+        nargs="*",
+        default=[],
+        help="config 위에 덮어쓸 yaml 파일 경로들. 예시: config/overlay/token_profile_klue_roberta-small.yaml",
+    )
     args, _ = parser.parse_known_args()
     conf = OmegaConf.load(f"./config/{args.config}.yaml")
+    conf = OmegaConf.merge(conf, *[OmegaConf.load(path) for path in args.overlay])
 
     SEED = conf.utils.seed
     random.seed(SEED)
@@ -52,6 +76,18 @@ if __name__ == "__main__":
         else:
             train.continue_train(args, conf)
 
+    elif args.mode == "resume" or args.mode == "r":
+        if args.saved_model is None:
+            print("경로를 입력해주세요")
+        else:
+            train.resume_train(args, conf)
+
+    elif args.mode == "incremental" or args.mode == "it":
+        if args.saved_model is None:
+            print("경로를 입력해주세요")
+        else:
+            incremental.incremental_train(args, conf)
+
     elif args.mode == "exp" or args.mode == "e":
         exp_count = int(input("실험할 횟수를 입력해주세요 "))
         train.sweep(args, conf, exp_count)
@@ -61,9 +97,82 @@ if __name__ == "__main__":
             print("경로를 입력해주세요")
         else:
             inference.inference(args, conf)
+
+    elif args.mode == "cpu inference" or args.mode == "ci":
+        if args.saved_model is None:
+            print("경로를 입력해주세요")
+        else:
+            cpu_inference.cpu_inference(args, conf)
+
+    elif args.mode == "adapter ensemble" or args.mode == "la":
+        adapter_ensemble.adapter_ensemble(args, conf)
+
+    elif args.mode == "early exit" or args.mode == "ee":
+        if args.saved_model is None:
+            print("경로를 입력해주세요")
+        else:
+            early_exit.early_exit_report(args, conf)
+
+    elif args.mode == "prune" or args.mode == "p":
+        if args.saved_model is None:
+            print("경로를 입력해주세요")
+        else:
+            prune.prune(args, conf)
+
+    elif args.mode == "trim vocab" or args.mode == "tv":
+        if args.saved_model is None:
+            print("경로를 입력해주세요")
+        else:
+            vocab_trim.vocab_trim(args, conf)
+
+    elif args.mode == "quantize" or args.mode == "q":
+        if args.saved_model is None:
+            print("경로를 입력해주세요")
+        else:
+            quantize.quantize(args, conf)
+
+    elif args.mode == "cascade" or args.mode == "cs":
+        cascade.cascade(args, conf)
+
+    elif args.mode == "soup" or args.mode == "so":
+        soup.soup(args, conf)
+
+    elif args.mode == "capacity" or args.mode == "cp":
+        capacity.capacity(args, conf)
+
+    elif args.mode == "autotune" or args.mode == "at":
+        autotune.autotune(args, conf)
+
+    elif args.mode == "shard" or args.mode == "sh":
+        shards.write_shards(create_instance.new_dataloader(conf), conf.path.train_path, conf.data.shard_dir, conf.data.rows_per_shard)
+
+    elif args.mode == "token profile" or args.mode == "tp":
+        token_profile.token_profile(args, conf)
+
+    elif args.mode == "scaling" or args.mode == "sc":
+        scaling.scaling_report(args, conf)
+
+    elif args.mode == "data pruning" or args.mode == "dp":
+        data_pruning.data_pruning(args, conf)
     else:
         print("모드를 다시 설정해주세요 ")
         print("train     : t,\ttrain")
         print("exp       : e,\texp")
         print("inference : i,\tinference")
         print("continue train : ct,\tcontinue train")
+        print("cpu inference : ci,\tcpu inference")
+        print("resume    : r,\tresume")
+        print("incremental train : it,\tincremental")
+        print("lora adapter ensemble : la,\tadapter ensemble")
+        print("early exit report : ee,\tearly exit")
+        print("prune     : p,\tprune")
+        print("quantize  : q,\tquantize")
+        print("trim vocab : tv,\ttrim vocab")
+        print("weight soup : so,\tsoup")
+        print("cascade inference : cs,\tcascade")
+        print("write shards : sh,\tshard")
+        print("token profile : tp,\ttoken profile")
+        print("batch autotune : at,\tautotune")
+        print("capacity plan : cp,\tcapacity")
+        print("scaling report : sc,\tscaling")
+        print("data pruning report : dp,\tdata pruning")
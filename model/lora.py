@@ -0,0 +1,125 @@
+import math
+
+import torch
+import torch.nn as nn
+
+
+class LoRALinear(nn.Module):
+    """
+    얼린 nn.Linear에 low-rank 업데이트 B @ A * (alpha / r)를 더하는 층 (Hu et al. 2021)
+
+    B를 0으로 초기화해서 학습 시작 시점에는 원래 층과 같은 출력
+    merge()하면 업데이트를 원래 weight에 더해서 추가 연산 없이 추론, unmerge()로 되돌림
+    """
+
+    def __init__(self, base, r, alpha, dropout=0.0):
+        super().__init__()
+        self.base = base
+        self.r = r
+        self.scaling = alpha / r
+        self.lora_A = nn.Parameter(torch.empty(r, base.in_features))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, r))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.lora_dropout = nn.Dropout(dropout)
+        self.merged = False
+
+    def delta(self):
+        return (self.lora_B @ self.lora_A) * self.scaling
+
+    @torch.no_grad()
+    def merge(self):
+        if not self.merged:
+            self.base.weight += self.delta().to(self.base.weight.dtype)
+            self.merged = True
+
+    @torch.no_grad()
+    def unmerge(self):
+        if self.merged:
+            self.base.weight -= self.delta().to(self.base.weight.dtype)
+            self.merged = False
+
+    def forward(self, x):
+        out = self.base(x)
+        if self.merged:
+            return out
+        return out + (self.lora_dropout(x) @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+
+def add_lora(model, r=8, alpha=16, dropout=0.0, target_modules=("query", "value")):
+    """
+    backbone(model.plm.base_model) 안에서 이름이 target_modules로 끝나는 nn.Linear를 LoRALinear로 바꾸고,
+    backbone은 얼린 채 adapter와 backbone 밖의 회귀 head만 학습하도록 requires_grad를 설정
+    """
+    backbone = model.plm.base_model
+    targets = [
+        (name, module)
+        for name, module in backbone.named_modules()
+        if isinstance(module, nn.Linear) and name.split(".")[-1] in target_modules
+    ]
+    if not targets:
+        raise ValueError(f"{type(backbone).__name__}에서 {list(target_modules)}에 해당하는 nn.Linear를 찾지 못했습니다")
+
+    backbone_params = {id(p) for p in backbone.parameters()}
+    for name, module in targets:
+        parent_name, _, child = name.rpartition(".")
+        parent = backbone.get_submodule(parent_name) if parent_name else backbone
+        setattr(parent, child, LoRALinear(module, r, alpha, dropout))
+
+    for name, param in model.named_parameters():
+        param.requires_grad = "lora_" in name or id(param) not in backbone_params
+    return model
+
+
+def lora_layers(model):
+    return [module for module in model.modules() if isinstance(module, LoRALinear)]
+
+
+def merge_lora(model):
+    for layer in lora_layers(model):
+        layer.merge()
+
+
+def unmerge_lora(model):
+    for layer in lora_layers(model):
+        layer.unmerge()
+
+
+def embedding_key(model):
+    weight = model.plm.get_input_embeddings().weight
+    return next(name for name, param in model.named_parameters() if param is weight)
+
+
+def adapter_state(model, state_dict=None):
+    """
+    checkpoint에 남길 텐서: 학습한 텐서(adapter, 회귀 head)와 resize_token_embeddings로 추가한 토큰의 embedding 행
+    추가 토큰 행은 초기화가 실행마다 다를 수 있어서 fold마다 함께 저장함 (몇 개 행뿐이라 크기는 무시할 만함)
+    """
+    state_dict = model.state_dict() if state_dict is None else state_dict
+    trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+    adapter = {key: value for key, value in state_dict.items() if key in trainable}
+    added_embeddings = model.plm.get_input_embeddings().weight[model.base_vocab_size :].detach().cpu().clone()
+    return adapter, added_embeddings
+
+
+def fill_backbone(model, adapter, added_embeddings=None):
+    # adapter만 있는 state_dict에 현재 모델(pretrained backbone)의 나머지 텐서를 채워서 strict하게 불러올 수 있게 함
+    state_dict = dict(model.state_dict())
+    state_dict.update(adapter)
+    if added_embeddings is not None:
+        key = embedding_key(model)
+        state_dict[key] = torch.cat([state_dict[key][: model.base_vocab_size], added_embeddings.to(state_dict[key])])
+    return state_dict
+
+
+def load_adapter(model, adapter, added_embeddings=None):
+    # 공유 backbone은 그대로 두고 adapter / head / 추가 토큰 embedding만 교체
+    if any(layer.merged for layer in lora_layers(model)):
+        raise ValueError("merge된 상태에서는 adapter를 바꿀 수 없습니다 (unmerge_lora 먼저 호출)")
+    trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+    missing, unexpected = trainable - adapter.keys(), adapter.keys() - trainable
+    if missing or unexpected:
+        raise ValueError(f"adapter 구조가 모델과 다릅니다 (없는 키: {sorted(missing)[:3]}, 모르는 키: {sorted(unexpected)[:3]})")
+    model.load_state_dict(adapter, strict=False)
+    if added_embeddings is not None:
+        with torch.no_grad():
+            model.plm.get_input_embeddings().weight[model.base_vocab_size :] = added_embeddings
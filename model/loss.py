@@ -28,6 +28,24 @@ def rmse_loss(output, target):
     return torch.sqrt(loss_func(output, target))
 
 
+def example_loss(loss, output, target):
+    # data pruning용 예시별 loss (reduction 없음), rmse는 mse 기준
+    output, target = output.reshape(-1), target.reshape(-1)
+    if loss in ("mse", "rmse"):
+        return (output - target) ** 2
+    if loss == "l1":
+        return (output - target).abs()
+    if loss == "bce":
+        return F.binary_cross_entropy_with_logits(output, target, reduction="none")
+    raise ValueError(f"data pruning을 지원하지 않는 loss입니다: {loss} (mse, rmse, l1, bce)")
+
+
+def weighted_loss(loss, losses, weights):
+    # importance weight를 곱한 batch 평균, weight가 모두 1이면 loss_config의 loss와 같음
+    mean = (losses * weights).mean()
+    return torch.sqrt(mean) if loss == "rmse" else mean
+
+
 loss_config = {
     "nll": nll_loss,
     "l1": L1_loss,
@@ -0,0 +1,62 @@
+import torch
+import torchmetrics
+
+
+class StreamingPearson(torchmetrics.Metric):
+    """
+    epoch 전체에 대한 pearson 상관계수를 배치 단위로 누적해서 계산함
+
+    상태는 (n, mean_x, mean_y, m2_x, m2_y, c_xy) 6개 스칼라뿐이라 데이터 크기와 상관없이 O(1)
+    배치마다 배치 통계를 구한 뒤 Chan의 병렬 Welford 공식으로 합치고,
+    분산 학습에서는 프로세스별 상태를 모아 같은 공식으로 병합함
+    """
+
+    is_differentiable = False
+    higher_is_better = True
+    full_state_update = False
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        for name in ["n", "mean_x", "mean_y", "m2_x", "m2_y", "c_xy"]:
+            # dist_reduce_fx=None: 프로세스별 상태를 stack 해두고 compute에서 병합
+            self.add_state(name, default=torch.tensor(0.0, dtype=torch.float64), dist_reduce_fx=None)
+
+    def update(self, preds, target):
+        x = preds.detach().reshape(-1).double()
+        y = target.detach().reshape(-1).double()
+        n = torch.tensor(float(x.numel()), dtype=torch.float64, device=x.device)
+        if n == 0:
+            return
+        mean_x, mean_y = x.mean(), y.mean()
+        dx, dy = x - mean_x, y - mean_y
+        batch = (n, mean_x, mean_y, (dx * dx).sum(), (dy * dy).sum(), (dx * dy).sum())
+        state = (self.n, self.mean_x, self.mean_y, self.m2_x, self.m2_y, self.c_xy)
+        self.n, self.mean_x, self.mean_y, self.m2_x, self.m2_y, self.c_xy = _merge(state, batch)
+
+    def compute(self):
+        # 동기화 후에는 각 상태가 [world_size] 텐서가 되므로 하나씩 병합
+        states = [torch.atleast_1d(s) for s in (self.n, self.mean_x, self.mean_y, self.m2_x, self.m2_y, self.c_xy)]
+        merged = tuple(s[0] for s in states)
+        for i in range(1, states[0].numel()):
+            merged = _merge(merged, tuple(s[i] for s in states))
+        n, _, _, m2_x, m2_y, c_xy = merged
+        return (c_xy / torch.sqrt(m2_x * m2_y).clamp(min=1e-12)).float()
+
+
+def _merge(a, b):
+    # Chan et al. 병렬 분산 공식 (공분산까지 확장)
+    n_a, mean_xa, mean_ya, m2_xa, m2_ya, c_a = a
+    n_b, mean_xb, mean_yb, m2_xb, m2_yb, c_b = b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    dx, dy = mean_xb - mean_xa, mean_yb - mean_ya
+    w = n_a * n_b / n
+    return (
+        n,
+        mean_xa + dx * n_b / n,
+        mean_ya + dy * n_b / n,
+        m2_xa + m2_xb + dx * dx * w,
+        m2_ya + m2_yb + dy * dy * w,
+        c_a + c_b + dx * dy * w,
+    )
@@ -1,30 +1,74 @@
 import pytorch_lightning as pl
 import torch
 import torch.nn as nn
-import torchmetrics
 import transformers
 from torch.optim.lr_scheduler import ExponentialLR, LambdaLR, StepLR
 
+from . import lora as lora_module
 from . import loss as loss_module
+from .metric import StreamingPearson
 
 
-class Model(pl.LightningModule):
-    def __init__(self, model_name, lr, loss, new_vocab_size, frozen):  # 새로운 vocab 사이즈 설정
+class BaseModel(pl.LightningModule):
+    # 네 모델이 공유하는 학습/검증/추론 step, 각 모델은 __init__, forward (필요하면 configure_optimizers)만 구현
+    def __init__(self):
         super().__init__()
-        self.save_hyperparameters()
-
-        self.model_name = model_name
-        self.lr = lr
-
-        self.plm = transformers.AutoModelForSequenceClassification.from_pretrained(
-            pretrained_model_name_or_path=model_name,
-            num_labels=1,
-        )
-
-        if frozen == True:
-            self.frozen()
-        self.plm.resize_token_embeddings(new_vocab_size)  # 임베딩 차원 재조정
-        self.loss_func = loss_module.loss_config[loss]
+        # 배치별 pearson의 평균이 아니라 epoch 전체 예측에 대한 pearson을 계산
+        self.val_pearson = StreamingPearson()
+        self.test_pearson = StreamingPearson()
+        # data pruning(utils/loss_pruning.py): callback이 batch마다 importance weight를 넣고, 학습 step이 예시별 loss를 남김
+        self.example_weights = None
+        self.example_loss = None
+
+    def attention_mask(self, x):
+        # pad_token_id가 주어진 모델(dynamic padding 학습)만 pad 토큰을 attention에서 제외, 기존 모델은 None (모든 토큰 attend)
+        pad_token_id = self.hparams.get("pad_token_id")
+        if pad_token_id is None:
+            return None
+        return x.ne(pad_token_id).long()
+
+    def packed_cls(self, packed):
+        """
+        sequence packing 입력(data_loaders.pack_collate)을 encoder에 통과시키고 쌍마다 자기 CLS hidden을 꺼냄 [batch, 1, hidden]
+
+        같은 segment끼리만 attend하는 block-diagonal mask와 쌍마다 다시 시작하는 position id를 써서
+        pad mask를 쓴 unpacked 추론(pad_token_id 설정)과 같은 결과가 나옴 (부동소수점 오차 범위)
+        """
+        backbone = self.plm.base_model
+        if not hasattr(backbone, "encoder") or not hasattr(backbone.encoder, "layer"):
+            raise ValueError(f"{type(backbone).__name__}는 sequence packing을 지원하지 않습니다")
+        segment_ids = packed["segment_ids"]
+        mask = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] > 0)
+        # roberta 계열은 position이 padding_idx + 1부터 시작
+        padding_idx = getattr(backbone.embeddings, "padding_idx", None)
+        position_ids = packed["position_ids"] + (0 if padding_idx is None else padding_idx + 1)
+        hidden = backbone(packed["input_ids"], attention_mask=mask.long(), position_ids=position_ids)[0]
+        rows, cols = packed["cls_index"]
+        return hidden[rows, cols].unsqueeze(1)
+
+    def final_head(self, hidden):
+        # AutoModelForSequenceClassification의 head만 실행, hidden은 [batch, 길이, hidden]이고 CLS(0번 위치)만 사용
+        backbone = self.plm.base_model
+        if getattr(backbone, "pooler", None) is not None:  # bert 계열: pooler -> classifier
+            return self.plm.classifier(self.plm.dropout(backbone.pooler(hidden)))
+        return self.plm.classifier(hidden)  # roberta 계열: classifier가 CLS를 직접 꺼냄
+
+    def setup_lora(self, lora):
+        # lora 설정({r, alpha, dropout, target_modules})이 있으면 backbone을 얼리고 adapter와 회귀 head만 학습
+        self.base_vocab_size = None
+        if lora is not None:
+            self.base_vocab_size = transformers.AutoConfig.from_pretrained(self.model_name).vocab_size  # 이후 행은 추가한 토큰
+            lora_module.add_lora(self, **lora)
+
+    def on_save_checkpoint(self, checkpoint):
+        # lora 학습이면 backbone은 빼고 adapter / head / 추가 토큰 embedding만 저장
+        if self.hparams.get("lora") is not None:
+            checkpoint["state_dict"], checkpoint["added_embeddings"] = lora_module.adapter_state(self, checkpoint["state_dict"])
+
+    def on_load_checkpoint(self, checkpoint):
+        # adapter만 있는 checkpoint는 방금 불러온 pretrained backbone으로 나머지를 채움 (load_from_checkpoint, resume 모두)
+        if self.hparams.get("lora") is not None:
+            checkpoint["state_dict"] = lora_module.fill_backbone(self, checkpoint["state_dict"], checkpoint.get("added_embeddings"))
 
     def frozen(self):  # 추후 레이어를 반복하면서 얼리고 풀고 할 수 있게 훈련
         for name, param in self.plm.named_parameters():
@@ -37,15 +81,15 @@ class Model(pl.LightningModule):
             ]:
                 param.requires_grad = True
 
-    def forward(self, x):
-        x = self.plm(x)["logits"]
-
-        return x
-
     def training_step(self, batch, batch_idx):
         x, y = batch
         logits = self(x)
-        loss = self.loss_func(logits, y.float())
+        if self.example_weights is None:
+            loss = self.loss_func(logits, y.float())
+        else:
+            losses = loss_module.example_loss(self.hparams.loss, logits, y.float())
+            self.example_loss = losses.detach()
+            loss = loss_module.weighted_loss(self.hparams.loss, losses, self.example_weights)
         self.log("train_loss", loss)
         return loss
 
@@ -54,20 +98,16 @@ class Model(pl.LightningModule):
         logits = self(x)
         loss = self.loss_func(logits, y.float())
         self.log("val_loss", loss)
-        self.log(
-            "val_pearson",
-            torchmetrics.functional.pearson_corrcoef(logits.squeeze(), y.squeeze()),
-        )
+        self.val_pearson.update(logits, y)
+        self.log("val_pearson", self.val_pearson, on_step=False, on_epoch=True)  # epoch 끝에 한 번만 compute
 
         return loss
 
     def test_step(self, batch, batch_idx):
         x, y = batch
         logits = self(x)
-        self.log(
-            "test_pearson",
-            torchmetrics.functional.pearson_corrcoef(logits.squeeze(), y.squeeze()),
-        )
+        self.test_pearson.update(logits, y)
+        self.log("test_pearson", self.test_pearson, on_step=False, on_epoch=True)
 
     def predict_step(self, batch, batch_idx):
         x = batch
@@ -81,8 +121,35 @@ class Model(pl.LightningModule):
         return optimizer
 
 
-class Klue_CustomModel(pl.LightningModule):
-    def __init__(self, model_name, lr, loss, new_vocab_size, frozen):
+class Model(BaseModel):
+    def __init__(self, model_name, lr, loss, new_vocab_size, frozen, pad_token_id=None, lora=None):  # 새로운 vocab 사이즈 설정
+        super().__init__()
+        self.save_hyperparameters()
+
+        self.model_name = model_name
+        self.lr = lr
+
+        self.plm = transformers.AutoModelForSequenceClassification.from_pretrained(
+            pretrained_model_name_or_path=model_name,
+            num_labels=1,
+        )
+
+        if frozen == True:
+            self.frozen()
+        self.plm.resize_token_embeddings(new_vocab_size)  # 임베딩 차원 재조정
+        self.loss_func = loss_module.loss_config[loss]
+        self.setup_lora(lora)  # model/lora.py, 설정이 없으면 그대로
+
+    def forward(self, x):
+        if isinstance(x, dict):  # sequence packing
+            return self.final_head(self.packed_cls(x))
+        x = self.plm(x, attention_mask=self.attention_mask(x))["logits"]
+
+        return x
+
+
+class Klue_CustomModel(BaseModel):
+    def __init__(self, model_name, lr, loss, new_vocab_size, frozen, pad_token_id=None, lora=None):
         super().__init__()
         self.save_hyperparameters()
         self.model_name = model_name
@@ -106,64 +173,19 @@ class Klue_CustomModel(pl.LightningModule):
             self.frozen()
         self.plm.resize_token_embeddings(new_vocab_size)  # 임베딩 차원 재조정
         self.loss_func = loss_module.loss_config[loss]
-
-    def frozen(self):  # 추후 레이어를 반복하면서 얼리고 풀고 할 수 있게 훈련
-        for name, param in self.plm.named_parameters():
-            param.requires_grad = False
-            if name in [
-                "classifier.dense.weight",
-                "classifier.dense.bias",
-                "classifier.out_proj.weight",
-                "classifier.out_proj.bias",
-            ]:
-                param.requires_grad = True
+        self.setup_lora(lora)
 
     def forward(self, x):
-        x = self.plm(x)["logits"]
+        if isinstance(x, dict):  # sequence packing
+            x = self.final_head(self.packed_cls(x))
+        else:
+            x = self.plm(x, attention_mask=self.attention_mask(x))["logits"]
         x = self.MLP_HEAD(x)
         return x
 
-    def training_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
-        loss = self.loss_func(logits, y.float())
-        self.log("train_loss", loss)
-        return loss
-
-    def validation_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
-        loss = self.loss_func(logits, y.float())
-        self.log("val_loss", loss)
-        self.log(
-            "val_pearson",
-            torchmetrics.functional.pearson_corrcoef(logits.squeeze(), y.squeeze()),
-        )
-
-        return loss
 
-    def test_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
-        self.log(
-            "test_pearson",
-            torchmetrics.functional.pearson_corrcoef(logits.squeeze(), y.squeeze()),
-        )
-
-    def predict_step(self, batch, batch_idx):
-        x = batch
-        logits = self(x)
-
-        return logits.squeeze()
-
-    def configure_optimizers(self):
-        optimizer = torch.optim.AdamW(self.parameters(), lr=self.lr)
-
-        return optimizer
-
-
-class Funnel_CustomModel(pl.LightningModule):  # 스케줄러 사용
-    def __init__(self, model_name, lr, loss, new_vocab_size, frozen):
+class Funnel_CustomModel(BaseModel):  # 스케줄러 사용
+    def __init__(self, model_name, lr, loss, new_vocab_size, frozen, pad_token_id=None, lora=None):
         super().__init__()
         self.save_hyperparameters()
         self.model_name = model_name
@@ -190,137 +212,191 @@ class Funnel_CustomModel(pl.LightningModule):  # 스케줄러 사용
             self.frozen()
         self.plm.resize_token_embeddings(new_vocab_size)  # 임베딩 차원 재조정
         self.loss_func = loss_module.loss_config[loss]
-
-    def frozen(self):  # 추후 레이어를 반복하면서 얼리고 풀고 할 수 있게 훈련
-        for name, param in self.plm.named_parameters():
-            param.requires_grad = False
-            if name in [
-                "classifier.dense.weight",
-                "classifier.dense.bias",
-                "classifier.out_proj.weight",
-                "classifier.out_proj.bias",
-            ]:
-                param.requires_grad = True
+        self.setup_lora(lora)
 
     def forward(self, x):
-        x = self.plm(x)[0]
+        if isinstance(x, dict):
+            # funnel은 레이어 사이에서 인접 토큰을 pooling해서 줄이므로 여러 쌍을 한 행에 넣으면 쌍끼리 섞임
+            raise ValueError("Funnel_CustomModel은 sequence packing을 지원하지 않습니다 (data.packing: False로 학습)")
+        x = self.plm(x, attention_mask=self.attention_mask(x))[0]
         x = x[:, 0, :]  # x: 768
         y = self.Head(x)  # y: 1024
         x = torch.cat((x, y), dim=1)
         x = self.Head2(x)
         return x
 
-    def training_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
-        loss = self.loss_func(logits, y.float())
-        return loss
+    def configure_optimizers(self):
+        optimizer = torch.optim.AdamW(self.parameters(), lr=self.lr)
+        scheduler = ExponentialLR(optimizer, gamma=0.95)  # 지수적으로 감소하게 해둠
+        return [optimizer], [scheduler]
 
-    def validation_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
-        loss = self.loss_func(logits, y.float())
-        self.log("val_loss", loss)
-        self.log(
-            "val_pearson",
-            torchmetrics.functional.pearson_corrcoef(logits.squeeze(), y.squeeze()),
-        )
 
-        return loss
+class Xlm_CustomModel(BaseModel):
+    def __init__(self, model_name, lr, loss, new_vocab_size, frozen, pad_token_id=None, lora=None):  # 새로운 vocab 사이즈 설정
+        super().__init__()
+        self.save_hyperparameters()
 
-    def test_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
-        self.log(
-            "test_pearson",
-            torchmetrics.functional.pearson_corrcoef(logits.squeeze(), y.squeeze()),
+        self.model_name = model_name
+        self.lr = lr
+
+        self.plm = transformers.AutoModelForSequenceClassification.from_pretrained(
+            pretrained_model_name_or_path=model_name,
+            num_labels=1,
         )
 
-    def predict_step(self, batch, batch_idx):
-        x = batch
-        logits = self(x)
-        return logits.squeeze()
+        if frozen == True:
+            self.frozen()
+        self.plm.resize_token_embeddings(new_vocab_size)  # 임베딩 차원 재조정
+        self.loss_func = loss_module.loss_config[loss]
+        self.setup_lora(lora)
+
+    def forward(self, x):
+        if isinstance(x, dict):  # sequence packing
+            return self.final_head(self.packed_cls(x))
+        x = self.plm(x, attention_mask=self.attention_mask(x))["logits"]
+
+        return x
 
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.lr)
-        scheduler = ExponentialLR(optimizer, gamma=0.95)  # 지수적으로 감소하게 해둠
+        scheduler = StepLR(optimizer, step_size=30, gamma=0.5)
+        # scheduler = LambdaLR(optimizer, lr_lambda=triangle_func)
         return [optimizer], [scheduler]
 
 
-class Xlm_CustomModel(pl.LightningModule):
-    def __init__(self, model_name, lr, loss, new_vocab_size, frozen):  # 새로운 vocab 사이즈 설정
+class EarlyExit_Model(BaseModel):
+    """
+    중간 레이어마다 가벼운 회귀 head(exit)를 붙인 Model
+
+    학습: 최종 head loss + exit head loss
+        exit_training="joint"  : exit들도 정답 label로 학습 (backbone까지 gradient 전달)
+        exit_training="distill": exit들은 detach된 hidden으로 최종 head 예측을 따라가도록 self-distillation
+    추론: exit_threshold가 설정되면 레이어를 하나씩 실행하면서,
+        연속된 두 exit 예측 차이가 exit_threshold보다 작아진 샘플부터 배치에서 빼고 그 값을 예측으로 사용
+    """
+
+    def __init__(self, model_name, lr, loss, new_vocab_size, frozen, exit_training="joint", pad_token_id=None):
         super().__init__()
         self.save_hyperparameters()
 
         self.model_name = model_name
         self.lr = lr
+        self.exit_training = exit_training
+        self.exit_threshold = None  # None이면 모든 레이어 실행
+        self.last_exit_layers = None  # 마지막 forward에서 샘플별로 실행된 레이어 수
 
         self.plm = transformers.AutoModelForSequenceClassification.from_pretrained(
             pretrained_model_name_or_path=model_name,
             num_labels=1,
         )
+        self.num_layers = self.plm.config.num_hidden_layers
+        self.exit_heads = nn.ModuleList(  # 1 ~ (L-1)번째 레이어 출력의 CLS에 붙는 exit, L번째는 기존 classifier
+            [
+                nn.Sequential(
+                    nn.Dropout(0.1),
+                    nn.Linear(self.plm.config.hidden_size, 1),
+                )
+                for _ in range(self.num_layers - 1)
+            ]
+        )
 
         if frozen == True:
             self.frozen()
         self.plm.resize_token_embeddings(new_vocab_size)  # 임베딩 차원 재조정
         self.loss_func = loss_module.loss_config[loss]
 
-    def frozen(self):  # 추후 레이어를 반복하면서 얼리고 풀고 할 수 있게 훈련
-        for name, param in self.plm.named_parameters():
-            param.requires_grad = False
-            if name in [
-                "classifier.dense.weight",
-                "classifier.dense.bias",
-                "classifier.out_proj.weight",
-                "classifier.out_proj.bias",
-            ]:
-                param.requires_grad = True
+    @property
+    def backbone(self):  # plm.roberta / plm.bert (state_dict에 중복 등록되지 않도록 property로 접근)
+        return self.plm.base_model
+
+    def exit_logits(self, x):
+        # 모든 exit의 예측 [L, B, 1], 학습과 검증에서 사용
+        hidden_states = self.backbone(x, attention_mask=self.attention_mask(x), output_hidden_states=True)["hidden_states"]  # (embedding, layer1, ..., layerL)
+        final = self.final_head(hidden_states[-1])
+        exits = []
+        for i, head in enumerate(self.exit_heads):
+            hidden = hidden_states[i + 1][:, 0, :]
+            if self.exit_training == "distill":
+                hidden = hidden.detach()
+            exits.append(head(hidden))
+        return exits, final
 
     def forward(self, x):
-        x = self.plm(x)["logits"]
-
-        return x
+        if isinstance(x, dict):
+            raise ValueError("EarlyExit_Model은 sequence packing을 지원하지 않습니다")
+        if self.exit_threshold is None:
+            self.last_exit_layers = torch.full((x.size(0),), self.num_layers, device=x.device)
+            return self.final_head(self.backbone(x, attention_mask=self.attention_mask(x))[0])
+        return self.early_exit_forward(x, self.exit_threshold)
+
+    @torch.no_grad()
+    def early_exit_forward(self, x, threshold):
+        logits = torch.zeros(x.size(0), 1, device=x.device)
+        exit_layers = torch.full((x.size(0),), self.num_layers, device=x.device)
+        active = torch.arange(x.size(0), device=x.device)  # 아직 exit하지 못한 샘플의 원래 위치
+
+        mask = self.attention_mask(x)
+        if mask is not None:
+            mask = self.backbone.get_extended_attention_mask(mask, x.shape)
+        hidden = self.backbone.embeddings(input_ids=x)
+        prev = None
+        for i, layer in enumerate(self.backbone.encoder.layer):
+            hidden = layer(hidden, attention_mask=mask)[0]
+            if i == self.num_layers - 1:
+                logits[active] = self.final_head(hidden)
+                break
+
+            pred = self.exit_heads[i](hidden[:, 0, :])
+            if prev is not None:
+                done = (pred - prev).abs().squeeze(-1) < threshold
+                if done.any():
+                    logits[active[done]] = pred[done]
+                    exit_layers[active[done]] = i + 1
+                    active, hidden, pred = active[~done], hidden[~done], pred[~done]
+                    if mask is not None:
+                        mask = mask[~done]
+                    if active.numel() == 0:
+                        break
+            prev = pred
+
+        self.last_exit_layers = exit_layers
+        return logits
 
     def training_step(self, batch, batch_idx):
         x, y = batch
-        logits = self(x)
-        loss = self.loss_func(logits, y.float())
+        exits, logits = self.exit_logits(x)
+        if self.example_weights is None:
+            loss = self.loss_func(logits, y.float())
+        else:  # data pruning: 마지막 head의 예시별 loss를 기록하고 importance weight로 가중 (exit head loss는 그대로)
+            losses = loss_module.example_loss(self.hparams.loss, logits, y.float())
+            self.example_loss = losses.detach()
+            loss = loss_module.weighted_loss(self.hparams.loss, losses, self.example_weights)
+        if self.exit_training == "distill":
+            target = logits.detach()
+            exit_loss = sum(self.loss_func(e, target) for e in exits) / len(exits)
+        else:
+            # 깊은 exit일수록 큰 가중치 (DeeBERT/PABEE 방식)
+            weights = [(i + 1) / len(exits) for i in range(len(exits))]
+            exit_loss = sum(w * self.loss_func(e, y.float()) for w, e in zip(weights, exits)) / sum(weights)
         self.log("train_loss", loss)
-        return loss
-
-    def validation_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
-        loss = self.loss_func(logits, y.float())
-        self.log("val_loss", loss)
-        self.log(
-            "val_pearson",
-            torchmetrics.functional.pearson_corrcoef(logits.squeeze(), y.squeeze()),
-        )
-
-        return loss
-
-    def test_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
-        self.log(
-            "test_pearson",
-            torchmetrics.functional.pearson_corrcoef(logits.squeeze(), y.squeeze()),
-        )
+        self.log("train_exit_loss", exit_loss)
+        return loss + exit_loss
 
-    def predict_step(self, batch, batch_idx):
-        x = batch
-        logits = self(x)
 
-        return logits.squeeze()
-
-    def configure_optimizers(self):
+class EarlyExit_XlmModel(EarlyExit_Model):
+    def configure_optimizers(self):  # Xlm_CustomModel과 같은 스케줄러
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.lr)
         scheduler = StepLR(optimizer, step_size=30, gamma=0.5)
-        # scheduler = LambdaLR(optimizer, lr_lambda=triangle_func)
         return [optimizer], [scheduler]
 
 
+# early_exit.use_early_exit일 때 model.model_class에 대응하는 early exit 클래스
+early_exit_config = {
+    "Model": EarlyExit_Model,
+    "Xlm_CustomModel": EarlyExit_XlmModel,
+}
+
+
 # def triangle_func(epoch):
 #     max_lr_epoch = 50  # 삼각형의 꼭짓점
 #     grad = 1 / max_lr_epoch  # 기울기
@@ -0,0 +1,32 @@
+import torch
+import torch.nn as nn
+
+
+class TrimmedEmbedding(nn.Module):
+    """
+    사용하는 토큰 행만 남긴 word embedding, 입력은 원래 tokenizer의 id 그대로 받음
+
+    vocab_map[원래 id] = 남긴 행 번호, 남기지 않은 토큰은 unk 행으로 보냄
+    tokenizer를 다시 만들지 않아도 되고, 남긴 토큰만으로 된 문장은 원래 모델과 같은 예측
+    """
+
+    def __init__(self, embedding, kept_ids, unk_id):
+        super().__init__()
+        kept_ids = torch.as_tensor(kept_ids, dtype=torch.long)
+        vocab_map = torch.full((embedding.num_embeddings,), int((kept_ids == unk_id).nonzero()[0]), dtype=torch.long)
+        vocab_map[kept_ids] = torch.arange(len(kept_ids))
+        self.register_buffer("vocab_map", vocab_map)
+        self.embedding = nn.Embedding.from_pretrained(embedding.weight.detach()[kept_ids].clone(), freeze=False, padding_idx=None)
+        if embedding.padding_idx is not None:
+            self.embedding.padding_idx = int(vocab_map[embedding.padding_idx])
+
+    @property
+    def weight(self):
+        return self.embedding.weight
+
+    @property
+    def num_embeddings(self):  # 원래 id 범위 (tokenizer 기준)
+        return self.vocab_map.numel()
+
+    def forward(self, input_ids):
+        return self.embedding(self.vocab_map[input_ids])
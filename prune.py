@@ -0,0 +1,179 @@
+import copy
+import os
+import time
+
+import pandas as pd
+import torch
+from transformers.pytorch_utils import prune_linear_layer
+
+import create_instance
+import utils.utils as utils
+from model import lora as lora_module
+from model.metric import StreamingPearson
+
+
+def encoder_layers(model):
+    # roberta/bert 계열 (Model, Klue_CustomModel, Xlm_CustomModel)만 지원
+    base = model.plm.base_model
+    if not hasattr(base, "encoder") or not hasattr(base.encoder, "layer"):
+        raise ValueError(f"{type(base).__name__}는 head/FFN pruning을 지원하지 않습니다")
+    return base.encoder.layer
+
+
+def evaluate(model, loader, device):
+    # dev pearson과 전체 dev를 한 번 도는 데 걸린 시간
+    pearson = StreamingPearson().to(device)
+    model.eval()
+    start = time.perf_counter()
+    with torch.no_grad():
+        for x, y in loader:
+            x, y = x.to(device), y.to(device)
+            pearson.update(model(x), y)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return float(pearson.compute()), time.perf_counter() - start
+
+
+def importance_scores(model, loader, device):
+    """
+    dev set에서 1차 Taylor 근사 |w * dL/dw|로 구조별 중요도를 계산함
+
+    head: 해당 head의 query/key/value 행과 attention output 열
+    ffn: intermediate 뉴런 하나에 연결된 intermediate 행과 output 열
+    layer: 레이어 안 head, ffn 중요도의 합
+    train.use_frozen으로 얼린 backbone도 점수를 낼 수 있도록 encoder 파라미터의 gradient를 잠시 켰다가 원래대로 되돌림
+    """
+    layers = encoder_layers(model)
+    requires_grad = {param: param.requires_grad for param in layers.parameters()}
+    for param in requires_grad:
+        param.requires_grad = True
+    head_scores = [torch.zeros(layer.attention.self.num_attention_heads, device=device) for layer in layers]
+    ffn_scores = [torch.zeros(layer.intermediate.dense.out_features, device=device) for layer in layers]
+
+    model.train()  # dropout은 끄고 gradient만 필요
+    for module in model.modules():
+        if isinstance(module, torch.nn.Dropout):
+            module.eval()
+
+    for x, y in loader:
+        x, y = x.to(device), y.to(device)
+        model.zero_grad()
+        loss = model.loss_func(model(x), y.float())
+        loss.backward()
+
+        with torch.no_grad():
+            for i, layer in enumerate(layers):
+                attn = layer.attention.self
+                head_size = attn.attention_head_size
+                score = sum((m.weight * m.weight.grad).abs().sum(dim=1) + (m.bias * m.bias.grad).abs() for m in (attn.query, attn.key, attn.value))
+                out = layer.attention.output.dense
+                score = score + (out.weight * out.weight.grad).abs().sum(dim=0)
+                head_scores[i] += score.view(-1, head_size).sum(dim=1)
+
+                inter, output = layer.intermediate.dense, layer.output.dense
+                ffn = (inter.weight * inter.weight.grad).abs().sum(dim=1) + (inter.bias * inter.bias.grad).abs()
+                ffn_scores[i] += ffn + (output.weight * output.weight.grad).abs().sum(dim=0)
+    model.zero_grad()
+    for param, flag in requires_grad.items():
+        param.requires_grad = flag
+
+    layer_scores = torch.stack([h.sum() + f.sum() for h, f in zip(head_scores, ffn_scores)])
+    return head_scores, ffn_scores, layer_scores
+
+
+def prune_step(model, head_scores, ffn_scores, layer_scores, prune_conf):
+    layers = encoder_layers(model)
+
+    # 중요도가 가장 낮은 레이어 제거 (레이어는 최소 1개 유지)
+    if prune_conf.prune_layers and len(layers) > 1:
+        drop = int(layer_scores.argmin())
+        keep = [i for i in range(len(layers)) if i != drop]
+        model.plm.base_model.encoder.layer = torch.nn.ModuleList([layers[i] for i in keep])
+        model.plm.config.num_hidden_layers = len(keep)
+        head_scores = [head_scores[i] for i in keep]
+        ffn_scores = [ffn_scores[i] for i in keep]
+        layers = encoder_layers(model)
+
+    # 전체 head 중 하위 head_ratio 제거 (레이어마다 head는 최소 1개 유지)
+    all_heads = sorted((float(s), i, h) for i, scores in enumerate(head_scores) for h, s in enumerate(scores))
+    n_heads = int(len(all_heads) * prune_conf.head_ratio)
+    remove = {i: [] for i in range(len(layers))}
+    for _, i, h in all_heads:
+        if n_heads == 0:
+            break
+        if len(remove[i]) < len(head_scores[i]) - 1:
+            remove[i].append(h)
+            n_heads -= 1
+    for i, heads in remove.items():
+        if heads:
+            attn = layers[i].attention
+            # prune_heads는 원래 head 번호를 받으므로 현재 번호를 변환
+            alive = sorted(set(range(attn.self.num_attention_heads + len(attn.pruned_heads))) - attn.pruned_heads)
+            attn.prune_heads([alive[h] for h in heads])
+
+    # 레이어마다 FFN 뉴런 중 하위 ffn_ratio 제거
+    for layer, scores in zip(layers, ffn_scores):
+        n_keep = max(1, int(len(scores) * (1 - prune_conf.ffn_ratio)))
+        index = scores.topk(n_keep).indices.sort().values
+        layer.intermediate.dense = prune_linear_layer(layer.intermediate.dense, index, dim=0)
+        layer.output.dense = prune_linear_layer(layer.output.dense, index, dim=1)
+
+    model.plm.config.pruned_heads = {i: sorted(layer.attention.pruned_heads) for i, layer in enumerate(layers) if layer.attention.pruned_heads}
+    return model
+
+
+def model_size(model):
+    n_params = sum(p.numel() for p in model.parameters())
+    n_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    return n_params, n_bytes / 1024**2
+
+
+def prune(args, conf):
+    dataloader, model = create_instance.new_instance(conf)
+    model, _, __ = create_instance.load_model(args, conf, dataloader, model)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model.to(device)
+    encoder_layers(model)  # 지원하지 않는 모델이면 여기서 종료
+    if lora_module.lora_layers(model):
+        exit("LoRA adapter 모델은 query / value가 LoRALinear로 감싸져 있어서 head/FFN pruning을 지원하지 않습니다")
+    if conf.prune.prune_layers and hasattr(model, "exit_heads"):
+        exit("EarlyExit 모델은 레이어마다 exit head가 있어서 prune_layers를 지원하지 않습니다")
+
+    dataloader.setup("test")
+    dev_loader = dataloader.test_dataloader()
+
+    base_pearson, base_time = evaluate(model, dev_loader, device)
+    n_params, size_mb = model_size(model)
+    rows = [{"step": 0, "layers": len(encoder_layers(model)), "params": n_params, "size_mb": size_mb, "dev_time_s": base_time, "dev_pearson": base_pearson}]
+    print(rows[-1])
+
+    for step in range(1, conf.prune.max_steps + 1):
+        previous = copy.deepcopy(model)
+        head_scores, ffn_scores, layer_scores = importance_scores(model, dev_loader, device)
+        model = prune_step(model, head_scores, ffn_scores, layer_scores, conf.prune)
+
+        if conf.prune.recovery_epochs > 0:  # 짧은 recovery fine-tune
+            trainer = utils.build_trainer(conf, logger=False, max_epochs=conf.prune.recovery_epochs, enable_checkpointing=False)
+            trainer.fit(model=model, datamodule=dataloader)
+            model.to(device)
+
+        pearson, dev_time = evaluate(model, dev_loader, device)
+        n_params, size_mb = model_size(model)
+        rows.append({"step": step, "layers": len(encoder_layers(model)), "params": n_params, "size_mb": size_mb, "dev_time_s": dev_time, "dev_pearson": pearson})
+        print(rows[-1])
+
+        if base_pearson - pearson > conf.prune.tolerance:
+            print(f"dev pearson 하락 {base_pearson - pearson:.4f} > tolerance {conf.prune.tolerance}, step {step - 1} 모델 사용")
+            rows[-1]["rejected"] = True
+            model = previous
+            break
+
+    # .pt는 모델 구조까지 저장하므로 줄어든 모델 그대로 inference 모드에서 불러올 수 있음
+    save_name = conf.path.save_path + os.path.splitext(os.path.basename(args.saved_model))[0] + "_pruned.pt"
+    model.cpu()
+    torch.save(model, save_name)
+
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    report.to_csv(conf.path.save_path + "prune_report.csv", index=False)
+    print(f"저장 완료: {save_name} ({os.path.getsize(save_name) / 1024**2:.1f}MB)")
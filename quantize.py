@@ -0,0 +1,114 @@
+import copy
+import io
+import os
+import time
+
+import pandas as pd
+import torch
+import torchmetrics
+from pytorch_lightning.utilities import move_data_to_device
+
+import create_instance
+from model import lora as lora_module
+from model.metric import StreamingPearson
+
+
+def to_dtype(model, dtype):
+    # metric 상태(float64 누적값)는 그대로 두고 모델 가중치만 변환
+    for module in model.children():
+        if not isinstance(module, torchmetrics.Metric):
+            module.to(dtype)
+    return model
+
+
+def convert(model, mode):
+    """
+    int8: nn.Linear 가중치를 int8로 저장하고 activation은 실행할 때 양자화 (dynamic quantization, cpu 전용)
+    bf16 / fp16: 모든 가중치를 bfloat16 / float16으로 변환 (fp16은 cuda 전용)
+    """
+    model = copy.deepcopy(model)
+    if mode == "int8":
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if mode == "bf16":
+        return to_dtype(model, torch.bfloat16)
+    if mode == "fp16":
+        return to_dtype(model, torch.float16)
+    raise ValueError(f"지원하지 않는 mode입니다: {mode} (int8, bf16, fp16)")
+
+
+def weights_mb(model):
+    # 양자화된 nn.Linear는 parameters()에 나오지 않으므로 직렬화한 state_dict 크기로 비교
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024**2
+
+
+def evaluate(model, loader, device):
+    # dev pearson, pair당 latency(ms), cuda면 최대 메모리(MB)
+    pearson = StreamingPearson().to(device)
+    model.to(device).eval()
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    n_pairs = 0
+    start = time.perf_counter()
+    with torch.no_grad():
+        for x, y in loader:
+            x, y = move_data_to_device((x, y), device)
+            pearson.update(model(x).float(), y)
+            n_pairs += len(y)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    peak_mb = torch.cuda.max_memory_allocated() / 1024**2 if device == "cuda" else float("nan")
+    return float(pearson.compute()), elapsed / n_pairs * 1000, peak_mb
+
+
+def quantize(args, conf):
+    """
+    저장된 모델을 quantize.modes의 정밀도로 변환하고 dev set에서 fp32 모델과 비교
+
+    dev pearson 하락이 quantize.tolerance 이하인 mode만 <체크포인트 이름>_<mode>.pt로 저장 (-m i -s 로 바로 추론)
+    mode별 latency, 가중치 크기, pearson을 quantize_report.csv로 저장
+    """
+    quant_conf = conf.quantize
+    device = quant_conf.device
+    if "int8" in quant_conf.modes and device != "cpu":
+        exit("int8 dynamic quantization은 cpu에서만 실행됩니다 (quantize.device: cpu)")
+    if "fp16" in quant_conf.modes and device != "cuda":
+        exit("fp16은 cuda에서만 지원합니다 (quantize.device: cuda)")
+    if quant_conf.num_threads:
+        torch.set_num_threads(quant_conf.num_threads)
+
+    dataloader, model = create_instance.new_instance(conf)
+    model, _, __ = create_instance.load_model(args, conf, dataloader, model)
+    model.cpu().eval()
+    lora_module.merge_lora(model)  # lora adapter는 weight에 합친 뒤 변환 (adapter가 없으면 그대로)
+
+    dataloader.setup("test")
+    dev_loader = dataloader.test_dataloader()
+
+    base_pearson, latency, peak_mb = evaluate(model, dev_loader, device)
+    rows = [{"mode": "fp32", "weights_mb": weights_mb(model), "latency_ms_per_pair": latency, "peak_memory_mb": peak_mb, "dev_pearson": base_pearson, "drop": 0.0, "accepted": True}]
+    print(rows[-1])
+    model.cpu()
+
+    save_name = conf.path.save_path + os.path.splitext(os.path.basename(args.saved_model))[0]
+    for mode in quant_conf.modes:
+        converted = convert(model, mode)
+        pearson, latency, peak_mb = evaluate(converted, dev_loader, device)
+        drop = base_pearson - pearson
+        accepted = drop <= quant_conf.tolerance
+        rows.append({"mode": mode, "weights_mb": weights_mb(converted), "latency_ms_per_pair": latency, "peak_memory_mb": peak_mb, "dev_pearson": pearson, "drop": drop, "accepted": accepted})
+        print(rows[-1])
+
+        if accepted:
+            torch.save(converted.cpu(), f"{save_name}_{mode}.pt")
+            print(f"저장 완료: {save_name}_{mode}.pt")
+        else:
+            print(f"{mode}: dev pearson 하락 {drop:.4f} > tolerance {quant_conf.tolerance}, 저장하지 않음")
+        del converted
+
+    report = pd.DataFrame(rows)
+    report["speedup"] = report["latency_ms_per_pair"].iloc[0] / report["latency_ms_per_pair"]
+    print(report.to_string(index=False))
+    report.to_csv(conf.path.save_path + "quantize_report.csv", index=False)
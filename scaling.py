@@ -0,0 +1,68 @@
+import json
+import os
+import tempfile
+import time
+
+import pandas as pd
+import pytorch_lightning as pl
+
+import create_instance
+import utils.utils as utils
+
+
+class ThroughputMonitor(pl.Callback):
+    """warmup batch 이후 학습 처리량(전체 rank 합산 샘플/초)을 재서 rank 0에서 json으로 저장"""
+
+    def __init__(self, output_path, warmup=3):
+        self.output_path = output_path
+        self.warmup = warmup
+        self.start = None
+        self.samples = 0
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        if batch_idx == self.warmup:
+            self.start = time.perf_counter()
+            self.samples = 0
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        if self.start is not None:
+            self.samples += len(batch[1]) * trainer.world_size
+
+    def on_train_end(self, trainer, pl_module):
+        if trainer.is_global_zero and self.start is not None:
+            elapsed = time.perf_counter() - self.start
+            with open(self.output_path, "w") as f:
+                json.dump({"samples": self.samples, "seconds": elapsed, "samples_per_sec": self.samples / elapsed}, f)
+
+
+def scaling_report(args, conf):
+    # rank 수를 바꿔가며 같은 학습 step 수를 돌려서 처리량 비교 (trainer 섹션의 accelerator / process_group_backend / num_threads 사용)
+    rows = []
+    for num_ranks in conf.trainer.scaling_ranks:
+        dataloader, model = create_instance.new_instance(conf)
+        output_path = os.path.join(tempfile.mkdtemp(), "throughput.json")
+        # 한 프로세스 안에서 rank 수를 바꿔가며 반복해야 하므로 스크립트를 다시 실행하는 ddp 대신 ddp_spawn 사용
+        strategy = "ddp_spawn" if num_ranks > 1 else None
+        trainer = utils.build_trainer(
+            conf,
+            logger=False,
+            callbacks=[ThroughputMonitor(output_path)],
+            devices=num_ranks,
+            strategy=strategy,
+            max_epochs=1,
+            limit_train_batches=conf.trainer.scaling_batches,
+            limit_val_batches=0,
+            enable_checkpointing=False,
+        )
+        trainer.fit(model=model, datamodule=dataloader)
+
+        with open(output_path) as f:
+            result = json.load(f)
+        rows.append({"ranks": num_ranks, "threads_per_rank": conf.trainer.num_threads, **result})
+        print(rows[-1])
+
+    report = pd.DataFrame(rows)
+    report["speedup"] = report["samples_per_sec"] / report["samples_per_sec"].iloc[0]
+    report["efficiency"] = report["speedup"] / (report["ranks"] / report["ranks"].iloc[0])
+    print(report.to_string(index=False))
+    report.to_csv("scaling_report.csv", index=False)
@@ -0,0 +1,138 @@
+import glob
+import os
+import time
+
+import pandas as pd
+import torch
+from pytorch_lightning.utilities import move_data_to_device
+
+import create_instance
+from model import lora as lora_module
+from model.metric import StreamingPearson
+
+
+def load_state_dict(path, model):
+    # .ckpt는 Lightning checkpoint의 state_dict, .pt는 저장된 모델 전체
+    if path.endswith(".pt"):
+        return torch.load(path, map_location="cpu").state_dict()
+    checkpoint = torch.load(path, map_location="cpu")
+    if checkpoint.get("hyper_parameters", {}).get("lora") is None:
+        return checkpoint["state_dict"]
+    # LoRA checkpoint는 adapter / head / 추가 토큰 embedding만 있으므로 pretrained backbone으로 채워서 같은 구조로 평균
+    if not lora_module.lora_layers(model):
+        exit(f"{path}는 LoRA adapter checkpoint입니다. 학습 때와 같은 lora 설정(lora.use_lora: True)으로 실행해주세요")
+    return {key: value.cpu() for key, value in lora_module.fill_backbone(model, checkpoint["state_dict"], checkpoint.get("added_embeddings")).items()}
+
+
+def average_state_dicts(state_dicts):
+    # 실수 텐서만 평균, 정수 버퍼(position_ids 등)는 첫 번째 것을 그대로 사용
+    first = state_dicts[0]
+    for i, state_dict in enumerate(state_dicts[1:], 1):
+        if state_dict.keys() != first.keys() or any(state_dict[k].shape != first[k].shape for k in first):
+            raise ValueError(f"{i}번째 체크포인트의 구조가 첫 번째와 다릅니다 (같은 모델 구조끼리만 평균 가능)")
+    averaged = {}
+    for key, value in first.items():
+        if value.is_floating_point():
+            averaged[key] = sum(state_dict[key].double() for state_dict in state_dicts).div(len(state_dicts)).to(value.dtype)
+        else:
+            averaged[key] = value
+    return averaged
+
+
+def predict_dev(model, loader, device):
+    # dev 예측값, pearson, 전체 dev를 한 번 도는 데 걸린 시간
+    pearson = StreamingPearson().to(device)
+    predictions = []
+    model.eval()
+    start = time.perf_counter()
+    with torch.no_grad():
+        for x, y in loader:
+            x, y = move_data_to_device((x, y), device)  # packing 입력(dict)도 그대로 옮김
+            logits = model(x)
+            pearson.update(logits, y)
+            predictions.append(logits.reshape(-1))
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return torch.cat(predictions), float(pearson.compute()), time.perf_counter() - start
+
+
+def pearson_of(predictions, targets):
+    metric = StreamingPearson().to(predictions.device)
+    metric.update(predictions, targets)
+    return float(metric.compute())
+
+
+def soup(args, conf):
+    """
+    같은 구조의 체크포인트들(top-k, fold)을 가중치 평균해서 모델 하나로 만듦
+
+    uniform: 전체 체크포인트의 단순 평균
+    greedy: dev pearson이 높은 순서로 하나씩 넣어보고, soup의 dev pearson이 떨어지지 않을 때만 유지
+    각 체크포인트, 예측값 평균 앙상블, 두 soup의 dev pearson과 latency를 비교해서 soup_report.csv로 저장
+    """
+    paths = sorted({path for pattern in conf.soup.checkpoints for path in glob.glob(pattern)})
+    if len(paths) < 2:
+        exit("soup.checkpoints에 평균낼 체크포인트를 2개 이상 지정해주세요")
+
+    dataloader, model = create_instance.new_instance(conf)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model.to(device)
+    dataloader.setup("test")
+    dev_loader = dataloader.test_dataloader()
+    targets = torch.cat([y.reshape(-1) for _, y in dev_loader]).to(device)
+    n_pairs = len(targets)
+
+    def evaluate(state_dict):
+        model.load_state_dict(state_dict)
+        return predict_dev(model, dev_loader, device)
+
+    state_dicts = [load_state_dict(path, model) for path in paths]  # evaluate 전에 채워야 backbone이 pretrained 그대로
+    use_lora = bool(lora_module.lora_layers(model))
+    rows, member_predictions, member_scores = [], [], []
+    for path, state_dict in zip(paths, state_dicts):
+        predictions, pearson, elapsed = evaluate(state_dict)
+        member_predictions.append(predictions)
+        member_scores.append(pearson)
+        rows.append({"model": os.path.basename(path), "members": 1, "dev_pearson": pearson, "latency_ms_per_pair": elapsed / n_pairs * 1000})
+        print(rows[-1])
+
+    # 앙상블은 멤버를 모두 실행해야 하므로 latency는 멤버 latency의 합
+    ensemble = torch.stack(member_predictions).mean(dim=0)
+    ensemble_latency = sum(row["latency_ms_per_pair"] for row in rows)
+    rows.append({"model": "ensemble", "members": len(paths), "dev_pearson": pearson_of(ensemble, targets), "latency_ms_per_pair": ensemble_latency})
+
+    uniform = average_state_dicts(state_dicts)
+    _, pearson, elapsed = evaluate(uniform)
+    rows.append({"model": "uniform_soup", "members": len(paths), "dev_pearson": pearson, "latency_ms_per_pair": elapsed / n_pairs * 1000})
+
+    order = sorted(range(len(paths)), key=lambda i: -member_scores[i])
+    selected, best = [order[0]], member_scores[order[0]]
+    for i in order[1:]:
+        _, pearson, _ = evaluate(average_state_dicts([state_dicts[j] for j in selected + [i]]))
+        if pearson >= best:
+            selected, best = selected + [i], pearson
+    greedy = average_state_dicts([state_dicts[i] for i in selected])
+    _, pearson, elapsed = evaluate(greedy)
+    rows.append({"model": "greedy_soup", "members": len(selected), "dev_pearson": pearson, "latency_ms_per_pair": elapsed / n_pairs * 1000})
+    print("greedy soup 멤버:", [os.path.basename(paths[i]) for i in selected])
+
+    # 첫 체크포인트의 hparams 등은 그대로 두고 state_dict만 바꿔서 저장 (-m i -s <soup.ckpt>로 바로 추론 가능)
+    # optimizer 상태는 평균한 가중치와 맞지 않으므로 빼고 저장, LoRA면 학습 때처럼 adapter / head / 추가 토큰 embedding만 저장
+    save_dir = os.path.dirname(paths[0])
+    base = torch.load(paths[0], map_location="cpu") if paths[0].endswith(".ckpt") else None
+    for name, state_dict in [("uniform", uniform), ("greedy", greedy)]:
+        if base is not None:
+            checkpoint = {k: v for k, v in base.items() if k not in ("optimizer_states", "lr_schedulers")}
+            checkpoint["state_dict"] = state_dict
+            if use_lora:
+                model.load_state_dict(state_dict)
+                checkpoint["state_dict"], checkpoint["added_embeddings"] = lora_module.adapter_state(model)
+            torch.save(checkpoint, os.path.join(save_dir, f"soup_{name}.ckpt"))
+        else:
+            model.load_state_dict(state_dict)
+            torch.save(model.cpu(), os.path.join(save_dir, f"soup_{name}.pt"))
+            model.to(device)
+
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    report.to_csv(os.path.join(save_dir, "soup_report.csv"), index=False)
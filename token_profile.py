@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+import create_instance
+from data_loader.data_loaders import pair_texts
+
+
+def pair_lengths(dataloader, path):
+    # 학습 때와 같은 방식으로 문장 쌍을 이어붙여 truncation 없이 토큰 길이를 잼
+    dataframe = pd.read_csv(path)
+    texts = pair_texts(dataframe, dataloader.text_columns, False, dataloader.preprocessor)
+    input_ids = dataloader.tokenizer(texts, add_special_tokens=True, truncation=False)["input_ids"]
+    return np.array([len(ids) for ids in input_ids])
+
+
+def suggest_buckets(lengths, max_length, num_buckets):
+    # 길이 분포의 분위수를 8의 배수로 올림한 값을 bucket 경계로 사용
+    clipped = np.minimum(lengths, max_length)
+    quantiles = np.quantile(clipped, [i / num_buckets for i in range(1, num_buckets)])
+    boundaries = {int(min(max_length, np.ceil(q / 8) * 8)) for q in quantiles}
+    return sorted(boundaries | {max_length})
+
+
+def padding_waste(lengths, padded_lengths):
+    # 전체 입력 토큰 중 pad 토큰의 비율
+    return 1 - np.minimum(lengths, padded_lengths).sum() / padded_lengths.sum()
+
+
+def bucket_padding_waste(lengths, boundaries, max_length):
+    # 각 쌍을 자기 bucket 경계까지 padding한다고 볼 때의 pad 비율 (batch 최대 길이까지만 채우므로 실제로는 이보다 작음)
+    bucket_of = np.searchsorted(boundaries, np.minimum(lengths, max_length))
+    return padding_waste(lengths, np.array(boundaries)[bucket_of])
+
+
+def packing_padding_waste(lengths, max_length, batch_size, seed=0):
+    # batch_size개씩 무작위로 묶어 pack_collate와 같은 first-fit으로 max_length 행에 담을 때의 pad 비율
+    lengths = np.random.default_rng(seed).permutation(np.minimum(lengths, max_length))
+    rows = 0
+    for start in range(0, len(lengths), batch_size):
+        free = []
+        for length in sorted(lengths[start : start + batch_size], reverse=True):
+            row = next((r for r, space in enumerate(free) if space >= length), None)
+            if row is None:
+                free.append(max_length - length)
+            else:
+                free[row] -= length
+        rows += len(free)
+    return 1 - lengths.sum() / (rows * max_length)
+
+
+def token_profile(args, conf):
+    dataloader = create_instance.new_dataloader(conf)
+    paths = {"train": conf.path.train_path, "dev": conf.path.test_path, "predict": conf.path.predict_path}
+    lengths = {split: pair_lengths(dataloader, path) for split, path in paths.items() if os.path.exists(path)}
+
+    print(f"model: {conf.model.model_name}")
+    for split, split_lengths in lengths.items():
+        p50, p90, p95, p99 = np.percentile(split_lengths, [50, 90, 95, 99])
+        print(f"[{split}] n={len(split_lengths)} mean={split_lengths.mean():.1f} p50={p50:.0f} p90={p90:.0f} p95={p95:.0f} p99={p99:.0f} max={split_lengths.max()}")
+
+    all_lengths = np.concatenate(list(lengths.values()))
+    candidates = sorted(c for c in conf.profile.candidates if c <= 512)
+    rows = []
+    for max_length in candidates:
+        rows.append(
+            {
+                "max_length": max_length,
+                "truncated": float((all_lengths > max_length).mean()),
+                "padding_waste": float(padding_waste(all_lengths, np.full_like(all_lengths, max_length))),
+            }
+        )
+    report = pd.DataFrame(rows)
+    report["bucket_padding_waste"] = [
+        float(bucket_padding_waste(all_lengths, suggest_buckets(all_lengths, c, conf.profile.num_buckets), c)) for c in report["max_length"]
+    ]
+    report["packing_padding_waste"] = [float(packing_padding_waste(all_lengths, c, conf.train.batch_size)) for c in report["max_length"]]
+
+    # 잘리는 쌍 비율이 허용치 이하인 가장 작은 후보
+    fits = report[report["truncated"] <= conf.profile.max_truncation]
+    max_length = int(fits["max_length"].iloc[0]) if len(fits) else candidates[-1]
+    boundaries = suggest_buckets(all_lengths, max_length, conf.profile.num_buckets)
+
+    print(report.to_string(index=False))
+    print(f"추천 max_length: {max_length} (truncated {float((all_lengths > max_length).mean()):.4f}, padding waste {padding_waste(all_lengths, np.full_like(all_lengths, max_length)):.3f})")
+    print(f"추천 bucket_boundaries: {boundaries} (bucket padding waste {bucket_padding_waste(all_lengths, boundaries, max_length):.3f})")
+
+    # data 모듈이 그대로 읽을 수 있는 config overlay로 저장 (python main.py ... -o <overlay 경로>)
+    os.makedirs("./config/overlay", exist_ok=True)
+    name = conf.model.model_name.replace("/", "_")
+    overlay_path = f"./config/overlay/token_profile_{name}.yaml"
+    OmegaConf.save(OmegaConf.create({"data": {"max_length": max_length, "bucket_boundaries": boundaries}}), overlay_path)
+    print(f"overlay 저장: {overlay_path}")
@@ -1,8 +1,12 @@
+import os
+
 import pytorch_lightning as pl
 import torch
+from omegaconf import OmegaConf
 from pytorch_lightning.loggers import WandbLogger
 
 import model.model as module_arch
+import utils.checkpoint as checkpoint
 import utils.utils as utils
 import wandb
 from data_loader.data_loaders import Dataloader, KfoldDataloader
@@ -11,17 +15,13 @@ import create_instance
 
 # train.train(conf)
 def train(args, conf):
-    project_name = conf.wandb.project
     dataloader, model = create_instance.new_instance(conf)  # 함수화로 변경
-    wandb_logger = WandbLogger(project=project_name)
-
-    save_path = f"{conf.path.save_path}{conf.model.model_name}_maxEpoch{conf.train.max_epoch}_batchSize{conf.train.batch_size}_{wandb_logger.experiment.name}/"
-    trainer = pl.Trainer(
-        accelerator="gpu",
-        devices=1,
-        max_epochs=conf.train.max_epoch,
-        log_every_n_steps=1,
-        logger=wandb_logger,
+    logger = utils.build_logger(conf)
+
+    save_path = f"{conf.path.save_path}{conf.model.model_name}_maxEpoch{conf.train.max_epoch}_batchSize{conf.train.batch_size}_{logger.experiment.name}/"
+    trainer = utils.build_trainer(
+        conf,
+        logger=logger,
         callbacks=[
             utils.early_stop(
                 monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
@@ -34,30 +34,75 @@ def train(args, conf):
                 monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
                 mode=utils.monitor_config[conf.utils.monitor]["mode"],
                 filename="{epoch}-{step}-{val_pearson}",  # best 모델 저장시에 filename 설정
+                async_save=OmegaConf.select(conf, "utils.async_save", default=False),
+                every_n_train_steps=OmegaConf.select(conf, "sub_validation.every_n_steps", default=None),
+            ),
+            utils.resume_save(
+                save_path=save_path,
+                every_n_steps=OmegaConf.select(conf, "utils.resume_every_n_steps", default=None),
+                every_n_minutes=OmegaConf.select(conf, "utils.resume_every_n_minutes", default=None),
             ),
+            *utils.swa_callbacks(conf, save_path),
         ],
     )
 
     trainer.fit(model=model, datamodule=dataloader)
     trainer.test(model=model, datamodule=dataloader)
-    wandb.finish()
-
-    trainer.save_checkpoint(save_path + "model.ckpt")
+    checkpoint.save_final(trainer, save_path + "model.ckpt")  # async_save면 로거 마무리와 겹쳐서 저장
+    utils.finish_logger(logger, save_path + "model.ckpt")
+    checkpoint.wait_all(trainer)
     # torch.save(model, save_path + "model.pt")
 
 
+def resume_train(args, conf):
+    # 가중치만 불러오는 continue_train과 달리 optimizer / scheduler / epoch / batch 위치 / RNG까지 복원해서 이어서 학습
+    dataloader, model = create_instance.new_instance(conf)
+    logger = utils.build_logger(conf)
+
+    save_path = os.path.dirname(args.saved_model) + "/"  # 중단된 학습과 같은 디렉터리에 이어서 저장
+    trainer = utils.build_trainer(
+        conf,
+        logger=logger,
+        callbacks=[
+            utils.early_stop(
+                monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
+                patience=conf.utils.patience,
+                mode=utils.monitor_config[conf.utils.monitor]["mode"],
+            ),
+            utils.best_save(
+                save_path=save_path,
+                top_k=conf.utils.top_k,
+                monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
+                mode=utils.monitor_config[conf.utils.monitor]["mode"],
+                filename="{epoch}-{step}-{val_pearson}",  # best 모델 저장시에 filename 설정
+                async_save=OmegaConf.select(conf, "utils.async_save", default=False),
+                every_n_train_steps=OmegaConf.select(conf, "sub_validation.every_n_steps", default=None),
+            ),
+            utils.resume_save(
+                save_path=save_path,
+                every_n_steps=OmegaConf.select(conf, "utils.resume_every_n_steps", default=None),
+                every_n_minutes=OmegaConf.select(conf, "utils.resume_every_n_minutes", default=None),
+            ),
+            *utils.swa_callbacks(conf, save_path),
+        ],
+    )
+
+    trainer.fit(model=model, datamodule=dataloader, ckpt_path=args.saved_model)
+    trainer.test(model=model, datamodule=dataloader)
+    checkpoint.save_final(trainer, save_path + "model.ckpt")
+    utils.finish_logger(logger, save_path + "model.ckpt")
+    checkpoint.wait_all(trainer)
+
+
 def continue_train(args, conf):
     dataloader, model = create_instance.new_instance(conf)
     model, args, conf = create_instance.load_model(args, conf, dataloader, model)  # train.py에 저장된 모델을 불러오는 메서드 따로 작성함
 
-    wandb_logger = WandbLogger(project=conf.wandb.project)
-    save_path = f"{conf.path.save_path}{conf.model.model_name}_maxEpoch{conf.train.max_epoch}_batchSize{conf.train.batch_size}_{wandb_logger.experiment.name}/"  # 모델 저장 디렉터리명에 wandb run name 추가
-    trainer = pl.Trainer(
-        accelerator="gpu",
-        devices=1,
-        max_epochs=conf.train.max_epoch,
-        log_every_n_steps=1,
-        logger=wandb_logger,
+    logger = utils.build_logger(conf)
+    save_path = f"{conf.path.save_path}{conf.model.model_name}_maxEpoch{conf.train.max_epoch}_batchSize{conf.train.batch_size}_{logger.experiment.name}/"  # 모델 저장 디렉터리명에 run 이름 추가
+    trainer = utils.build_trainer(
+        conf,
+        logger=logger,
         callbacks=[
             utils.early_stop(
                 monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
@@ -70,21 +115,22 @@ def continue_train(args, conf):
                 monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
                 mode=utils.monitor_config[conf.utils.monitor]["mode"],
                 filename="{epoch}-{step}-{val_pearson}",  # best 모델 저장시에 filename 설정
+                async_save=OmegaConf.select(conf, "utils.async_save", default=False),
+                every_n_train_steps=OmegaConf.select(conf, "sub_validation.every_n_steps", default=None),
             ),
+            *utils.swa_callbacks(conf, save_path),
         ],
     )
 
     trainer.fit(model=model, datamodule=dataloader)
     trainer.test(model=model, datamodule=dataloader)
-    wandb.finish()
-
-    trainer.save_checkpoint(save_path + "model.ckpt")
+    checkpoint.save_final(trainer, save_path + "model.ckpt")  # async_save면 로거 마무리와 겹쳐서 저장
+    utils.finish_logger(logger, save_path + "model.ckpt")
+    checkpoint.wait_all(trainer)
     # torch.save(model, save_path + "model.pt")
 
 
 def k_train(args, conf):
-    project_name = conf.wandb.project
-
     results = []
     num_folds = conf.k_fold.num_folds
 
@@ -99,6 +145,16 @@ def k_train(args, conf):
             conf.path.test_path,
             conf.path.predict_path,
             conf.data.swap,
+            max_length=OmegaConf.select(conf, "data.max_length", default=128),
+            bucket_boundaries=OmegaConf.select(conf, "data.bucket_boundaries", default=None),
+            packing=OmegaConf.select(conf, "data.packing", default=False),
+            eval_batch_size=OmegaConf.select(conf, "data.eval_batch_size", default=None),
+            max_tokens=OmegaConf.select(conf, "data.max_tokens", default=None),
+            eval_max_tokens=OmegaConf.select(conf, "data.eval_max_tokens", default=None),
+            num_workers=OmegaConf.select(conf, "data.num_workers", default=0),
+            lazy_tokenization=OmegaConf.select(conf, "data.lazy_tokenization", default=False),
+            sub_val_size=create_instance.sub_val_size(conf),
+            pruning=create_instance.pruning_config(conf),
         )
 
         Kmodel = module_arch.Model(
@@ -107,17 +163,16 @@ def k_train(args, conf):
             conf.train.loss,
             k_datamodule.new_vocab_size(),
             conf.train.use_frozen,
+            pad_token_id=None if k_datamodule.padding() == "max_length" else k_datamodule.tokenizer.pad_token_id,
+            lora=create_instance.lora_config(conf),  # fold마다 adapter만 저장, -m la로 backbone 하나에 번갈아 올림
         )
 
         name_ = f"{k+1}th_fold"
-        wandb_logger = WandbLogger(project=project_name, name=name_)
+        logger = utils.build_logger(conf, name=name_)
         save_path = f"{conf.path.save_path}{conf.model.model_name}_{conf.train.max_epoch}_{conf.train.batch_size}/"  # 모델 저장 디렉터리명에 wandb run name 추가
-        trainer = pl.Trainer(
-            accelerator="gpu",
-            devices=1,
-            max_epochs=conf.train.max_epoch,
-            log_every_n_steps=1,
-            logger=wandb_logger,
+        trainer = utils.build_trainer(
+            conf,
+            logger=logger,
             callbacks=[
                 utils.early_stop(
                     monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
@@ -130,18 +185,22 @@ def k_train(args, conf):
                     monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
                     mode=utils.monitor_config[conf.utils.monitor]["mode"],
                     filename=f"{k+1}_best_pearson_model",
+                    async_save=OmegaConf.select(conf, "utils.async_save", default=False),
+                    every_n_train_steps=OmegaConf.select(conf, "sub_validation.every_n_steps", default=None),
                 ),
+                *utils.swa_callbacks(conf, save_path, filename=f"{k+1}_soup_swa.ckpt"),
             ],
         )
 
         trainer.fit(model=Kmodel, datamodule=k_datamodule)
         score = trainer.test(model=Kmodel, datamodule=k_datamodule)
-        wandb.finish()
-
-        results.extend(score)
         save_model = f"{conf.path.save_path}{conf.model.model_name}_fold_{k+1}_epoch_{conf.train.max_epoch}_batchsize_{conf.train.batch_size}"
         # torch.save(Kmodel, save_model + ".pt")
-        trainer.save_checkpoint(save_model + ".ckpt")
+        checkpoint.save_final(trainer, save_model + ".ckpt")
+        utils.finish_logger(logger, save_model + ".ckpt")
+        checkpoint.wait_all(trainer)
+
+        results.extend(score)
 
     result = [x["test_pearson"] for x in results]
     score = sum(result) / num_folds
@@ -180,11 +239,9 @@ def sweep(args, conf, exp_count):  # 메인에서 받아온 args와 실험을 
 
         wandb_logger = WandbLogger(project=project_name)
         save_path = f"{conf.path.save_path}{conf.model.model_name}_sweep_id_{wandb.run.name}/"
-        trainer = pl.Trainer(
-            gpus=1,
-            max_epochs=conf.train.max_epoch,
+        trainer = utils.build_trainer(
+            conf,
             logger=wandb_logger,
-            log_every_n_steps=1,
             callbacks=[
                 utils.early_stop(
                     monitor=utils.monitor_config[conf.utils.monitor]["monitor"],
@@ -202,7 +259,8 @@ def sweep(args, conf, exp_count):  # 메인에서 받아온 args와 실험을 
         )
         trainer.fit(model=model, datamodule=dataloader)
         trainer.test(model=model, datamodule=dataloader)
-        trainer.save_checkpoint(save_path + "model.ckpt")
+        checkpoint.save_final(trainer, save_path + "model.ckpt")
+        checkpoint.wait_all(trainer)
         # torch.save(model, save_path + "model.pt")
 
     sweep_id = wandb.sweep(
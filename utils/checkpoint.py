@@ -0,0 +1,288 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from pytorch_lightning.callbacks import ModelCheckpoint, StochasticWeightAveraging
+from pytorch_lightning.utilities.apply_func import apply_to_collection
+
+
+def snapshot_checkpoint(trainer):
+    # 학습 스레드에서는 checkpoint dict를 CPU 메모리로 복사하는 데까지만 기다림
+    checkpoint = trainer._checkpoint_connector.dump_checkpoint(weights_only=False)
+    return apply_to_collection(checkpoint, torch.Tensor, lambda t: t.detach().to("cpu", copy=True))
+
+
+def atomic_save(checkpoint, filepath):
+    # 임시 파일에 다 쓴 뒤 rename 해서 중간에 죽어도 깨진 checkpoint가 남지 않도록 함
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    tmp_path = filepath + ".tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, filepath)
+
+
+class AsyncModelCheckpoint(pl.Callback):
+    """
+    ModelCheckpoint처럼 monitor 기준 top-k checkpoint를 남기되, 파일 쓰기는 백그라운드 스레드에서 함
+
+    validation이 끝날 때 top-k에 들면 state를 CPU로 snapshot하고 writer 스레드에 넘김
+    동시에 진행 중인 저장은 max_in_flight개로 제한 (넘으면 앞선 저장이 끝날 때까지 학습 스레드가 기다림)
+    top-k에서 밀려난 파일은 새 파일이 다 써진 뒤에 지움
+
+    Args:
+        dirpath: 저장 디렉터리
+        filename: ModelCheckpoint와 같은 형식의 파일명 템플릿, 예시: "{epoch}-{step}-{val_pearson}"
+        monitor: 비교할 metric 이름
+        mode: "max" 또는 "min"
+        save_top_k: 남길 checkpoint 수
+        max_in_flight: 동시에 진행 중인 저장의 최대 개수
+        every_n_train_steps: 설정하면 validation 끝이 아니라 이 step마다 비교 (val_sub_pearson)
+    """
+
+    def __init__(self, dirpath, filename, monitor, mode, save_top_k=1, max_in_flight=1, every_n_train_steps=None):
+        self.dirpath = dirpath
+        self.filename = filename
+        self.monitor = monitor
+        self.mode = mode
+        self.save_top_k = save_top_k
+        self.best_k_models = {}  # 경로 -> score
+        self.best_model_path = ""
+        self.max_in_flight = max_in_flight
+        self.every_n_train_steps = every_n_train_steps
+        self._last_step = None
+        self._init_writer()
+
+    def _init_writer(self):
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.writer = ThreadPoolExecutor(max_workers=1)  # 한 스레드에서 순서대로 써야 삭제가 저장보다 앞서지 않음
+        self.futures = []
+
+    def __getstate__(self):  # ddp_spawn으로 넘길 때 스레드 객체는 빼고 보냄
+        state = self.__dict__.copy()
+        for name in ["slots", "writer", "futures"]:
+            state.pop(name)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_writer()
+
+    def _better(self, score, other):
+        return score > other if self.mode == "max" else score < other
+
+    def _worst_path(self):
+        pick = min if self.mode == "max" else max
+        return pick(self.best_k_models, key=self.best_k_models.get)
+
+    def on_validation_end(self, trainer, pl_module):
+        if self.every_n_train_steps is None:
+            self.save_topk(trainer)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        step = trainer.global_step
+        if self.every_n_train_steps and step > 0 and step % self.every_n_train_steps == 0 and step != self._last_step:
+            self._last_step = step
+            self.save_topk(trainer)
+
+    def save_topk(self, trainer):
+        if trainer.sanity_checking or not trainer.is_global_zero or self.save_top_k == 0:
+            return
+        score = trainer.callback_metrics.get(self.monitor)
+        if score is None:
+            return
+        score = float(score)
+
+        evicted = None
+        if len(self.best_k_models) >= self.save_top_k:
+            worst = self._worst_path()
+            if not self._better(score, self.best_k_models[worst]):
+                return
+            self.best_k_models.pop(worst)
+            evicted = worst
+
+        metrics = {k: v for k, v in trainer.callback_metrics.items()}
+        metrics.update({"epoch": trainer.current_epoch, "step": trainer.global_step})
+        name = ModelCheckpoint._format_checkpoint_name(self.filename, metrics)
+        filepath = os.path.join(self.dirpath, name + ".ckpt")
+
+        self.best_k_models[filepath] = score
+        pick = max if self.mode == "max" else min
+        self.best_model_path = pick(self.best_k_models, key=self.best_k_models.get)
+        self.save(trainer, filepath, evicted=evicted)
+
+    def save(self, trainer, filepath, evicted=None):
+        # top-k와 상관없는 저장 (학습 종료 후 model.ckpt 등)에도 사용
+        self.slots.acquire()
+        try:
+            checkpoint = snapshot_checkpoint(trainer)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.futures.append(self.writer.submit(self._write, checkpoint, filepath, evicted))
+
+    def _write(self, checkpoint, filepath, evicted):
+        try:
+            atomic_save(checkpoint, filepath)
+            if evicted is not None and evicted != filepath and os.path.exists(evicted):
+                os.remove(evicted)
+        finally:
+            self.slots.release()
+
+    def wait(self):
+        # 진행 중인 저장이 모두 끝날 때까지 기다림, 저장 중 난 예외는 여기서 올라옴
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def on_fit_end(self, trainer, pl_module):
+        self.wait()
+
+    def state_dict(self):
+        return {"best_k_models": self.best_k_models, "best_model_path": self.best_model_path}
+
+    def load_state_dict(self, state_dict):
+        self.best_k_models = state_dict.get("best_k_models", {})
+        self.best_model_path = state_dict.get("best_model_path", "")
+
+
+class SWACheckpoint(StochasticWeightAveraging):
+    """
+    StochasticWeightAveraging에 더해, 학습이 끝날 때 평균 가중치를 filepath에 따로 저장함
+
+    Lightning의 SWA는 max_epochs까지 학습해야만 평균 가중치를 모델에 옮기므로, early stopping으로 일찍 끝나면 평균이 사라짐
+    그래서 어떻게 끝났든 on_train_end에서 평균 가중치로 잠시 바꿔 저장하고 학습 가중치로 되돌림 (max_epochs까지 가면 모델도 평균 가중치)
+    swa_epoch_start 전에 끝나서 평균한 epoch가 없으면 저장하지 않고 알림
+
+    Args:
+        filepath: 평균 가중치 checkpoint 경로 (예: save_path/soup_swa.ckpt)
+        kwargs: StochasticWeightAveraging 인자 (swa_lrs, swa_epoch_start 등)
+    """
+
+    def __init__(self, filepath, **kwargs):
+        super().__init__(**kwargs)
+        self.filepath = filepath
+
+    def on_train_end(self, trainer, pl_module):
+        super().on_train_end(trainer, pl_module)
+        if self.n_averaged is None or int(self.n_averaged) == 0:
+            if trainer.is_global_zero:
+                print(f"SWA 평균을 시작하기 전(swa_epoch_start)에 학습이 끝나서 {self.filepath}를 저장하지 않습니다")
+            return
+        trained = [p.detach().to("cpu", copy=True) for p in pl_module.parameters()]
+        self.transfer_weights(self._average_model, pl_module)
+        trainer.save_checkpoint(self.filepath, weights_only=True)  # 모든 rank가 같이 불러야 함
+        for param, value in zip(pl_module.parameters(), trained):
+            param.detach().copy_(value.to(param.device))
+        if trainer.is_global_zero:
+            print(f"SWA 평균 가중치({int(self.n_averaged)}개 epoch) 저장: {self.filepath}")
+
+
+def save_final(trainer, filepath):
+    # 학습 뒤 마지막 모델 저장, AsyncModelCheckpoint가 있으면 백그라운드로 저장 (wait_all로 완료 대기)
+    for callback in trainer.callbacks:
+        if isinstance(callback, AsyncModelCheckpoint):
+            if trainer.is_global_zero:
+                callback.save(trainer, filepath)
+            return
+    trainer.save_checkpoint(filepath)
+
+
+def wait_all(trainer):
+    for callback in trainer.callbacks:
+        if isinstance(callback, AsyncModelCheckpoint):
+            callback.wait()
+
+
+def get_rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def skip_batches(dataloader, num_batches):
+    # train dataloader의 sampler를 이번 epoch에서 num_batches만큼 앞으로 보냄
+    loader = getattr(dataloader, "loaders", dataloader)  # Lightning의 CombinedLoader면 안쪽 DataLoader
+    if hasattr(loader.batch_sampler, "skip"):  # BucketBatchSampler
+        loader.batch_sampler.skip(num_batches)
+    elif hasattr(loader.sampler, "skip"):  # ResumableSampler
+        loader.sampler.skip(num_batches * loader.batch_size)
+    else:
+        raise ValueError(f"{type(loader.sampler).__name__}는 batch 단위 재개를 지원하지 않습니다")
+
+
+class ResumeCheckpoint(pl.Callback):
+    """
+    step 수나 경과 시간마다 dirpath/last.ckpt를 덮어써서, 학습이 중간에 죽어도 같은 batch부터 이어서 학습할 수 있게 함
+
+    model / optimizer / scheduler / loop 상태는 Lightning checkpoint에 들어가고,
+    이 callback은 이번 epoch에서 학습한 batch 수와 RNG 상태를 callback state로 함께 저장함
+    (다른 ModelCheckpoint가 저장하는 checkpoint에도 들어가므로 어떤 .ckpt에서든 재개 가능)
+    trainer.fit(ckpt_path=...)로 재개하면 sampler가 이미 학습한 batch를 건너뛰고, 첫 batch 직전에 RNG를 되돌림
+
+    Args:
+        dirpath: 저장 디렉터리
+        every_n_steps: 몇 batch마다 저장할지 (None이면 사용 안 함)
+        every_n_minutes: 몇 분마다 저장할지 (None이면 사용 안 함)
+        filename: 저장 파일명
+    """
+
+    def __init__(self, dirpath, every_n_steps=None, every_n_minutes=None, filename="last.ckpt"):
+        self.filepath = os.path.join(dirpath, filename)
+        self.every_n_steps = every_n_steps
+        self.every_n_minutes = every_n_minutes
+        self.epoch = 0
+        self.batches_done = 0  # 이번 epoch에서 학습을 마친 batch 수
+        self._last_save = None
+        self._restored = None
+
+    def on_train_start(self, trainer, pl_module):
+        self._last_save = time.monotonic()
+        if self._restored is not None:
+            self.epoch, self.batches_done = self._restored["epoch"], self._restored["batches_done"]
+            if self.epoch == trainer.current_epoch and self.batches_done > 0:
+                skip_batches(trainer.train_dataloader, self.batches_done)
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        if self.epoch != trainer.current_epoch:
+            self.epoch, self.batches_done = trainer.current_epoch, 0
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        # DataLoader iterator를 만들면서 RNG를 한 번 쓰므로, 복원은 첫 batch를 받은 뒤에 해야 저장 시점과 같아짐
+        if self._restored is not None:
+            set_rng_state(self._restored["rng"])
+            self._restored = None
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.batches_done += 1
+        due = self.every_n_steps is not None and self.batches_done % self.every_n_steps == 0
+        if self.every_n_minutes is not None:
+            # rank마다 시간이 달라서 rank 0의 판단으로 맞춤 (save_checkpoint는 모든 rank가 같이 불러야 함)
+            due = trainer.strategy.broadcast(due or time.monotonic() - self._last_save >= self.every_n_minutes * 60)
+        if due:
+            self.save(trainer)
+
+    def save(self, trainer):
+        tmp_path = self.filepath + ".tmp"
+        trainer.save_checkpoint(tmp_path)
+        if trainer.is_global_zero:
+            os.replace(tmp_path, self.filepath)  # 저장 중에 죽어도 이전 last.ckpt는 남음
+        self._last_save = time.monotonic()
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "batches_done": self.batches_done, "rng": get_rng_state()}
+
+    def load_state_dict(self, state_dict):
+        self._restored = state_dict
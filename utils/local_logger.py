@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from argparse import Namespace
+
+import pandas as pd
+from pytorch_lightning.loggers.logger import Logger, rank_zero_experiment
+from pytorch_lightning.utilities import rank_zero_only
+
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT, project TEXT, name TEXT, started REAL, finished REAL, status TEXT, config TEXT, hparams TEXT
+);
+CREATE TABLE IF NOT EXISTS metrics (run_id INTEGER, step INTEGER, key TEXT, value REAL, wall_time REAL);
+CREATE INDEX IF NOT EXISTS metrics_run_key ON metrics (run_id, key);
+CREATE TABLE IF NOT EXISTS checkpoints (run_id INTEGER, path TEXT, score REAL, wall_time REAL);
+"""
+
+
+def connect(db_path):
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    db = sqlite3.connect(db_path, timeout=30)  # writer 스레드와 동시에 쓰면 잠깐 기다림 (WAL)
+    db.executescript(SCHEMA)
+    return db
+
+
+class LocalRun:
+    # WandbLogger처럼 logger.experiment.name으로 run 이름을 쓸 수 있게 하는 객체
+    def __init__(self, run_id, name):
+        self.run_id = run_id
+        self.name = name
+
+
+class LocalLogger(Logger):
+    """
+    scalar metric을 메모리 버퍼에 모았다가 백그라운드 스레드가 로컬 sqlite 파일에 append하는 로거 (네트워크 불필요)
+
+    log_metrics는 버퍼에 넣고 바로 돌아오고, writer 스레드가 flush_interval초마다 또는 버퍼가 flush_size개를 넘으면
+    한 transaction으로 기록함. run마다 config, hyperparameter, checkpoint 경로를 함께 저장
+    조회 / 비교: python -m utils.local_logger list | show | compare
+
+    Args:
+        db_path: sqlite 파일 경로
+        project: 프로젝트 이름 (wandb.project)
+        name: run 이름, None이면 시작 시각
+        config: run과 함께 저장할 전체 config (dict)
+        flush_interval: writer 스레드가 기록하는 주기(초)
+        flush_size: 버퍼에 이만큼 쌓이면 주기를 기다리지 않고 기록
+    """
+
+    def __init__(self, db_path, project, name=None, config=None, flush_interval=5.0, flush_size=1000):
+        super().__init__()
+        self.db_path = db_path
+        self.project = project
+        self.run_name = name or time.strftime("run-%Y%m%d-%H%M%S")
+        self.config = config
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._run = None
+        self._buffer = []
+        self._checkpoints = set()
+        self._init_writer()
+
+    def _init_writer(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._writer = None
+
+    def __getstate__(self):  # ddp_spawn으로 넘길 때 스레드 객체는 빼고 보냄
+        state = self.__dict__.copy()
+        for name in ["_lock", "_wake", "_stop", "_writer"]:
+            state.pop(name)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_writer()
+
+    @property
+    def name(self):
+        return self.project
+
+    @property
+    def version(self):
+        return self.run_name
+
+    @property
+    @rank_zero_experiment
+    def experiment(self):
+        # 처음 접근할 때 runs 테이블에 run을 만듦 (rank 0만)
+        if self._run is None:
+            db = connect(self.db_path)
+            cursor = db.execute(
+                "INSERT INTO runs (project, name, started, status, config) VALUES (?, ?, ?, ?, ?)",
+                (self.project, self.run_name, time.time(), "running", json.dumps(self.config, default=str)),
+            )
+            db.commit()
+            db.close()
+            self._run = LocalRun(cursor.lastrowid, self.run_name)
+        return self._run
+
+    def _execute(self, query, parameters):
+        # 학습 스레드에서 드물게 쓰는 기록 (hyperparameter, checkpoint, 상태)
+        db = connect(self.db_path)
+        db.execute(query, parameters)
+        db.commit()
+        db.close()
+
+    def _start_writer(self):
+        if self._writer is None:
+            self._stop.clear()
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        db = connect(self.db_path)
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._flush(db)
+        self._flush(db)
+        db.close()
+
+    def _flush(self, db):
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if rows:
+            db.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?)", rows)
+            db.commit()
+
+    @rank_zero_only
+    def log_metrics(self, metrics, step=None):
+        run_id = self.experiment.run_id
+        now = time.time()
+        rows = [(run_id, step, key, float(value), now) for key, value in metrics.items()]
+        with self._lock:
+            self._buffer.extend(rows)
+            full = len(self._buffer) >= self.flush_size
+        self._start_writer()
+        if full:
+            self._wake.set()
+
+    @rank_zero_only
+    def log_hyperparams(self, params, *args, **kwargs):
+        params = vars(params) if isinstance(params, Namespace) else dict(params)
+        self._execute("UPDATE runs SET hparams = ? WHERE run_id = ?", (json.dumps(params, default=str), self.experiment.run_id))
+
+    @rank_zero_only
+    def log_checkpoint(self, path, score=None):
+        if path in self._checkpoints:
+            return
+        self._checkpoints.add(path)
+        score = None if score is None else float(score)
+        self._execute("INSERT INTO checkpoints VALUES (?, ?, ?, ?)", (self.experiment.run_id, path, score, time.time()))
+
+    def after_save_checkpoint(self, checkpoint_callback):
+        # ModelCheckpoint가 저장할 때마다 호출됨, top-k에 들어간 경로를 기록
+        for path, score in getattr(checkpoint_callback, "best_k_models", {}).items():
+            self.log_checkpoint(path, score)
+
+    @rank_zero_only
+    def finalize(self, status):
+        # fit / test가 끝날 때마다 호출됨, 버퍼를 모두 기록하고 writer를 멈춤 (다음 log_metrics에서 다시 시작)
+        if self._run is None:
+            return
+        if self._writer is not None:
+            self._stop.set()
+            self._wake.set()
+            self._writer.join()
+            self._writer = None
+        self._execute("UPDATE runs SET finished = ?, status = ? WHERE run_id = ?", (time.time(), status, self._run.run_id))
+
+
+def list_runs(db_path, project=None):
+    db = connect(db_path)
+    query = """
+        SELECT r.run_id, r.project, r.name, r.status, datetime(r.started, 'unixepoch', 'localtime') AS started,
+               r.finished - r.started AS seconds, MAX(m.step) AS last_step,
+               MAX(CASE WHEN m.key = 'val_pearson' THEN m.value END) AS best_val_pearson,
+               (SELECT COUNT(*) FROM checkpoints c WHERE c.run_id = r.run_id) AS checkpoints
+        FROM runs r LEFT JOIN metrics m ON m.run_id = r.run_id
+        WHERE ? IS NULL OR r.project = ?
+        GROUP BY r.run_id ORDER BY r.run_id
+    """
+    runs = pd.read_sql_query(query, db, params=(project, project))
+    db.close()
+    return runs
+
+
+def metric_history(db_path, run_id, key):
+    db = connect(db_path)
+    history = pd.read_sql_query("SELECT step, value, wall_time FROM metrics WHERE run_id = ? AND key = ? ORDER BY wall_time", db, params=(run_id, key))
+    db.close()
+    return history
+
+
+def compare_runs(db_path, run_ids, keys):
+    # run마다 metric의 마지막 값과 최고 값 (loss는 최소, 나머지는 최대)
+    rows = []
+    for run_id in run_ids:
+        row = {"run_id": run_id}
+        for key in keys:
+            history = metric_history(db_path, run_id, key)
+            if len(history) == 0:
+                continue
+            row[f"{key}_last"] = history["value"].iloc[-1]
+            row[f"{key}_best"] = history["value"].min() if "loss" in key else history["value"].max()
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def show_run(db_path, run_id):
+    db = connect(db_path)
+    run = db.execute("SELECT name, status, config, hparams FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+    if run is None:
+        db.close()
+        exit(f"run {run_id}이 없습니다")
+    checkpoints = pd.read_sql_query("SELECT path, score FROM checkpoints WHERE run_id = ? ORDER BY wall_time", db, params=(run_id,))
+    summary = pd.read_sql_query(
+        "SELECT key, COUNT(*) AS n, MIN(value) AS min, MAX(value) AS max FROM metrics WHERE run_id = ? GROUP BY key", db, params=(run_id,)
+    )
+    db.close()
+    print(f"run {run_id}: {run[0]} ({run[1]})")
+    print("hparams:", run[3])
+    print("config:", run[2])
+    print(checkpoints.to_string(index=False))
+    print(summary.to_string(index=False))
+
+
+def benchmark(db_path, steps=2000):
+    """
+    Lightning이 매 step 부르는 log_metrics의 호출 시간을 LocalLogger와 wandb offline 모드로 비교
+    init_s: run 생성, per_step_us: log_metrics 한 번, finish_s: 남은 기록을 마치는 데 걸린 시간
+    """
+    import wandb
+    from pytorch_lightning.loggers import WandbLogger
+
+    metrics = {"train_loss": 0.5, "epoch": 0.0}
+    loggers = [
+        ("local", LocalLogger(db_path, "logger_benchmark", name="benchmark"), lambda logger: logger.finalize("success")),
+        ("wandb_offline", WandbLogger(project="logger_benchmark", offline=True), lambda logger: wandb.finish()),
+    ]
+    rows = []
+    for name, logger, finish in loggers:
+        start = time.perf_counter()
+        logger.experiment
+        init_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for step in range(steps):
+            logger.log_metrics(metrics, step=step)
+        per_step_us = (time.perf_counter() - start) / steps * 1e6
+
+        start = time.perf_counter()
+        finish(logger)
+        rows.append({"logger": name, "steps": steps, "init_s": init_s, "per_step_us": per_step_us, "finish_s": time.perf_counter() - start})
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    # 예시: python -m utils.local_logger compare 3 5 --metrics val_pearson train_loss
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default="./result/runs.sqlite")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list").add_argument("--project", default=None)
+    commands.add_parser("show").add_argument("run_id", type=int)
+    compare = commands.add_parser("compare")
+    compare.add_argument("run_ids", type=int, nargs="+")
+    compare.add_argument("--metrics", nargs="+", default=["val_pearson", "val_loss", "train_loss"])
+    commands.add_parser("bench").add_argument("--steps", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.command == "list":
+        print(list_runs(args.db, args.project).to_string(index=False))
+    elif args.command == "show":
+        show_run(args.db, args.run_id)
+    elif args.command == "compare":
+        print(compare_runs(args.db, args.run_ids, args.metrics).to_string(index=False))
+    elif args.command == "bench":
+        report = benchmark(args.db, args.steps)
+        print(report.to_string(index=False))
+        report.to_csv("logger_benchmark.csv", index=False)
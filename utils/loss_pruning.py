@@ -0,0 +1,63 @@
+import pytorch_lightning as pl
+import torch
+
+from data_loader.data_loaders import LossPruningBatchSampler
+
+
+class LossPruning(pl.Callback):
+    """
+    LossPruningBatchSampler로 뽑은 학습 batch에 importance weight를 넘기고, 학습 step이 남긴 예시별 loss를 sampler에 기록함
+
+    epoch 끝에 rank별 기록을 합쳐서(sum) 모든 rank의 loss EMA를 같게 갱신하고, 사용한 예시 비율을 pruning_kept_ratio로 기록
+    loss EMA는 callback state로 checkpoint에 들어가서 resume 후에도 이어서 사용
+    """
+
+    def __init__(self):
+        self.current = None
+        self.state = None
+
+    @staticmethod
+    def sampler(trainer):
+        loader = getattr(trainer.train_dataloader, "loaders", trainer.train_dataloader)  # Lightning의 CombinedLoader면 안쪽 DataLoader
+        sampler = getattr(loader, "batch_sampler", None)
+        return sampler if isinstance(sampler, LossPruningBatchSampler) else None
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        # dataloader iterator를 만들기 전, resume이면 checkpoint의 loss EMA로 이번 epoch batch 목록을 다시 만듦
+        self.current = self.sampler(trainer)
+        if self.current is None:
+            return
+        if self.state is not None:
+            self.current.ema = self.state["ema"]
+            self.state = None
+        self.current.set_epoch(trainer.current_epoch)
+        # Lightning은 fit 시작 때 센 epoch당 batch 수로 epoch 끝 검증 시점을 정하므로 이번 epoch batch 수로 맞춤
+        trainer.num_training_batches = len(self.current)
+        if isinstance(trainer.val_check_interval, float):
+            trainer.val_check_batch = max(1, int(trainer.num_training_batches * trainer.val_check_interval))
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        if self.current is not None:
+            pl_module.example_weights = self.current.weights[self.current.batches[batch_idx]].to(pl_module.device)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        if self.current is not None and pl_module.example_loss is not None:
+            self.current.record(torch.tensor(self.current.batches[batch_idx]), pl_module.example_loss.float().cpu())
+            pl_module.example_loss = None
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        if self.current is None:
+            return
+        loss_sum = trainer.strategy.reduce(self.current.loss_sum.to(pl_module.device), reduce_op="sum")
+        loss_count = trainer.strategy.reduce(self.current.loss_count.to(pl_module.device), reduce_op="sum")
+        self.current.update(loss_sum.cpu(), loss_count.cpu())
+        pl_module.log("pruning_kept_ratio", self.current.kept_ratio())
+
+    def on_train_end(self, trainer, pl_module):
+        pl_module.example_weights = None  # 이후 이 callback 없이 학습해도 평소 loss를 쓰도록
+
+    def state_dict(self):
+        return {} if self.current is None else {"ema": self.current.ema}
+
+    def load_state_dict(self, state_dict):
+        self.state = state_dict or None
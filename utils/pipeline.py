@@ -0,0 +1,177 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from omegaconf import OmegaConf
+
+DONE_FILE = "_SUCCESS.json"  # stage 완료 표시 파일, 이 파일이 있어야만 캐시로 인정
+
+
+def file_digest(path, chunk_size=1 << 20):
+    # 파일 내용의 sha256, 없는 파일은 경로만 반영
+    h = hashlib.sha256()
+    if not os.path.exists(path):
+        h.update(f"missing:{path}".encode())
+        return h.hexdigest()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Stage:
+    """
+    파이프라인의 한 단계
+
+    Args:
+        name: stage 이름 (파이프라인 안에서 유일해야 함)
+        func: func(conf, out_dir, inputs, **kwargs) 형태의 모듈 최상위 함수
+            inputs는 {의존 stage 이름: 해당 stage 출력 디렉터리}
+        conf: stage에 쓰이는 OmegaConf 설정
+        deps: 먼저 끝나야 하는 stage 이름들
+        data: 내용이 캐시 키에 들어가는 데이터 파일 경로들
+        code: 내용이 캐시 키에 들어가는 소스 파일 경로들
+        kwargs: func에 그대로 넘길 추가 인자 (캐시 키에 포함)
+    """
+
+    def __init__(self, name, func, conf=None, deps=(), data=(), code=(), kwargs=None):
+        self.name = name
+        self.func = func
+        self.conf = conf
+        self.deps = list(deps)
+        self.data = list(data)
+        self.code = list(code)
+        self.kwargs = kwargs or {}
+
+    def digest(self, dep_keys):
+        # 설정 + 데이터 + 코드 + 의존 stage 키를 모두 묶어서 content address를 만듦
+        h = hashlib.sha256()
+        h.update(self.name.encode())
+        h.update(f"{self.func.__module__}.{self.func.__qualname__}".encode())
+        if self.conf is not None:
+            h.update(OmegaConf.to_yaml(self.conf, resolve=True).encode())
+        h.update(json.dumps(self.kwargs, sort_keys=True, default=str).encode())
+        for path in sorted(self.data):
+            h.update(file_digest(path).encode())
+        for path in sorted(self.code):
+            h.update(file_digest(path).encode())
+        for dep in self.deps:
+            h.update(dep_keys[dep].encode())
+        return h.hexdigest()
+
+
+def _run_stage(stage, out_dir, inputs):
+    # 중간에 죽은 결과물이 캐시로 남지 않도록 임시 디렉터리에서 실행 후 rename
+    tmp_dir = out_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    stage.func(stage.conf, tmp_dir, inputs, **stage.kwargs)
+    with open(os.path.join(tmp_dir, DONE_FILE), "w") as f:
+        json.dump({"stage": stage.name, "inputs": inputs}, f, indent=2)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return stage.name
+
+
+class Pipeline:
+    """
+    Stage들을 DAG로 묶어서 실행함
+    각 stage의 출력은 cache_dir/<name>-<hash>/ 에 저장되고, 같은 해시의 완료된 출력이 있으면 건너뜀
+    """
+
+    def __init__(self, cache_dir="./result/cache"):
+        self.cache_dir = cache_dir
+        self.stages = {}
+
+    def add(self, stage):
+        if stage.name in self.stages:
+            raise ValueError(f"중복된 stage 이름: {stage.name}")
+        self.stages[stage.name] = stage
+        return stage
+
+    def _order(self):
+        # 위상 정렬, 순환이 있거나 없는 stage를 참조하면 에러
+        order, state = [], {}
+
+        def visit(name):
+            if name not in self.stages:
+                raise KeyError(f"정의되지 않은 stage: {name}")
+            if state.get(name) == "visiting":
+                raise ValueError(f"순환 의존성: {name}")
+            if state.get(name) == "done":
+                return
+            state[name] = "visiting"
+            for dep in self.stages[name].deps:
+                visit(dep)
+            state[name] = "done"
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def plan(self):
+        # stage 이름 -> 출력 디렉터리
+        keys, out_dirs = {}, {}
+        for name in self._order():
+            keys[name] = self.stages[name].digest(keys)
+            out_dirs[name] = os.path.join(self.cache_dir, f"{name}-{keys[name][:16]}")
+        return out_dirs
+
+    def is_done(self, out_dir):
+        return os.path.exists(os.path.join(out_dir, DONE_FILE))
+
+    def run(self, jobs=1, targets=None):
+        out_dirs = self.plan()
+        needed = set(self._order() if targets is None else self._closure(targets))
+        pending = {name for name in needed if not self.is_done(out_dirs[name])}
+
+        for name in self._order():
+            if name in needed and name not in pending:
+                print(f"[pipeline] skip  {name} (cached: {out_dirs[name]})")
+
+        def ready(name):
+            return all(dep not in pending for dep in self.stages[name].deps)
+
+        def inputs_of(name):
+            return {dep: out_dirs[dep] for dep in self.stages[name].deps}
+
+        if jobs <= 1:
+            for name in self._order():
+                if name in pending:
+                    print(f"[pipeline] run   {name}")
+                    _run_stage(self.stages[name], out_dirs[name], inputs_of(name))
+                    pending.discard(name)
+            return out_dirs
+
+        # 독립적인 stage들은 별도 프로세스에서 동시에 실행 (CUDA 때문에 spawn 사용)
+        running = {}
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+            while pending:
+                for name in self._order():
+                    if name in pending and name not in running.values() and ready(name):
+                        print(f"[pipeline] run   {name}")
+                        future = pool.submit(_run_stage, self.stages[name], out_dirs[name], inputs_of(name))
+                        running[future] = name
+                if not running:
+                    raise RuntimeError(f"실행할 수 없는 stage가 남음: {sorted(pending)}")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    future.result()  # stage 실패 시 여기서 예외가 올라옴, 끝난 stage들은 캐시에 남아있음
+                    pending.discard(name)
+        return out_dirs
+
+    def _closure(self, targets):
+        names, stack = set(), list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in names:
+                names.add(name)
+                stack.extend(self.stages[name].deps)
+        return names
@@ -0,0 +1,85 @@
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """
+    문장 쌍 예측값 캐시, STS는 대칭이므로 두 문장의 순서와 상관없이 같은 키를 사용
+
+    메모리에는 capacity개까지 LRU로 보관하고, disk_path를 주면 sqlite 파일에도 저장해서 실행 간에 공유함
+    키는 (model_id, 정렬한 전처리 후 문장 쌍의 해시)라서 다른 체크포인트의 예측과 섞이지 않음
+
+    Args:
+        model_id: 체크포인트와 입력 설정을 구분하는 문자열
+        capacity: 메모리에 둘 최대 쌍 수
+        disk_path: sqlite 파일 경로 (None이면 메모리만 사용)
+    """
+
+    def __init__(self, model_id, capacity=100000, disk_path=None):
+        self.model_id = model_id
+        self.capacity = capacity
+        self.memory = OrderedDict()
+        self.db = None
+        if disk_path is not None:
+            self.db = sqlite3.connect(disk_path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS predictions (model_id TEXT, pair TEXT, score REAL, PRIMARY KEY (model_id, pair))")
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def pair_key(first, second):
+        first, second = sorted((first, second))
+        return hashlib.sha1(f"{first}\x1f{second}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        # 찾은 키만 {키: 예측값}으로 돌려줌
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+        self.memory_hits += len(found)
+
+        rest = [key for key in keys if key not in found]
+        if self.db is not None and rest:
+            for i in range(0, len(rest), 500):  # sqlite 변수 개수 제한
+                chunk = rest[i : i + 500]
+                query = f"SELECT pair, score FROM predictions WHERE model_id = ? AND pair IN ({','.join('?' * len(chunk))})"
+                rows = self.db.execute(query, [self.model_id, *chunk]).fetchall()
+                self.disk_hits += len(rows)
+                found.update(rows)
+                self._remember(rows)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, scores):
+        self._remember(scores.items())
+        if self.db is not None:
+            self.db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)", [(self.model_id, k, v) for k, v in scores.items()])
+            self.db.commit()
+
+    def _remember(self, items):
+        for key, score in items:
+            self.memory[key] = score
+            self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "lookups": lookups,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_size": len(self.memory),
+        }
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,56 @@
+import pytorch_lightning as pl
+import torch
+from pytorch_lightning.callbacks.early_stopping import EarlyStopping
+from pytorch_lightning.utilities import move_data_to_device
+
+from model.metric import StreamingPearson
+
+
+class SubEarlyStopping(EarlyStopping):
+    # epoch 끝에는 확인하지 않고 SubValidation이 sub validation마다 확인함 (patience는 sub validation 횟수)
+    def _should_skip_check(self, trainer):
+        return True
+
+
+class SubValidation(pl.Callback):
+    """
+    학습 중 every_n_steps step마다 datamodule의 sub_val_dataset으로 pearson을 계산해서 val_sub_pearson으로 기록함
+    (sub_val_dataset: 검증 split에서 binary-label 비율대로 뽑은 고정 부분집합, 전체 검증은 그대로 epoch 끝에만)
+
+    값을 trainer.callback_metrics에도 넣어서 같은 step에 저장하는 ModelCheckpoint / AsyncModelCheckpoint(every_n_train_steps)가 사용하고,
+    SubEarlyStopping은 여기서 바로 확인함. build_trainer가 callback 목록 맨 앞에 넣어서 이들보다 먼저 실행됨
+
+    Args:
+        every_n_steps: 몇 optimizer step마다 sub validation을 할지
+    """
+
+    def __init__(self, every_n_steps):
+        self.every_n_steps = every_n_steps
+        self.loader = None
+        self._last_step = None
+
+    def on_train_start(self, trainer, pl_module):
+        dataset = getattr(trainer.datamodule, "sub_val_dataset", None)
+        self.loader = None if dataset is None else trainer.datamodule.make_dataloader(dataset, False)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        step = trainer.global_step
+        if self.loader is None or step == 0 or step % self.every_n_steps != 0 or step == self._last_step:
+            return
+        self._last_step = step
+
+        pearson = StreamingPearson().to(pl_module.device)
+        pl_module.eval()
+        with torch.no_grad():
+            for x, y in self.loader:
+                x, y = move_data_to_device((x, y), pl_module.device)
+                pearson.update(pl_module(x), y)
+        pl_module.train()
+        value = pearson.compute()  # 분산 학습이면 rank별 상태를 모아서 계산 (모든 rank가 같은 값)
+
+        trainer.callback_metrics["val_sub_pearson"] = value
+        for logger in trainer.loggers:
+            logger.log_metrics({"val_sub_pearson": float(value)}, step=step)
+        for callback in trainer.early_stopping_callbacks:
+            if isinstance(callback, SubEarlyStopping):
+                callback._run_early_stopping_check(trainer)
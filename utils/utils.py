@@ -1,31 +1,157 @@
+import os
+
 import pytorch_lightning as pl
+import torch
+import wandb
+from omegaconf import OmegaConf
 from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
+from pytorch_lightning.loggers import WandbLogger
+from pytorch_lightning.strategies import DDPSpawnStrategy, DDPStrategy
+
+from data_loader.shards import ShardEpoch
+from utils.checkpoint import AsyncModelCheckpoint, ResumeCheckpoint, SWACheckpoint
+from utils.local_logger import LocalLogger
+from utils.loss_pruning import LossPruning
+from utils.sub_validation import SubEarlyStopping, SubValidation
+
+
+def build_trainer(conf, logger=True, callbacks=None, **kwargs):
+    """
+    config의 trainer 섹션으로 pl.Trainer를 만듦 (섹션이 없으면 기존과 같은 gpu 1장)
+
+    Args:
+        conf: 전체 config, trainer.accelerator / devices / num_nodes / strategy / process_group_backend / num_threads 사용
+        logger: pl.Trainer의 logger 인자
+        callbacks: pl.Trainer의 callbacks 인자
+        kwargs: config보다 우선하는 pl.Trainer 인자 (예: devices=1, max_epochs=...)
+    """
+    trainer_conf = OmegaConf.select(conf, "trainer", default=None)
+    trainer_conf = {} if trainer_conf is None else OmegaConf.to_container(trainer_conf)
+    accelerator = kwargs.pop("accelerator", trainer_conf.get("accelerator", "gpu"))
+    devices = kwargs.pop("devices", trainer_conf.get("devices", 1))
+    strategy = kwargs.pop("strategy", trainer_conf.get("strategy"))
+    backend = trainer_conf.get("process_group_backend") or ("gloo" if accelerator == "cpu" else None)
+
+    # ddp 계열은 통신 backend를 지정 (cpu 클러스터는 gloo)
+    if strategy == "ddp":
+        strategy = DDPStrategy(process_group_backend=backend, find_unused_parameters=False)
+    elif strategy == "ddp_spawn":
+        strategy = DDPSpawnStrategy(process_group_backend=backend, find_unused_parameters=False)
+
+    callbacks = list(callbacks or [])
+    if any(isinstance(callback, AsyncModelCheckpoint) for callback in callbacks):
+        kwargs.setdefault("enable_checkpointing", False)  # Lightning 기본 ModelCheckpoint가 추가로 동기 저장하지 않도록
+    if trainer_conf.get("num_threads"):
+        callbacks.append(ThreadBudget(trainer_conf["num_threads"]))
+    if OmegaConf.select(conf, "data.shard_dir", default=None):
+        callbacks.append(ShardEpoch())  # shard 스트리밍 dataset에 epoch 전달 (shuffle 순서)
+    if OmegaConf.select(conf, "sub_validation.every_n_steps", default=None):
+        callbacks.insert(0, SubValidation(conf.sub_validation.every_n_steps))  # 같은 step의 checkpoint / early stopping보다 먼저 실행
+    if OmegaConf.select(conf, "pruning.use_pruning", default=False):
+        callbacks.append(LossPruning())  # 예시별 loss를 LossPruningBatchSampler에 기록 (쉬운 예시를 덜 뽑음)
+
+    trainer_kwargs = dict(
+        accelerator=accelerator,
+        devices=devices,
+        num_nodes=trainer_conf.get("num_nodes", 1),
+        strategy=strategy,
+        max_epochs=conf.train.max_epoch,
+        log_every_n_steps=1,
+        logger=logger,
+        callbacks=callbacks,
+        replace_sampler_ddp=False,  # 분산 sampler는 data 모듈에서 직접 만듦 (bucket sampler 때문)
+    )
+    trainer_kwargs.update(kwargs)
+    return pl.Trainer(**trainer_kwargs)
+
+
+def build_logger(conf, name=None):
+    """
+    logger.backend에 따라 학습 로거를 만듦 (섹션이 없으면 기존과 같은 WandbLogger)
+
+    wandb: wandb 서버로 전송 (logger.experiment.name이 wandb run 이름)
+    local: 네트워크 없이 logger.db_path sqlite 파일에 버퍼링해서 기록 (utils/local_logger.py)
+    """
+    if OmegaConf.select(conf, "logger.backend", default="wandb") == "local":
+        return LocalLogger(
+            conf.logger.db_path,
+            conf.wandb.project,
+            name=name,
+            config=OmegaConf.to_container(conf),
+            flush_interval=conf.logger.flush_interval,
+            flush_size=conf.logger.flush_size,
+        )
+    return WandbLogger(project=conf.wandb.project, name=name)
+
+
+def finish_logger(logger, checkpoint_path=None):
+    # 최종 checkpoint 경로를 run에 기록하고 닫음 (wandb는 업로드가 끝날 때까지 기다림)
+    if isinstance(logger, LocalLogger):
+        if checkpoint_path is not None:
+            logger.log_checkpoint(checkpoint_path)
+        logger.finalize("success")
+    else:
+        wandb.finish()
+
+
+class ThreadBudget(pl.Callback):
+    """rank(프로세스)마다 intra-op thread 수를 제한함, 한 노드에 여러 rank를 띄울 때 코어를 나눠 쓰기 위함"""
+
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+
+    def setup(self, trainer, pl_module, stage=None):
+        torch.set_num_threads(self.num_threads)
 
 
 def early_stop(monitor, patience, mode):
+    if monitor == "val_sub_pearson":  # epoch 끝이 아니라 sub validation마다 확인
+        return SubEarlyStopping(monitor=monitor, min_delta=0.00, patience=patience, verbose=False, mode=mode)
     early_stop_callback = EarlyStopping(monitor=monitor, min_delta=0.00, patience=patience, verbose=False, mode=mode)
     return early_stop_callback
 
 
-def best_save(save_path, top_k, monitor, mode, filename):
+def best_save(save_path, top_k, monitor, mode, filename, async_save=False, every_n_train_steps=None):
+    if monitor == "val_sub_pearson":  # sub validation을 하는 step마다 top-k 비교 (epoch 끝에는 저장하지 않음)
+        filename = filename.replace("{val_pearson}", "{val_sub_pearson}")
+    else:
+        every_n_train_steps = None
+    if async_save:  # 파일 쓰기를 백그라운드 스레드로 (학습은 CPU snapshot 동안만 멈춤)
+        return AsyncModelCheckpoint(dirpath=save_path, filename=filename, monitor=monitor, mode=mode, save_top_k=top_k, every_n_train_steps=every_n_train_steps)
     checkpoint_callback = ModelCheckpoint(
         dirpath=save_path,
         save_top_k=top_k,
         monitor=monitor,
         mode=mode,
         filename=filename,
+        every_n_train_steps=every_n_train_steps,
     )
     return checkpoint_callback
 
 
-def get_checkpoint_callback(criterion, save_frequency, prefix="checkpoint", use_modelcheckpoint_filename=False):
+def swa_callbacks(conf, save_path, filename="soup_swa.ckpt"):
+    # soup.swa가 켜져 있으면 학습 후반 epoch의 가중치를 평균해서 학습이 끝날 때 save_path/filename으로 저장
+    # (early stopping으로 끝나면 학습한 모델과 top-k checkpoint는 평균 가중치가 아님)
+    if not OmegaConf.select(conf, "soup.swa", default=False):
+        return []
+    return [SWACheckpoint(os.path.join(save_path, filename), swa_lrs=conf.soup.swa_lrs, swa_epoch_start=conf.soup.swa_epoch_start)]
+
+
+def resume_save(save_path, every_n_steps=None, every_n_minutes=None):
+    # save_path/last.ckpt를 주기적으로 덮어씀, resume 모드(-m r -s .../last.ckpt)로 같은 batch부터 이어서 학습
+    return ResumeCheckpoint(dirpath=save_path, every_n_steps=every_n_steps, every_n_minutes=every_n_minutes)
+
+
+def get_checkpoint_callback(criterion, save_frequency, prefix="checkpoint", use_modelcheckpoint_filename=False, dirpath="model_save/"):
 
     checkpoint_callback = None
     if criterion == "step":
-        checkpoint_callback = CheckpointEveryNSteps(save_frequency, prefix, use_modelcheckpoint_filename)
+        checkpoint_callback = CheckpointEveryNSteps(save_frequency, prefix, use_modelcheckpoint_filename, dirpath)
     elif criterion == "epoch":
-        checkpoint_callback = CheckpointEveryNEpochs(save_frequency, prefix, use_modelcheckpoint_filename)
+        checkpoint_callback = CheckpointEveryNEpochs(save_frequency, prefix, use_modelcheckpoint_filename, dirpath)
+    elif criterion == "minute":
+        checkpoint_callback = ResumeCheckpoint(dirpath=dirpath, every_n_minutes=save_frequency, filename=f"{prefix}_last.ckpt")
 
     return checkpoint_callback
 
@@ -41,6 +167,7 @@ class CheckpointEveryNSteps(pl.Callback):
         save_step_frequency,
         prefix="checkpoint",
         use_modelcheckpoint_filename=False,
+        dirpath="model_save/",
     ):
         """
         Args:
@@ -49,27 +176,29 @@ class CheckpointEveryNSteps(pl.Callback):
                 use_modelcheckpoint_filename=False
             use_modelcheckpoint_filename: just use the ModelCheckpoint callback's
                 default filename, don't use ours.
+            dirpath: directory to save the checkpoints in
         """
         self.save_step_frequency = save_step_frequency
         self.prefix = prefix
         self.use_modelcheckpoint_filename = use_modelcheckpoint_filename
+        self.dirpath = dirpath
 
-    def on_batch_end(self, trainer: pl.Trainer, _):
+    def on_train_batch_end(self, trainer: pl.Trainer, pl_module, outputs, batch, batch_idx):
         """Check if we should save a checkpoint after every train batch"""
         epoch = trainer.current_epoch
         global_step = trainer.global_step
         if global_step % self.save_step_frequency == 0:
             if self.use_modelcheckpoint_filename:
-                filename = trainer.checkpoint_callback.filename
+                filename = os.path.basename(trainer.checkpoint_callback.format_checkpoint_name({"epoch": epoch, "step": global_step}))
             else:
                 filename = f"{self.prefix}_epoch={epoch}_global_step={global_step}.ckpt"
-            ckpt_path = os.path.join("model_save/", filename)
+            ckpt_path = os.path.join(self.dirpath, filename)
             trainer.save_checkpoint(ckpt_path)
 
 
 class CheckpointEveryNEpochs(pl.Callback):
     """
-    Save a checkpoint every N steps, instead of Lightning's default that checkpoints
+    Save a checkpoint every N epochs, instead of Lightning's default that checkpoints
     based on validation loss.
     """
 
@@ -78,6 +207,7 @@ class CheckpointEveryNEpochs(pl.Callback):
         save_epoch_frequency,
         prefix="checkpoint",
         use_modelcheckpoint_filename=False,
+        dirpath="model_save/",
     ):
         """
         Args:
@@ -86,21 +216,23 @@ class CheckpointEveryNEpochs(pl.Callback):
                 use_modelcheckpoint_filename=False
             use_modelcheckpoint_filename: just use the ModelCheckpoint callback's
                 default filename, don't use ours.
+            dirpath: directory to save the checkpoints in
         """
         self.save_epoch_frequency = save_epoch_frequency
         self.prefix = prefix
         self.use_modelcheckpoint_filename = use_modelcheckpoint_filename
+        self.dirpath = dirpath
 
-    def on_epoch_end(self, trainer: pl.Trainer, _):
+    def on_train_epoch_end(self, trainer: pl.Trainer, pl_module):
         """Check if we should save a checkpoint after every train epoch"""
         epoch = trainer.current_epoch
         global_step = trainer.global_step
         if epoch % self.save_epoch_frequency == 0:
             if self.use_modelcheckpoint_filename:
-                filename = trainer.checkpoint_callback.filename
+                filename = os.path.basename(trainer.checkpoint_callback.format_checkpoint_name({"epoch": epoch, "step": global_step}))
             else:
                 filename = f"{self.prefix}_epoch={epoch}_global_step={global_step}.ckpt"
-            ckpt_path = os.path.join("model_save/", filename)
+            ckpt_path = os.path.join(self.dirpath, filename)
             trainer.save_checkpoint(ckpt_path)
 
 
@@ -108,4 +240,5 @@ class CheckpointEveryNEpochs(pl.Callback):
 monitor_config = {
     "val_loss": {"monitor": "val_loss", "mode": "min"},
     "val_pearson": {"monitor": "val_pearson", "mode": "max"},
+    "val_sub_pearson": {"monitor": "val_sub_pearson", "mode": "max"},  # sub_validation.every_n_steps 필요
 }
@@ -0,0 +1,93 @@
+import io
+import os
+
+import pandas as pd
+import torch
+from pytorch_lightning.utilities import move_data_to_device
+
+import create_instance
+from data_loader.data_loaders import tokenize_pairs
+from model.vocab import TrimmedEmbedding
+from soup import pearson_of
+
+
+def scan_corpora(dataloader, paths):
+    # corpus의 문장 쌍을 학습 / 추론과 같은 전처리와 tokenizer로 토크나이징해서 등장한 토큰 id와 횟수를 셈
+    counts = {}
+    for path in paths:
+        inputs = tokenize_pairs(dataloader.tokenizer, pd.read_csv(path), dataloader.text_columns, False, dataloader.preprocessor, padding=False)
+        for ids in inputs:
+            for token_id in ids:
+                counts[token_id] = counts.get(token_id, 0) + 1
+    return counts
+
+
+def predict_all(model, loader, device):
+    predictions = []
+    model.to(device).eval()
+    with torch.no_grad():
+        for batch in loader:
+            x = batch[0] if isinstance(batch, (list, tuple)) else batch
+            predictions.append(model(move_data_to_device(x, device)).reshape(-1).float().cpu())
+    return torch.cat(predictions)
+
+
+def serialized_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024**2
+
+
+def vocab_trim(args, conf):
+    """
+    corpus에 나오는 토큰과 special / 추가 토큰(<PERSON> 등)만 남기도록 word embedding을 잘라서 <체크포인트 이름>_trimmed.pt로 저장
+
+    embedding 행 수는 resize_token_embeddings 후 크기(원래 vocab + 추가 토큰) 기준으로 자르고, 입력 id는 모델 안에서 다시 매핑
+    dev / test에서 원래 모델과 예측 차이, pearson, 크기를 vocab_trim_report.csv로 비교
+    """
+    trim_conf = conf.vocab_trim
+    dataloader, model = create_instance.new_instance(conf)
+    model, _, __ = create_instance.load_model(args, conf, dataloader, model)
+    if isinstance(model.plm.get_input_embeddings(), TrimmedEmbedding):
+        exit("이미 vocab을 줄인 모델입니다")
+    embedding = model.plm.get_input_embeddings()
+    tokenizer = dataloader.tokenizer
+    if embedding.num_embeddings != len(tokenizer):
+        exit(f"embedding 행 수({embedding.num_embeddings})와 tokenizer 크기({len(tokenizer)})가 다릅니다 (같은 config로 학습한 체크포인트인지 확인)")
+
+    paths = list(trim_conf.corpora) or [conf.path.train_path, conf.path.test_path, conf.path.predict_path]
+    counts = scan_corpora(dataloader, paths)
+    kept = {token_id for token_id, count in counts.items() if count >= trim_conf.min_count}
+    kept |= set(tokenizer.all_special_ids) | set(tokenizer.get_added_vocab().values())
+    kept = sorted(kept)
+    print(f"{embedding.num_embeddings}개 중 {len(kept)}개 토큰 유지 ({len(counts)}개가 corpus에 등장)")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dataloader.setup("test")
+    loaders = {"dev": dataloader.test_dataloader(), "test": dataloader.predict_dataloader()}
+    targets = torch.cat([y.reshape(-1).float() for _, y in loaders["dev"]])
+    before = {name: predict_all(model, loader, device) for name, loader in loaders.items()}
+    rows = [{"model": "original", "vocab": embedding.num_embeddings, "params": sum(p.numel() for p in model.parameters()), "size_mb": serialized_mb(model), "dev_pearson": pearson_of(before["dev"], targets)}]
+
+    model.cpu()
+    model.plm.set_input_embeddings(TrimmedEmbedding(embedding, kept, tokenizer.unk_token_id))
+    after = {name: predict_all(model, loader, device) for name, loader in loaders.items()}
+    rows.append(
+        {
+            "model": "trimmed",
+            "vocab": len(kept),
+            "params": sum(p.numel() for p in model.parameters()),
+            "size_mb": serialized_mb(model),
+            "dev_pearson": pearson_of(after["dev"], targets),
+            **{f"{name}_max_abs_diff": float((after[name] - before[name]).abs().max()) for name in loaders},
+        }
+    )
+
+    save_name = conf.path.save_path + os.path.splitext(os.path.basename(args.saved_model))[0] + "_trimmed.pt"
+    model.cpu()
+    torch.save(model, save_name)
+
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    report.to_csv(conf.path.save_path + "vocab_trim_report.csv", index=False)
+    print(f"저장 완료: {save_name} ({os.path.getsize(save_name) / 1024**2:.1f}MB)")